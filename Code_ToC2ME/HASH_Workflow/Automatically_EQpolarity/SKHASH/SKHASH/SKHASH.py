@@ -22,26 +22,15 @@ appropriate papers.
 '''
 
 # Standard libraries
+import os
 import sys
+import copy
 import time
-import importlib.util
 import multiprocessing
 import argparse
 
 # External libraries
 import numpy as np
-import pandas as pd
-
-# Local libraries
-import functions.in_pol as in_pol # Reading polarity inputs
-import functions.in_sta as in_sta # Reading station files
-import functions.in_sp as in_sp # Reading S/P ratios
-import functions.in_qc as in_qc # Quality control of user inputs
-import functions.in_other as in_other # Functions for reading other inputs
-import functions.fun as fun # Computing mechanisms
-import functions.out as out # Output functions
-import functions.gridsearch_so as gridsearch_so # For creating fortran gridsearch module
-import functions.compute_mech as compute_mech # For computing mechanism
 
 # Superficial version information
 version_string='v0.1'
@@ -78,6 +67,10 @@ p_dict={
 	'outfile_pol_agree':'', # record of polarity (dis)agreeement output filename
 	'outfile_sp_agree':'', # record of S/P difference output filename
 	'outfile_pol_info':'', # record of all polarities considered in the mechanisms
+	'checkpoint_file':'', # Journal of the computed events. If the run is interrupted, rerunning it with the same parameters skips the events in this file. To ignore, leave blank.
+	'incremental':False, # If True, the results in checkpoint_file of the events whose inputs (e.g., picks, stations, catalog, parameters) are unchanged are reused, and only new or changed events are computed.
+	'per_event_seed':False, # If True, the random numbers of each event are seeded by its event id, so its results do not depend on the other events computed. Enabled when using checkpoint_file.
+	'output_flush_interval':1.0, # The lines of outfile1/outfile2 are written in batches at most every output_flush_interval seconds. If 0, the lines of each event are written as soon as it is computed.
 	'outfolder_plots':'./figures', # Folder where simple focal mechanism plots will be created (outfolder_plots/event_id.png). To ignore, leave blank.
 
 	'npolmin':8, # mininum number of polarity data (e.g., 8)
@@ -101,6 +94,8 @@ p_dict={
 	'vmodel_paths':[], # list of paths to velocity model
 	'write_lookup_table':False, # The lookup table will be saved so that it can be used in future runs. A .npy file extension will be added to the vmodel_paths.
 	'recompute_lookup_table':True, # If a velocity model with an identical filename already exists, it will remake it.
+	'lookup_table_cache_dir':'', # If provided, lookup tables are cached in this folder, keyed by a hash of the velocity model contents and the lookup table parameters, and reused whenever they match (regardless of recompute_lookup_table). Several SKHASH runs can safely share the folder.
+	'lookup_table_cache_max_mb':1000, # Maximum size (MB) of the cached lookup tables. The least recently used tables are removed.
 
 	'require_temporal_match':False, # Requires the reported earthquake to occur between the station metadata start-end time.
 	'require_network_match':False, # Requires the reported pick network to match the metadata
@@ -118,14 +113,33 @@ p_dict={
 
 	'ignore_missing_metadata':False, # If True, any measurements with missing metadata will be ignored. If False, an error will be raised.
 
-	'use_fortran':False, # If True, it will attempt to load the Fortran subroutine. If it cannot load or is False, the Python routine will be used.
+	'gridsearch_backend':'python', # Grid search backend: 'python', 'fortran' (compiled with f2py, requires a Fortran compiler), 'numba' (requires the numba package), or 'auto' (times the available backends at startup and uses the fastest).
+	'gridsearch_build_dir':'', # Folder where the fortran backend is compiled. If empty, functions/build is used.
+	'use_fortran':False, # Deprecated. If True, equivalent to gridsearch_backend='fortran'.
 	'num_cpus':1, # Number of cores to run things in parallel. Set to 0 to use all available, or 1 to run in serial.
 
 	'dang':5, # minimum grid spacing (degrees).
+	'mech_sampling':'grid', # Test mechanisms: 'grid' (the grid used by HASH), or 'so3' (a quasi-uniform sampling of rotation space with a spacing of about dang; 4-8% fewer test mechanisms, without increasing the distance to the nearest test mechanism). 'so3' is not available with the fortran backend.
+	'max_gridsearch_memory_mb':0, # If >0, the Python and Numba grid searches are done in tiles of test mechanisms (and trials, if needed) so that their temporary arrays use at most roughly this many MB. Results are identical to the untiled grid search. Set to 0 to disable.
+	'bitpacked_polarity':False, # If True, the Python grid search packs the predicted P-polarity signs of the test mechanisms into 64-bit words and counts misfits with XOR and bit-sliced counters. Its memory use does not grow with the number of polarities; results are identical for unweighted polarities (or weights that are powers of two).
+	'coarse_dang':0, # If >0, a coarse-to-fine grid search is done: test mechanisms are first evaluated on a grid with this spacing (degrees), and only the fine (dang) mechanisms near acceptable coarse mechanisms are then evaluated. Must be larger than dang. Set to 0 to search the full grid.
+	'early_rejection':False, # If True, events without S/P ratios are first scored on the unperturbed trial, and the other trials are only scored on the mechanisms that could still be acceptable. The acceptable mechanisms are identical to the full grid search. Fastest when the trials are only slightly perturbed.
+	'early_rejection_trials':0, # Number of additional (evenly spaced) trials scored on every mechanism when early_rejection=True.
+	'gridsearch_threads':1, # Number of threads computing the Python grid search of each event, each computing the misfits of a part of the test mechanisms.
+	'intra_event_min_picks':0, # If >0, when running in parallel, the Python grid searches of events with at least this many P-polarities and S/P ratios are split across threads (see gridsearch_threads). Each of these events is given a share of the num_cpus cores proportional to its share of the estimated runtime of all events. The extra threads run on cores set aside from the worker processes (at most half of num_cpus). Set to 0 to disable.
+	'memory_budget_mb':0, # If >0, approximate memory budget (MB) of the grid searches. In parallel, tasks are held back until their estimated peak memory fits in the budget, and events whose grid search alone exceeds the budget are computed alone, with their grid search tiled to memory_budget_mb/num_cpus (see max_gridsearch_memory_mb). In serial, grid searches are tiled to the budget. Set to 0 to disable.
+	'parallel_schedule':'cost', # Order of the events computed in parallel (num_cpus>1). 'cost': the events estimated to be the most expensive (from their number of polarities and S/P ratios) are computed first, and inexpensive events are grouped into tasks. 'ordered': the events are computed in order, one at a time.
+	'ray_cache_resolution':0, # If >0, the Python grid search quantizes the ray directions to cells of about this many degrees, and caches the predicted P-polarity signs and S/P ratios of each cell for every test mechanism (see functions/ray_cache.py). Much faster when rays repeat across events and trials, but the misfits become approximate. Set to 0 to disable.
+	'ray_cache_max_memory_mb':500, # Approximate memory budget (MB) of the ray direction cache. Once exceeded, the least recently used cells are replaced.
+	'dir_cos_cache_dir':'', # If provided, the test mechanism direction cosines (and the coarse grid, if coarse_dang>0) are cached in this folder and memory-mapped. Parallel workers then load the cached arrays rather than receiving copies. Leave empty to compute them every run.
 	'nx0':101, # maximum source-station distance bins for look-up tables
 	'nd0':14, # maximum source depth bins for look-up tables
 	'look_dep':[0,39,3], # minimum source depth, maximum, and interval for the lookup table
 	'look_del':[0,200,2], # minimum source-station distance, maximum, and interval for the lookup table
+	'lookup_grid':'uniform', # Lookup table grid. 'uniform': depths and distances on the intervals of look_dep and look_del. 'adaptive': non-uniform depth and distance knots within the look_dep and look_del ranges, dense where the hypocenters and source-station distances fall (see fun.adaptive_lookup_grid). nd0 and nx0 are then set to the number of knots.
+	'lookup_num_knots':[40,80], # When lookup_grid='adaptive', the number of depth and distance knots
+	'lookup_dep_knots':[], # When lookup_grid='adaptive', depth knots (km) to use rather than determining them from the hypocenters
+	'lookup_del_knots':[], # When lookup_grid='adaptive', distance knots (km) to use rather than determining them from the source-station distances
 	'allow_hypocenters_outside_table':False, # If a hypocenter is outside of the lookup table range, the min/max lookup value is used. If False, an error will be produced.
 	'nump':9000, # number of rays traced
 
@@ -149,7 +163,7 @@ p_dict={
 
 	# Warning: only change the following values if you know what you're doing! :)
 	'compute_takeoff_azimuth':True, # Used to determine if takeoff and source-receiver azimuths need to be computed
-	'npick0':15000, # maximum number of picks per event. Used by Fortran gridsearch. If this is changed, the value in gridsearch.f must be changed and recompiled.
+	'npick0':15000, # Deprecated and ignored. The Fortran gridsearch arrays are now sized by the number of picks.
 	'merge_on':[] # Controls how to merge metadata with observations. List that includes ('network', 'station', 'location', 'channel')
 }
 
@@ -162,33 +176,93 @@ qual_criteria_dict={
 				'stdr':np.asarray(       [ 0.5,  0.4,  0.3,      0 ]),
 				}
 
-'''
-Reads command line arguments.
-Note that if you also use a control file, the control file variable will overwrite command line arguments.
-'''
-parser = argparse.ArgumentParser()
-parser.add_argument('controlfile',nargs='?')
-for p_dict_var in p_dict.keys():
-	parser.add_argument('--'+p_dict_var)
-args = vars(parser.parse_args())
-for p_dict_var in p_dict.keys():
-	if args[p_dict_var] is not None:
-		dtype=type(p_dict[p_dict_var])
-		if dtype==bool:
-			if args[p_dict_var].lower() in ['true','1']:
-				p_dict[p_dict_var]=True
-			elif args[p_dict_var].lower() in ['false','0']:
-				p_dict[p_dict_var]=False
+
+def default_parameters():
+	'''
+	Returns a copy of the default parameter values (p_dict).
+	'''
+	return copy.deepcopy(p_dict)
+
+
+def parse_command_line(argv=None):
+	'''
+	Reads command line arguments.
+	Note that if you also use a control file, the control file variable will overwrite command line arguments.
+	Input:
+		argv: list of the command line arguments. If None, sys.argv is used.
+	Output:
+		config: dictionary of the parameter values given on the command line
+	'''
+	parser = argparse.ArgumentParser()
+	parser.add_argument('controlfile',nargs='?')
+	for p_dict_var in p_dict.keys():
+		parser.add_argument('--'+p_dict_var)
+	args = vars(parser.parse_args(argv))
+	config={}
+	for p_dict_var in p_dict.keys():
+		if args[p_dict_var] is not None:
+			dtype=type(p_dict[p_dict_var])
+			if dtype==bool:
+				if args[p_dict_var].lower() in ['true','1']:
+					config[p_dict_var]=True
+				elif args[p_dict_var].lower() in ['false','0']:
+					config[p_dict_var]=False
+				else:
+					raise ValueError(('Expected a boolean for the command-line declared variable \'{}\''+\
+						  'The provided value ({}) is not a boolean.').format(p_dict_var,args[p_dict_var]))
 			else:
-				raise ValueError(('Expected a boolean for the command-line declared variable \'{}\''+\
-					  'The provided value ({}) is not a boolean.').format(p_dict_var,args[p_dict_var]))
-		else:
-			p_dict[p_dict_var]=dtype(args[p_dict_var])
+				config[p_dict_var]=dtype(args[p_dict_var])
+	return config
+
+
+def run(config=None,warm_state=None):
+	'''
+	Computes the focal mechanisms, writing the output files given by the parameters.
+	Input:
+		config: parameter values overwriting the default values (p_dict), dictionary. Can also be the path of a
+			control file. Note that the values of a control file (controlfile) overwrite the other values.
+		warm_state: if provided, a dictionary in which the inputs that do not depend on the events (the lookup tables,
+			the test mechanisms, and the station file) are kept, so that later calls with the same parameters reuse
+			them (see functions/service.py).
+	Output:
+		results: dictionary with the following keys:
+			mech_df: preferred mechanisms of the events (i.e., the content of outfile1), dataframe
+			pol_df: polarity dataframe, with the agreement of the measurements with the mechanisms
+			cat_df: catalog dataframe
+			p_dict: parameter values used
+	'''
+	# The libraries used to compute the mechanisms are imported here rather than when importing SKHASH,
+	# so that importing SKHASH (e.g., by the processes of a spawn-based multiprocessing pool) is fast.
+	import pandas as pd
+	import functions.in_pol as in_pol # Reading polarity inputs
+	import functions.in_sta as in_sta # Reading station files
+	import functions.in_sp as in_sp # Reading S/P ratios
+	import functions.in_qc as in_qc # Quality control of user inputs
+	import functions.in_other as in_other # Functions for reading other inputs
+	import functions.fun as fun # Computing mechanisms
+	import functions.out as out # Output functions
+	import functions.gridsearch_backends as gridsearch_backends # Grid search backends
+	import functions.compute_mech as compute_mech # For computing mechanism
+	import functions.ray_cache as ray_cache # Caching predictions of quantized ray directions
+	import functions.shared as shared # Sharing inputs with parallel workers
+	import functions.checkpoint as checkpoint # Checkpointing the computed events
+	import functions.scheduler as scheduler # Scheduling the events computed in parallel
+	import functions.service as service # Keeping inputs warm between runs
 
-if __name__ == "__main__":
 	print('========================\nSKHASH {} ({})\n========================'.format(version_string,version_date))
 	total_runtime_start=time.time()
 
+	'''
+	Sets the parameter values
+	'''
+	if isinstance(config,str):
+		config={'controlfile':config}
+	p_dict=default_parameters()
+	for p_dict_var,value in (config or {}).items():
+		if not(p_dict_var in p_dict):
+			raise ValueError('Unknown parameter: {}'.format(p_dict_var))
+		p_dict[p_dict_var]=copy.deepcopy(value)
+
 	'''
 	Checks Python version.
 	'''
@@ -202,21 +276,8 @@ if __name__ == "__main__":
 		print('Control file: {}'.format(p_dict['controlfile']))
 		p_dict=in_other.read_control_file(p_dict['controlfile'],p_dict)
 
-	'''
-	Loads/creates the fortran extension module
-	'''
 	if p_dict['use_fortran']:
-		gridsearch_spec = importlib.util.find_spec("functions.gridsearch")
-		if (gridsearch_spec is not None):
-			import functions.gridsearch as gridsearch
-			print('Fortran subroutine module successfully loaded.')
-		else:
-			status=gridsearch_so.create()
-			if status:
-				import functions.gridsearch as gridsearch
-			else:
-				p_dict['use_fortran']=False
-				print('Unable to load Fortran subroutine. Falling back to using the Python gridsearch routine.\n')
+		p_dict['gridsearch_backend']='fortran'
 
 	'''
 	Performs various checks to ensure that the user-defined parameters are appropriate
@@ -304,7 +365,7 @@ if __name__ == "__main__":
 
 	if len(pol_df)==0:
 		print('No polarity information provided. Exiting.')
-		quit()
+		return {'mech_df':pd.DataFrame(),'pol_df':pol_df,'cat_df':cat_df,'p_dict':p_dict}
 
 	'''
 	Reads earthquake catalog
@@ -346,7 +407,10 @@ if __name__ == "__main__":
 	Reads station metadata file and appends the locations to the polarities
 	'''
 	if p_dict['stfile']:
-		station_df=in_sta.read_station_file(pol_df,p_dict)
+		station_df=service.warm_input(warm_state,'station_df',
+							service.warm_key(dict(p_dict,stfile=service.file_key(p_dict['stfile'])),['stfile','input_format_stfile','merge_on','require_temporal_match']),
+							lambda: in_sta.load_station_file(p_dict))
+		station_df=in_sta.read_station_file(pol_df,p_dict,station_df)
 		pol_df=in_sta.apply_station_locations(pol_df,station_df,p_dict)
 
 	# Drops columns that are no longer needed
@@ -433,17 +497,30 @@ if __name__ == "__main__":
 	Reads the velocity model files and creates (or loads) the lookup tables.
 	'''
 	if p_dict['compute_takeoff_azimuth']:
-		lookup_dict=fun.create_lookup_table(p_dict)
+		if p_dict['lookup_grid']=='adaptive':
+			p_dict=fun.adaptive_lookup_grid(pol_df,p_dict)
+		lookup_key=service.warm_key(dict(p_dict,vmodel_paths=[service.file_key(vmodel_path) for vmodel_path in p_dict['vmodel_paths']]),
+							['vmodel_paths','look_dep','look_del','lookup_grid','lookup_dep_knots','lookup_del_knots','nump','nx0','nd0','output_angle_precision'])
+		lookup_dict=service.warm_input(warm_state,'lookup_dict',lookup_key,lambda: fun.create_lookup_table(p_dict))
 	else:
 		lookup_dict={'deptab':[],'delttab':[],'table':[]}
 
 	'''
 	Sets up array with direction cosines for all coordinate transformations
 	'''
-	if p_dict['use_fortran']:
+	if p_dict['gridsearch_backend']=='fortran':
 		dir_cos_dict={}
+	elif p_dict['dir_cos_cache_dir']:
+		dir_cos_dict=fun.cached_dir_cos_setup(p_dict)
 	else:
-		dir_cos_dict=fun.dir_cos_setup(p_dict)
+		dir_cos_key=service.warm_key(dict(p_dict,ampfile=bool(p_dict['ampfile'])),['dang','mech_sampling','min_amp','ampfile','coarse_dang'])
+		dir_cos_dict=service.warm_input(warm_state,'dir_cos_dict',dir_cos_key,
+							lambda: fun.coarse_grid_setup(fun.dir_cos_setup(p_dict),p_dict) if p_dict['coarse_dang'] else fun.dir_cos_setup(p_dict))
+
+	'''
+	Selects the grid search backend (python, fortran, or numba)
+	'''
+	p_dict['gridsearch_backend']=gridsearch_backends.select_backend(p_dict,dir_cos_dict)
 
 	'''
 	Groups polarities and S/P ratios by event_id
@@ -464,62 +541,120 @@ if __name__ == "__main__":
 
 	if not(event_ids):
 		print('No mechanisms to compute. Exiting.')
-		quit()
+		return {'mech_df':pd.DataFrame(),'pol_df':pol_df,'cat_df':cat_df,'p_dict':p_dict}
 
 	'''
 	Computes the focal mechanisms
 	'''
 	mech_runtime_start=time.time()
 	num_events=len(event_ids)
-	if p_dict['num_cpus']==1: # Run in serial
-		print('Computing mechanisms in serial...')
-		for event_x,event_id in enumerate(event_ids):
-			mech_dict=compute_mech.compute_mech(event_x,num_events,event_id,group_pol_df.get_group(event_id),
-												p_dict,lookup_dict,qual_criteria_dict,cat_df,dir_cos_dict)
-			if mech_dict['mech_qual']:
-				pol_df.loc[mech_dict['event_index'],'mech_quality']=mech_dict['mech_qual']
-				if p_dict['outfile_pol_agree']:
-					pol_df.loc[mech_dict['event_index'],'pol_agreement']=mech_dict['pol_agreement_out']
-				if p_dict['outfile_sp_agree']:
-					pol_df.loc[mech_dict['event_index'],'sp_diff']=mech_dict['sp_diff_out']
-				if (p_dict['stfile']) and (p_dict['outfile_pol_info']):
-					pol_df.loc[mech_dict['event_index'],'takeoff']=mech_dict['takeoff']
-					pol_df.loc[mech_dict['event_index'],'azimuth']=mech_dict['sr_az']
-					pol_df.loc[mech_dict['event_index'],'takeoff_uncertainty']=mech_dict['takeoff_uncertainty']
-					pol_df.loc[mech_dict['event_index'],'azimuth_uncertainty']=mech_dict['azimuth_uncertainty']
-	else: # Run in parallel
-		print('Computing mechanisms in parallel...')
-		pool=multiprocessing.Pool(processes=p_dict['num_cpus'])
-
-		async_results=[]
-		for event_x,event_id in enumerate(event_ids):
+
+	# Reads the events computed by a previous (interrupted) run. In incremental mode, only the events
+	# whose inputs are unchanged since they were computed are reused.
+	completed_dict={}
+	event_keys=None
+	if p_dict['checkpoint_file']:
+		if p_dict['incremental']:
+			event_keys=checkpoint.event_fingerprints(pol_df,cat_df,group_pol_df,p_dict,lookup_dict)
+		completed_dict=checkpoint.read_checkpoint(p_dict,event_keys)
+		if completed_dict:
+			print('Resuming from the checkpoint file ({}): {} of {} events already computed.'.format(p_dict['checkpoint_file'],sum([event_id in completed_dict for event_id in event_ids]),num_events))
+	compute_event_xs=[event_x for event_x,event_id in enumerate(event_ids) if not(event_id in completed_dict)]
+
+	# The lines of outfile1/outfile2 are written by a separate thread, in the order of the events.
+	# The per-measurement results of the events (event_results) are added to pol_df once all events are computed.
+	result_writer=out.start_result_writer(p_dict,event_keys)
+
+	# If an event fails, the lines of the events already computed are still written before the error is raised
+	try:
+		if p_dict['num_cpus']==1: # Run in serial
+			print('Computing mechanisms in serial...')
+			if p_dict['memory_budget_mb']>0: # Grid searches exceeding the memory budget are tiled
+				p_dict=dict(p_dict,max_gridsearch_memory_mb=min(p_dict['max_gridsearch_memory_mb'] or p_dict['memory_budget_mb'],p_dict['memory_budget_mb']))
+			mech_dicts=(compute_mech.compute_mech(event_x,num_events,event_ids[event_x],group_pol_df.get_group(event_ids[event_x]),
+												p_dict,lookup_dict,qual_criteria_dict,cat_df,dir_cos_dict) for event_x in compute_event_xs)
+			event_results=out.queue_results(result_writer,event_ids,mech_dicts,completed_dict)
+		else: # Run in parallel
+			print('Computing mechanisms in parallel...')
+
+			# The lookup tables and direction cosines are memory-mapped by the workers, and the inputs shared by all events
+			# are sent once to each worker, so that only the measurements of the events are sent with each task.
+			# If the direction cosines are cached, workers memory-map the cache folder instead.
+			shared_folder=shared.create_shared_folder()
 			try:
-				event_pol_df=group_pol_df.get_group(event_id)
-			except:
-				print('Error getting parallel result for event_id: {}'.format(event_id))
-				continue
-			async_results.append(pool.apply_async(compute_mech.compute_mech,
-						args=(event_x,num_events,event_id,event_pol_df,p_dict,lookup_dict,qual_criteria_dict,cat_df,dir_cos_dict)))
-		pool.close()
-		pool.join()
-
-		if any([p_dict['outfile_pol_agree'],p_dict['outfile_sp_agree'],p_dict['outfile_pol_info']]):
-			for result in async_results:
-				mech_dict=result.get()
-				if mech_dict['mech_qual']:
-					pol_df.loc[mech_dict['event_index'],'mech_quality']=mech_dict['mech_qual']
-					if p_dict['outfile_pol_agree']:
-						pol_df.loc[mech_dict['event_index'],'pol_agreement']=mech_dict['pol_agreement_out']
-					if p_dict['outfile_sp_agree']:
-						pol_df.loc[mech_dict['event_index'],'sp_diff']=mech_dict['sp_diff_out']
-					if (p_dict['stfile']) and (p_dict['outfile_pol_info']):
-						pol_df.loc[mech_dict['event_index'],'takeoff']=mech_dict['takeoff']
-						pol_df.loc[mech_dict['event_index'],'azimuth']=mech_dict['sr_az']
-						pol_df.loc[mech_dict['event_index'],'takeoff_uncertainty']=mech_dict['takeoff_uncertainty']
-						pol_df.loc[mech_dict['event_index'],'azimuth_uncertainty']=mech_dict['azimuth_uncertainty']
+				shared_lookup_dict=shared.share_dict(lookup_dict,os.path.join(shared_folder,'lookup'))
+				if 'cache_folder' in dir_cos_dict:
+					shared_dir_cos_dict={'cache_folder':dir_cos_dict['cache_folder']}
+				else:
+					shared_dir_cos_dict=shared.share_dict(dir_cos_dict,os.path.join(shared_folder,'dir_cos'))
+
+				# Event numbers of each task sent to the pool. With parallel_schedule='cost', the most expensive events are
+				# computed first, and inexpensive events are grouped into tasks.
+				compute_event_ids=[event_ids[event_x] for event_x in compute_event_xs]
+				num_mech=dir_cos_dict['b1'].shape[1] if 'b1' in dir_cos_dict else None
+				event_costs=scheduler.estimate_event_costs(pol_df,compute_event_ids,p_dict,num_mech)
+				if p_dict['parallel_schedule']=='cost':
+					tasks=scheduler.cost_schedule(compute_event_xs,event_costs,p_dict['num_cpus'])
+				else:
+					tasks=scheduler.ordered_schedule(compute_event_xs)
+
+				# The grid searches of large events are split across threads, which run on cores set aside from the pool workers.
+				# Events whose grid search alone exceeds the memory budget are routed to the tiled grid search.
+				# These events are computed in tasks of their own.
+				event_threads={}
+				num_workers=p_dict['num_cpus']
+				if (p_dict['intra_event_min_picks']>0) & (p_dict['gridsearch_backend']=='python'):
+					num_threads,num_workers=scheduler.intra_event_threads(pol_df,compute_event_ids,event_costs,p_dict)
+					event_threads={event_x:int(event_num_threads) for event_x,event_num_threads in zip(compute_event_xs,num_threads)
+									if event_num_threads!=p_dict['gridsearch_threads']}
+					if event_threads:
+						print('{} large events will be computed with up to {} threads each, alongside {} workers.'.format(len(event_threads),max(event_threads.values()),num_workers))
+				oversized_event_xs=[]
+				if p_dict['memory_budget_mb']>0:
+					event_memory_mb=dict(zip(compute_event_xs,scheduler.estimate_event_memory(pol_df,compute_event_ids,p_dict,num_mech)))
+					oversized_event_xs=[event_x for event_x in compute_event_xs if event_memory_mb[event_x]>p_dict['memory_budget_mb']]
+					if oversized_event_xs:
+						print('{} events are estimated to exceed the memory budget ({} MB). Their grid searches will be tiled.'.format(len(oversized_event_xs),p_dict['memory_budget_mb']))
+				tasks=scheduler.isolate_events(tasks,list(event_threads)+oversized_event_xs)
+				task_params=[{'gridsearch_threads':event_threads[task[0]]} if ((len(task)==1) and (task[0] in event_threads)) else {} for task in tasks]
+
+				# With a memory budget, tasks are held back until their estimated memory fits in the budget
+				task_memory_mb=None
+				if p_dict['memory_budget_mb']>0:
+					task_memory_mb,task_tile_mb=scheduler.memory_schedule(tasks,event_memory_mb,p_dict)
+					for params,tile_mb in zip(task_params,task_tile_mb):
+						if tile_mb is not None:
+							params['max_gridsearch_memory_mb']=tile_mb
+
+				pool=multiprocessing.Pool(processes=num_workers,initializer=compute_mech.init_worker,
+										initargs=(p_dict,shared_lookup_dict,qual_criteria_dict,cat_df,shared_dir_cos_dict))
+				utilization_dict={'start_time':time.time(),'end_time':time.time(),'busy_time':0.}
+				task_args=[(event_xs,num_events,[event_ids[event_x] for event_x in event_xs],[group_pol_df.get_group(event_ids[event_x]) for event_x in event_xs],params)
+							for event_xs,params in zip(tasks,task_params)]
+				get_result=scheduler.submit_tasks(pool,compute_mech.compute_mech_task_worker,task_args,task_memory_mb,p_dict['memory_budget_mb'])
+				# Results are collected in the order of the events, so the output does not depend on num_cpus or the schedule
+				mech_dicts=scheduler.ordered_results(tasks,get_result,compute_event_xs,utilization_dict)
+				event_results=out.queue_results(result_writer,event_ids,mech_dicts,completed_dict)
+				pool.close()
+				pool.join()
+				print(scheduler.utilization_summary(utilization_dict,len(tasks),len(compute_event_xs),p_dict['num_cpus']))
+			finally:
+				shared.remove_shared_folder(shared_folder)
+	except BaseException:
+		out.stop_result_writer(result_writer,raise_error=False)
+		raise
+	out.stop_result_writer(result_writer)
 
 	print('Mech computation runtime: {:.2f} sec'.format(time.time()-mech_runtime_start), flush=True)
 
+	merge_runtime_start=time.time()
+	pol_df=compute_mech.merge_mech_results(pol_df,event_results,p_dict)
+	mech_df=out.mech_dataframe(event_results,cat_df,pol_df)
+	del event_results
+	print('Result merge runtime: {:.2f} sec'.format(time.time()-merge_runtime_start), flush=True)
+	if (p_dict['ray_cache_resolution']>0) & (p_dict['num_cpus']==1):
+		print(ray_cache.ray_cache_summary())
+
 	'''
 	Determines the polarity agreements at the different stations and writes it to file
 	'''
@@ -539,3 +674,18 @@ if __name__ == "__main__":
 		out.pol_info(pol_df,p_dict)
 
 	print('Total runtime: {:.2f} sec'.format(time.time()-total_runtime_start), flush=True)
+
+	return {'mech_df':mech_df,'pol_df':pol_df,'cat_df':cat_df,'p_dict':p_dict}
+
+
+def main(argv=None):
+	'''
+	Command line interface: computes the focal mechanisms using the parameters given on the command line.
+	Input:
+		argv: list of the command line arguments. If None, sys.argv is used.
+	'''
+	run(parse_command_line(argv))
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,30 @@
+'''
+Runs SKHASH as a long-lived local service, keeping the lookup tables, the test mechanisms, and the
+station file warm between requests (see functions/service.py).
+
+Example:
+	python SKHASH_service.py control_file.txt --port 8765
+
+	curl -s -X POST http://127.0.0.1:8765/mechanism --data @request.json
+	curl -s http://127.0.0.1:8765/metrics
+
+where request.json contains the input files of the events, e.g.:
+	{"fpfile": "event_id,station,network,location,channel,p_polarity\\n...", "catfile": "..."}
+'''
+
+# Standard libraries
+import argparse
+
+# Local libraries
+import functions.service as service # Running SKHASH as a service
+
+
+if __name__=="__main__":
+	parser=argparse.ArgumentParser(description='Runs SKHASH as a local service.')
+	parser.add_argument('controlfile',nargs='?',default='',help='Control file with the parameters of the service')
+	parser.add_argument('--host',default='127.0.0.1',help='Address the service listens on')
+	parser.add_argument('--port',type=int,default=8765,help='Port the service listens on')
+	parser.add_argument('--no_warm_up',action='store_true',help='Do not compute the events of the control file at startup')
+	args=parser.parse_args()
+
+	service.serve(args.controlfile,host=args.host,port=args.port,warm_up=not(args.no_warm_up))
@@ -0,0 +1,121 @@
+'''
+Compares the coarse-to-fine grid search (coarse_dang) to the exhaustive grid search.
+
+The takeoff angles, azimuths, and P-polarities are read from a polarity info file
+produced by SKHASH (outfile_pol_info). For each event, the acceptable test mechanisms
+and the preferred mechanism are determined using both the exhaustive grid search and
+the coarse-to-fine grid search, and the following are reported:
+	num_eval: number of test mechanisms evaluated (coarse + fine)
+	runtime: grid search runtime (sec)
+	recall: fraction of the exhaustive acceptable mechanisms also found by the coarse-to-fine search
+	pref_rot: rotation angle (deg) between the preferred mechanisms of the two searches
+
+Example:
+	python benchmark_gridsearch.py ToC2ME_demo/OUT/out_polinfo.csv --dang 2 --coarse_dang 10
+'''
+
+# Standard libraries
+import time
+import argparse
+
+# External libraries
+import numpy as np
+import pandas as pd
+
+# Local libraries
+import functions.fun as fun
+
+
+def run_search(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,nextra,ntotal,p_dict):
+	'''
+	Runs the grid search, returning the acceptable mechanisms and the number of evaluated test mechanisms.
+	'''
+	coor_ind=None
+	num_eval=dir_cos_dict['b1'].shape[1]
+	if 'coarse' in dir_cos_dict:
+		coor_ind=fun.coarse_candidates(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,nextra,ntotal,0,0,max_memory_mb=p_dict['max_gridsearch_memory_mb'])
+		num_eval=dir_cos_dict['coarse']['b1'].shape[1]+len(coor_ind)
+
+	fit,afit=fun.gridsearch_misfit(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,max_memory_mb=p_dict['max_gridsearch_memory_mb'],coor_ind=coor_ind)
+	good_ind=np.where(fun.good_mech_flag(fit,afit,nextra,ntotal,0,0))[0]
+	if coor_ind is not None:
+		good_ind=coor_ind[good_ind]
+
+	return good_ind,num_eval
+
+
+def preferred_mech(good_ind,dir_cos_dict,p_dict):
+	'''
+	Determines the normal and slip vectors of the preferred mechanism from the acceptable mechanisms.
+	'''
+	if len(good_ind)>p_dict['maxout']:
+		good_ind=fun.rng.choice(good_ind,p_dict['maxout'],replace=False)
+	mech_df=fun.mech_probability(dir_cos_dict['b3'][:,good_ind],dir_cos_dict['b1'][:,good_ind],p_dict['cangle'],p_dict['prob_max'])
+	return fun.vector_from_sdr(*np.deg2rad(mech_df.loc[0,['str_avg','dip_avg','rak_avg']].values.astype(float)))
+
+
+if __name__=="__main__":
+	parser=argparse.ArgumentParser(description='Compares the coarse-to-fine grid search to the exhaustive grid search.')
+	parser.add_argument('pol_info_file',help='Polarity info file produced by SKHASH (outfile_pol_info)')
+	parser.add_argument('--dang',type=float,default=5,help='Grid spacing (degrees) of the fine grid')
+	parser.add_argument('--coarse_dang',type=float,default=15,help='Grid spacing (degrees) of the coarse grid')
+	parser.add_argument('--nmc',type=int,default=30,help='Number of trials')
+	parser.add_argument('--uncertainty',type=float,default=5,help='Takeoff and azimuth uncertainty (degrees) used when none is given')
+	parser.add_argument('--max_gridsearch_memory_mb',type=float,default=1000,help='Memory budget (MB) of the grid search. Set to 0 to disable tiling.')
+	parser.add_argument('--max_events',type=int,default=0,help='Maximum number of events to consider. Set to 0 to consider all events.')
+	args=parser.parse_args()
+
+	p_dict={'dang':args.dang,'coarse_dang':args.coarse_dang,'mech_sampling':'grid','ampfile':'','min_amp':0,
+			'max_gridsearch_memory_mb':args.max_gridsearch_memory_mb,
+			'badfrac':0.1,'badmin':2.0,'maxout':500,'cangle':45.0,'prob_max':0.2}
+
+	start_time=time.time()
+	dir_cos_dict=fun.dir_cos_setup(p_dict)
+	print('Fine grid setup ({} mechanisms): {:.2f} sec'.format(dir_cos_dict['b1'].shape[1],time.time()-start_time))
+	start_time=time.time()
+	coarse_dir_cos_dict=fun.coarse_grid_setup(dict(dir_cos_dict),p_dict)
+	print('Coarse grid setup ({} mechanisms): {:.2f} sec'.format(coarse_dir_cos_dict['coarse']['b1'].shape[1],time.time()-start_time))
+
+	pol_df=pd.read_csv(args.pol_info_file)
+	pol_df=pol_df[pol_df['p_polarity'].fillna(0)!=0]
+	for col in ['takeoff_uncertainty','azimuth_uncertainty']:
+		pol_df.loc[pol_df[col].abs()==0,col]=args.uncertainty
+
+	results=[]
+	for event_id,event_pol_df in pol_df.groupby('event_id'):
+		if (args.max_events>0) & (len(results)>=args.max_events):
+			break
+		sr_azimuth,takeoff=fun.perturb_azimuth_takeoff(event_pol_df,args.nmc)
+		p_pol=event_pol_df['p_polarity'].values.astype(float)
+		sp_amp=np.full(len(p_pol),np.nan)
+		sumpolweight=np.sum(np.abs(p_pol))
+		nextra=max([round(sumpolweight*p_dict['badfrac']*0.5),p_dict['badmin']])
+		ntotal=max([round(sumpolweight*p_dict['badfrac']),p_dict['badmin']])
+
+		event_result={'event_id':event_id}
+		for mode,tmp_dir_cos_dict in [('exhaustive',dir_cos_dict),('coarse',coarse_dir_cos_dict)]:
+			start_time=time.time()
+			good_ind,num_eval=run_search(sr_azimuth,takeoff,p_pol,sp_amp,tmp_dir_cos_dict,nextra,ntotal,p_dict)
+			event_result[mode+'_runtime']=time.time()-start_time
+			event_result[mode+'_num_eval']=num_eval
+			event_result[mode+'_good_ind']=good_ind
+
+		exhaustive_ind=event_result.pop('exhaustive_good_ind')
+		coarse_ind=event_result.pop('coarse_good_ind')
+		event_result['num_good']=len(exhaustive_ind)
+		event_result['recall']=np.isin(exhaustive_ind,coarse_ind).mean() if len(exhaustive_ind) else 1.
+		if len(exhaustive_ind) & len(coarse_ind):
+			norm1,slip1=preferred_mech(exhaustive_ind,dir_cos_dict,p_dict)
+			norm2,slip2=preferred_mech(coarse_ind,dir_cos_dict,p_dict)
+			event_result['pref_rot']=fun.mech_rotation(norm1,norm2[:,np.newaxis],slip1,slip2[:,np.newaxis])[0][0]
+		else:
+			event_result['pref_rot']=np.nan
+		results.append(event_result)
+		print('{}: recall={:.4f}, pref_rot={:.1f} deg, evaluated {} of {} mechanisms'.format(event_id,event_result['recall'],event_result['pref_rot'],event_result['coarse_num_eval'],event_result['exhaustive_num_eval']))
+
+	results=pd.DataFrame(results)
+	print('\nEvents: {}'.format(len(results)))
+	print('Mean recall: {:.4f} (min: {:.4f})'.format(results['recall'].mean(),results['recall'].min()))
+	print('Preferred mechanism rotation (deg): median={:.1f}, max={:.1f}'.format(results['pref_rot'].median(),results['pref_rot'].max()))
+	print('Mechanisms evaluated: {:.0f} coarse-to-fine vs {:.0f} exhaustive ({:.1f}%)'.format(results['coarse_num_eval'].mean(),results['exhaustive_num_eval'].mean(),100*results['coarse_num_eval'].mean()/results['exhaustive_num_eval'].mean()))
+	print('Grid search runtime: {:.2f} sec coarse-to-fine vs {:.2f} sec exhaustive'.format(results['coarse_runtime'].sum(),results['exhaustive_runtime'].sum()))
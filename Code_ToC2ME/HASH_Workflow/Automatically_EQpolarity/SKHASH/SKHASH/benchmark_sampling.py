@@ -0,0 +1,105 @@
+'''
+Compares the test mechanism samplings (mech_sampling): the grid used by HASH ('grid') and the
+quasi-uniform sampling of rotation space ('so3').
+
+For each grid spacing (dang), the following are reported for both samplings:
+	num_mech: number of test mechanisms
+	setup: runtime of dir_cos_setup() (sec)
+	nearest (max, p99, mean): rotation angle (deg) from random mechanisms to the most similar test mechanism
+	search: grid search runtime (sec) on synthetic events
+
+Example:
+	python benchmark_sampling.py --dang 10 7 5
+'''
+
+# Standard libraries
+import time
+import argparse
+
+# External libraries
+import numpy as np
+import pandas as pd
+
+# Local libraries
+import functions.fun as fun
+
+
+def random_mechanisms(num_mech,bench_rng):
+	'''
+	Creates uniformly distributed random mechanisms from random unit quaternions.
+	Output:
+		b1,b2,b3: direction cosines of the mechanisms, arrays of shape (3,num_mech)
+	'''
+	quat=bench_rng.normal(size=(4,num_mech))
+	w,x,y,z=quat/np.linalg.norm(quat,axis=0)
+	b1=np.array([1-2*(y*y+z*z),2*(x*y+w*z),2*(x*z-w*y)])
+	b2=np.array([2*(x*y-w*z),1-2*(x*x+z*z),2*(y*z+w*x)])
+	b3=np.array([2*(x*z+w*y),2*(y*z-w*x),1-2*(x*x+y*y)])
+	return b1,b2,b3
+
+
+def nearest_mech_angle(b1,b2,b3,dir_cos_dict,chunk_size=4096):
+	'''
+	Determines the rotation angle (deg) from each mechanism to the most similar test mechanism.
+	'''
+	max_similarity=np.full(b1.shape[1],-np.inf)
+	for chunk_start in range(0,dir_cos_dict['b1'].shape[1],chunk_size):
+		chunk_slice=slice(chunk_start,chunk_start+chunk_size)
+		similarity=fun.mech_frame_similarity(b1,b2,b3,dir_cos_dict['b1'][:,chunk_slice],dir_cos_dict['b2'][:,chunk_slice],dir_cos_dict['b3'][:,chunk_slice])
+		max_similarity=np.maximum(max_similarity,similarity.max(axis=1))
+	return np.rad2deg(np.arccos(np.clip((max_similarity-1)/2,-1,1)))
+
+
+def synthetic_events(num_events,npick,nmc,bench_rng):
+	'''
+	Creates the takeoff angles, azimuths, and P-polarities of synthetic events.
+	'''
+	events=[]
+	for event_x in range(num_events):
+		sr_azimuth=np.mod(bench_rng.uniform(0,360,npick)[:,np.newaxis]+bench_rng.normal(0,5,(npick,nmc)),360)
+		takeoff=np.clip(bench_rng.uniform(20,160,npick)[:,np.newaxis]+bench_rng.normal(0,5,(npick,nmc)),1e-6,180)
+		p_pol=bench_rng.choice([-1.,1.],npick)
+		events.append((sr_azimuth,takeoff,p_pol))
+	return events
+
+
+if __name__=="__main__":
+	parser=argparse.ArgumentParser(description='Compares the grid and so3 test mechanism samplings.')
+	parser.add_argument('--dang',type=float,nargs='+',default=[10,7,5],help='Grid spacings (degrees) to compare')
+	parser.add_argument('--num_random_mech',type=int,default=20000,help='Number of random mechanisms used to measure the distance to the nearest test mechanism')
+	parser.add_argument('--num_events',type=int,default=5,help='Number of synthetic events used to time the grid search')
+	parser.add_argument('--npick',type=int,default=30,help='Number of P-polarities of each synthetic event')
+	parser.add_argument('--nmc',type=int,default=30,help='Number of trials')
+	args=parser.parse_args()
+
+	bench_rng=np.random.default_rng(0)
+	random_b1,random_b2,random_b3=random_mechanisms(args.num_random_mech,bench_rng)
+	events=synthetic_events(args.num_events,args.npick,args.nmc,bench_rng)
+
+	results=[]
+	for dang in args.dang:
+		for mech_sampling in ['grid','so3']:
+			p_dict={'dang':dang,'mech_sampling':mech_sampling,'ampfile':'','min_amp':0}
+			start_time=time.time()
+			dir_cos_dict=fun.dir_cos_setup(p_dict)
+			setup_runtime=time.time()-start_time
+
+			nearest_angle=nearest_mech_angle(random_b1,random_b2,random_b3,dir_cos_dict)
+
+			start_time=time.time()
+			for sr_azimuth,takeoff,p_pol in events:
+				fun.gridsearch_misfit(sr_azimuth,takeoff,p_pol,np.full(len(p_pol),np.nan),dir_cos_dict,max_memory_mb=1000)
+			search_runtime=time.time()-start_time
+
+			results.append({'dang':dang,'mech_sampling':mech_sampling,'num_mech':dir_cos_dict['b1'].shape[1],'setup':setup_runtime,
+							'nearest_max':nearest_angle.max(),'nearest_p99':np.percentile(nearest_angle,99),'nearest_mean':nearest_angle.mean(),
+							'search':search_runtime})
+			print('dang={}, {}: {} mechanisms, nearest mechanism (deg): max={:.2f}, p99={:.2f}, mean={:.2f}, grid search: {:.2f} sec'.format(
+					dang,mech_sampling,results[-1]['num_mech'],results[-1]['nearest_max'],results[-1]['nearest_p99'],results[-1]['nearest_mean'],search_runtime),flush=True)
+
+	results=pd.DataFrame(results).set_index(['dang','mech_sampling'])
+	print('\n'+results.round(3).to_string())
+	for dang in args.dang:
+		print('dang={}: so3 uses {:.1f}% fewer test mechanisms, grid search {:.1f}% faster'.format(dang,
+				100*(1-results.loc[(dang,'so3'),'num_mech']/results.loc[(dang,'grid'),'num_mech']),
+				100*(1-results.loc[(dang,'so3'),'search']/results.loc[(dang,'grid'),'search'])))
@@ -0,0 +1,147 @@
+'''
+Functions for caching arrays on disk.
+'''
+
+# Standard libraries
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+# External libraries
+import numpy as np
+
+
+def cache_key(params):
+	'''
+	Creates a key that uniquely identifies the parameters used to create cached arrays.
+	Input:
+		params: dictionary of parameters. Values must be JSON serializable.
+	Output:
+		key: hexadecimal sha256 hash of the parameters, string
+	'''
+	return hashlib.sha256(json.dumps(params,sort_keys=True).encode()).hexdigest()
+
+
+def save_arrays(folder,arrays):
+	'''
+	Saves arrays to a folder as .npy files so they can later be memory-mapped.
+	The arrays are first written to a temporary folder, which is then renamed, so that
+	other processes never see a partially written cache. If the folder already exists
+	(e.g., another process created it first), the existing folder is kept.
+	Input:
+		folder: path of the folder to create
+		arrays: dictionary of arrays. The keys are used as the filenames.
+	'''
+	parent_folder=os.path.dirname(os.path.abspath(folder))
+	os.makedirs(parent_folder,exist_ok=True)
+	tmp_folder=tempfile.mkdtemp(dir=parent_folder,prefix='.tmp_')
+	try:
+		for key,value in arrays.items():
+			np.save(os.path.join(tmp_folder,key+'.npy'),np.asarray(value))
+		try:
+			os.rename(tmp_folder,folder)
+		except OSError:
+			if not(os.path.isdir(folder)):
+				raise
+	finally:
+		if os.path.isdir(tmp_folder):
+			shutil.rmtree(tmp_folder)
+
+
+def load_arrays(folder,mmap_mode='r'):
+	'''
+	Loads the arrays saved by save_arrays().
+	Input:
+		folder: path of the folder containing the .npy files
+		mmap_mode: memory-map mode passed to np.load. Set to None to read the arrays into memory.
+	Output:
+		arrays: dictionary of arrays
+	'''
+	arrays={}
+	for filename in sorted(os.listdir(folder)):
+		if filename.endswith('.npy'):
+			arrays[filename[:-4]]=np.load(os.path.join(folder,filename),mmap_mode=mmap_mode)
+	return arrays
+
+
+def save_array(path,array):
+	'''
+	Saves an array to a .npy file. The array is first written to a temporary file in the same folder,
+	which then replaces the file, so that other processes never see a partially written file.
+	Input:
+		path: path of the .npy file
+		array: array to save
+	'''
+	folder=os.path.dirname(os.path.abspath(path))
+	os.makedirs(folder,exist_ok=True)
+	fd,tmp_path=tempfile.mkstemp(dir=folder,prefix='.tmp_',suffix='.npy')
+	try:
+		with os.fdopen(fd,'wb') as f:
+			np.save(f,np.asarray(array))
+		os.chmod(tmp_path,0o644) # mkstemp creates files only readable by the owner
+		os.replace(tmp_path,path)
+	finally:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+
+
+def load_array(path,mmap_mode=None):
+	'''
+	Loads an array saved by save_array(). The modification time of the file is updated,
+	so that evict_lru() keeps the most recently used files.
+	Input:
+		path: path of the .npy file
+		mmap_mode: memory-map mode passed to np.load
+	Output:
+		array: the array. None if the file does not exist or cannot be read.
+	'''
+	try:
+		array=np.load(path,mmap_mode=mmap_mode)
+	except (OSError,ValueError):
+		return None
+	try:
+		os.utime(path)
+	except OSError:
+		pass
+	return array
+
+
+def evict_lru(folder,max_mb,prefix='',keep_paths=()):
+	'''
+	Removes the least recently used .npy files of a folder until the files use at most max_mb.
+	Files removed by other processes in the meantime are ignored.
+	Input:
+		folder: cache folder
+		max_mb: maximum total size (MB) of the files
+		prefix: only files whose name starts with this prefix are considered
+		keep_paths: files that are never removed (e.g., those in use), though their size counts toward max_mb
+	Output:
+		removed_paths: list of the removed files
+	'''
+	keep_paths=set([os.path.abspath(path) for path in keep_paths])
+	file_info=[]
+	total_bytes=0
+	for filename in os.listdir(folder):
+		if filename.startswith(prefix) and filename.endswith('.npy') and not(filename.startswith('.tmp_')):
+			path=os.path.join(folder,filename)
+			try:
+				file_stat=os.stat(path)
+			except FileNotFoundError:
+				continue
+			if os.path.abspath(path) in keep_paths:
+				total_bytes+=file_stat.st_size
+			else:
+				file_info.append((file_stat.st_mtime,file_stat.st_size,path))
+
+	removed_paths=[]
+	for mtime,size,path in sorted(file_info,reverse=True):
+		total_bytes+=size
+		if total_bytes>max_mb*1e6:
+			try:
+				os.remove(path)
+				removed_paths.append(path)
+			except FileNotFoundError:
+				pass
+	return removed_paths
@@ -0,0 +1,210 @@
+'''
+Functions for checkpointing the computed events, so an interrupted run can be resumed.
+
+The checkpoint file is a journal with one JSON line per computed event, containing its
+outfile1/outfile2 lines and the per-measurement results added to pol_df. The first line
+records the parameters of the run. The lines are written by the result writer thread
+(out.start_result_writer), which syncs the file to disk each time it writes.
+
+In incremental mode, each event is also recorded with a fingerprint of its inputs
+(event_fingerprints), so that a later run reuses the results of the unchanged events.
+'''
+
+# Standard libraries
+import os
+import json
+import hashlib
+import tempfile
+
+# External libraries
+import numpy as np
+import pandas as pd
+
+# Parameters that do not change the results, so they can differ when resuming a run
+runtime_params=['num_cpus','parallel_schedule','memory_budget_mb','gridsearch_threads','intra_event_min_picks','output_flush_interval','overwrite_output_file','checkpoint_file']
+
+# Output path parameters. Only whether each output is created is part of the parameters of a run, so the outputs can be renamed when resuming a run.
+output_params=['outfile1','outfile2','outfile_pol_agree','outfile_sp_agree','outfile_pol_info','outfolder_plots']
+
+# Input file parameters. In incremental mode, the contents of the inputs are fingerprinted instead of their paths.
+input_params=['controlfile','catfile','stfile','plfile','corfile','fpfile','impfile','conpfile','dlpfile','ampfile','relampfile','simulpsfile']
+
+
+def checkpoint_fingerprint(p_dict):
+	'''
+	Creates a key that identifies the parameters of a run.
+	Input:
+		p_dict: Parameter values created in SKHASH.py, dictionary
+	Output:
+		fingerprint: hexadecimal sha256 hash of the parameters, string
+	'''
+	params={key:value for key,value in p_dict.items() if not(key in runtime_params)}
+	for key in output_params:
+		params[key]=bool(params.get(key))
+	return hashlib.sha256(json.dumps(params,sort_keys=True,default=str).encode()).hexdigest()
+
+
+def event_fingerprints(pol_df,cat_df,group_pol_df,p_dict,lookup_dict):
+	'''
+	Fingerprints the inputs of each event after quality control: its measurements (e.g., polarities, weights,
+	station locations), its catalog entry, the parameters, and the lookup tables.
+	Input:
+		pol_df: polarity dataframe
+		cat_df: catalog dataframe
+		group_pol_df: pol_df grouped by event_id
+		p_dict: Parameter values created in SKHASH.py, dictionary
+		lookup_dict: dictionary with lookup variables, produced by create_lookup_table()
+	Output:
+		event_keys: dictionary keyed by event id, with the fingerprint of the event (fingerprint) and the
+			index of its measurements in pol_df (rows)
+	'''
+	params={key:value for key,value in p_dict.items() if not(key in runtime_params+input_params)}
+	for key in output_params:
+		params[key]=bool(params.get(key))
+	run_hash=hashlib.sha256(json.dumps(params,sort_keys=True,default=str).encode())
+	run_hash.update(json.dumps([str(col) for col in pol_df.columns]).encode())
+	for key in ['deptab','delttab','table']:
+		run_hash.update(np.ascontiguousarray(lookup_dict[key]).tobytes())
+
+	row_hashes=pd.util.hash_pandas_object(pol_df,index=False).values
+	cat_hashes={}
+	if len(cat_df):
+		cat_hashes=dict(zip(cat_df['event_id'],pd.util.hash_pandas_object(cat_df,index=False).values))
+
+	event_keys={}
+	for event_id,event_rows in group_pol_df.indices.items():
+		event_hash=run_hash.copy()
+		event_hash.update(str(event_id).encode())
+		event_hash.update(row_hashes[event_rows].tobytes())
+		event_hash.update(np.uint64(cat_hashes.get(event_id,0)).tobytes())
+		event_keys[event_id]={'fingerprint':event_hash.hexdigest(),'rows':pol_df.index.values[event_rows]}
+	return event_keys
+
+
+def json_default(value):
+	'''
+	Converts the numpy values of the mechanism dictionaries for json.dumps().
+	'''
+	if isinstance(value,np.ndarray):
+		return value.tolist()
+	if isinstance(value,np.generic):
+		return value.item()
+	raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+
+def format_record(mech_dict,outfile1_lines,outfile2_lines,event_key=None):
+	'''
+	Creates the checkpoint line of a computed event.
+	Input:
+		mech_dict: dictionary of mechanism solutions, produced by compute_mech.finish_event()
+		outfile1_lines: lines of the event in outfile1, string
+		outfile2_lines: lines of the event in outfile2, string
+		event_key: in incremental mode, the fingerprint and rows of the event produced by event_fingerprints().
+			The index of the measurements is then recorded relative to the rows of the event, as the
+			measurements of the event can be at other rows of pol_df in a later run.
+	Output:
+		record: JSON line, string
+	'''
+	mech_dict={key:value for key,value in mech_dict.items() if not(key in ['outfile1_lines','outfile2_lines'])}
+	if (event_key is not None) and mech_dict['mech_qual']:
+		mech_dict['event_index']=np.searchsorted(event_key['rows'],mech_dict['event_index'])
+	record={'mech_dict':mech_dict,'outfile1_lines':outfile1_lines,'outfile2_lines':outfile2_lines}
+	if event_key is not None:
+		record['fingerprint']=event_key['fingerprint']
+	return json.dumps(record,default=json_default)+'\n'
+
+
+def read_checkpoint(p_dict,event_keys=None):
+	'''
+	Reads the events computed by a previous run from the checkpoint file (p_dict['checkpoint_file']).
+	If the file does not exist, it is created. A partially written last line (e.g., if the run was killed
+	while writing it) is removed.
+	In incremental mode, only the events whose fingerprint is unchanged are read, and the checkpoint
+	file is rewritten with only these events, so that the changed events are recorded again once computed.
+	Input:
+		p_dict: Parameter values created in SKHASH.py, dictionary
+		event_keys: in incremental mode, the fingerprints and rows of the events produced by event_fingerprints()
+	Output:
+		completed_dict: dictionary of the computed events, keyed by event id. The values are the mechanism
+			dictionaries of the events, with their outfile1/outfile2 lines.
+	'''
+	checkpoint_file=p_dict['checkpoint_file']
+	fingerprint=checkpoint_fingerprint(p_dict)
+
+	if not(os.path.exists(checkpoint_file)) or (os.path.getsize(checkpoint_file)==0):
+		folder_path=os.path.dirname(checkpoint_file)
+		if folder_path:
+			os.makedirs(folder_path,exist_ok=True)
+		with open(checkpoint_file,'w') as f:
+			f.write(json.dumps({'fingerprint':fingerprint})+'\n')
+			f.flush()
+			os.fsync(f.fileno())
+		return {}
+
+	completed_dict={}
+	with open(checkpoint_file,'rb') as f:
+		lines=f.readlines()
+	try:
+		header=json.loads(lines[0])
+	except ValueError:
+		raise ValueError('***Error: Could not read the checkpoint file ({}).'.format(checkpoint_file))
+	if (event_keys is None) and (header.get('fingerprint')!=fingerprint):
+		raise ValueError('***Error: The checkpoint file ({}) was created by a run with different parameters. Either restore the parameters, or remove this file to start over.'.format(checkpoint_file))
+
+	valid_bytes=len(lines[0])
+	reused_lines={}
+	for line in lines[1:]:
+		try:
+			record=json.loads(line)
+		except ValueError:
+			break
+		if not(line.endswith(b'\n')):
+			break
+		valid_bytes+=len(line)
+		mech_dict=record['mech_dict']
+		event_id=mech_dict['event_id']
+		if event_keys is not None:
+			if not(event_id in event_keys) or (record.get('fingerprint')!=event_keys[event_id]['fingerprint']):
+				completed_dict.pop(event_id,None)
+				reused_lines.pop(event_id,None)
+				continue
+			reused_lines[event_id]=line
+		for key in ['event_index','pol_agreement_out','sp_diff_out','takeoff','sr_az','takeoff_uncertainty','azimuth_uncertainty']:
+			mech_dict[key]=np.asarray(mech_dict[key])
+		if (event_keys is not None) and mech_dict['mech_qual']:
+			mech_dict['event_index']=event_keys[event_id]['rows'][mech_dict['event_index']]
+		mech_dict['outfile1_lines']=record['outfile1_lines']
+		mech_dict['outfile2_lines']=record['outfile2_lines']
+		completed_dict[event_id]=mech_dict
+
+	if event_keys is not None:
+		rewrite_checkpoint(checkpoint_file,json.dumps({'fingerprint':fingerprint})+'\n',list(reused_lines.values()))
+	elif valid_bytes<os.path.getsize(checkpoint_file):
+		print('*WARNING: Removing the partially written last line of the checkpoint file ({}).'.format(checkpoint_file))
+		with open(checkpoint_file,'r+b') as f:
+			f.truncate(valid_bytes)
+			os.fsync(f.fileno())
+	return completed_dict
+
+
+def rewrite_checkpoint(checkpoint_file,header,lines):
+	'''
+	Replaces the checkpoint file with the given lines. The lines are first written to a temporary
+	file in the same folder, which then replaces the checkpoint file, so that the events are never lost.
+	Input:
+		checkpoint_file: path of the checkpoint file
+		header: first line of the file, string
+		lines: lines of the events, list of bytes
+	'''
+	fd,tmp_path=tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(checkpoint_file)),prefix='.tmp_')
+	try:
+		with os.fdopen(fd,'wb') as f:
+			f.write(header.encode())
+			f.writelines(lines)
+			f.flush()
+			os.fsync(f.fileno())
+		os.chmod(tmp_path,0o644) # mkstemp creates files only readable by the owner
+		os.replace(tmp_path,checkpoint_file)
+	finally:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
@@ -5,9 +5,60 @@ import time
 # External libraries
 import numpy as np
 
-import functions.gridsearch_so as gridsearch_so # For creating fortran gridsearch module
+import functions.gridsearch_backends as gridsearch_backends # Grid search backends
 import functions.out as out # Output functions
 import functions.fun as fun # Computing mechanisms
+import functions.shared as shared # Sharing inputs with parallel workers
+
+worker_inputs={} # Inputs shared by all events, set in each worker of a pool by init_worker()
+
+
+def empty_mech_dict(event_id):
+    '''
+    Creates the mechanism dictionary returned for events without a solution.
+    '''
+    return {'event_id':event_id,'event_index':-1,'pol_agreement_out':[],
+            'sp_diff_out':[],'takeoff':-1.,'sr_az':-1.,
+            'takeoff_uncertainty':-1.,'azimuth_uncertainty':-1.,
+            'mech_qual':'','outfile1_lines':'','outfile2_lines':''}
+
+
+def init_worker(p_dict,shared_lookup_dict,qual_criteria_dict,cat_df,shared_dir_cos_dict):
+    '''
+    Initializes a worker of the pool used to compute mechanisms in parallel. The inputs shared by
+    all events are received once per worker, and their arrays are memory-mapped.
+    Input:
+        p_dict: Parameter values created in SKHASH.py, dictionary
+        shared_lookup_dict: lookup variables, produced by shared.share_dict()
+        qual_criteria_dict: dictionary of quality criteria, created in SKHASH.py
+        cat_df: catalog dataframe
+        shared_dir_cos_dict: coordinate transformation variables, produced by shared.share_dict()
+    '''
+    worker_inputs['p_dict']=p_dict
+    worker_inputs['lookup_dict']=shared.attach_dict(shared_lookup_dict)
+    worker_inputs['qual_criteria_dict']=qual_criteria_dict
+    worker_inputs['cat_df']=cat_df
+    worker_inputs['dir_cos_dict']=shared.attach_dict(shared_dir_cos_dict)
+
+
+def compute_mech_task_worker(event_xs,num_events,event_ids,event_pol_dfs,task_params=None):
+    '''
+    Computes the focal mechanisms of the events of a task, using the inputs set by init_worker().
+    The events are computed one at a time with compute_mech().
+    If task_params is given, its values replace the parameters of p_dict for the events of this task (e.g.,
+    max_gridsearch_memory_mb for events exceeding the memory budget, or gridsearch_threads for large events).
+    Output:
+        task_result: dictionary with the mechanism dictionaries of the events (mech_dicts) and the
+            CPU time of the task, summed over its threads (busy_time)
+    '''
+    task_cpu_start=time.process_time()
+    p_dict=worker_inputs['p_dict']
+    if task_params:
+        p_dict=dict(p_dict,**task_params)
+    mech_dicts=[compute_mech(event_x,num_events,event_id,event_pol_df,p_dict,worker_inputs['lookup_dict'],
+                             worker_inputs['qual_criteria_dict'],worker_inputs['cat_df'],worker_inputs['dir_cos_dict'])
+                for event_x,event_id,event_pol_df in zip(event_xs,event_ids,event_pol_dfs)]
+    return {'mech_dicts':mech_dicts,'busy_time':time.process_time()-task_cpu_start}
 
 
 def compute_mech(event_x,num_events,event_id,event_pol_df,p_dict,lookup_dict,qual_criteria_dict,cat_df,dir_cos_dict):
@@ -28,14 +79,45 @@ def compute_mech(event_x,num_events,event_id,event_pol_df,p_dict,lookup_dict,qua
     '''
     event_runtime_start = time.time()
 
-    mech_dict={'event_index':-1,'pol_agreement_out':[],
-            'sp_diff_out':[],'takeoff':-1.,'sr_az':-1.,
-            'takeoff_uncertainty':-1.,'azimuth_uncertainty':-1.,
-            'mech_qual':''}
+    if ('cache_folder' in dir_cos_dict) and not('b1' in dir_cos_dict): # Loads the cached direction cosines in the worker
+        dir_cos_dict=fun.load_dir_cos(dir_cos_dict['cache_folder'])
+
+    # With per_event_seed, the event uses its own random number generator. The global one is restored
+    # afterwards, so that the later runs of a long-lived process (e.g., the service) are not affected.
+    global_rng=fun.rng
+    if p_dict['per_event_seed']:
+        fun.rng=fun.create_event_rng(event_id)
+    try:
+        event_dict=prepare_event(event_x,num_events,event_id,event_pol_df,p_dict,lookup_dict)
+        if event_dict is None:
+            return empty_mech_dict(event_id)
+
+        # Runs the gridsearch to find potential mech solutions using the selected backend (python, fortran, or numba).
+        faultnorms_all,faultslips_all=gridsearch_backends.focal_gridsearch(event_dict['sr_azimuth'],event_dict['takeoff'],event_dict['p_pol'],event_dict['sp_amp'],dir_cos_dict,
+                                                                            event_dict['nextra'],event_dict['ntotal'],event_dict['qextra'],event_dict['qtotal'],p_dict)
 
+        return finish_event(event_x,num_events,event_id,event_dict,faultnorms_all,faultslips_all,p_dict,qual_criteria_dict,cat_df,event_runtime_start)
+    finally:
+        fun.rng=global_rng
+
+
+def prepare_event(event_x,num_events,event_id,event_pol_df,p_dict,lookup_dict):
+    '''
+    Determines the (perturbed) azimuths and takeoff angles and the misfit criteria of an event.
+    Input:
+        event_x: The event number (cosmetic)
+        num_events: Total number of events to compute mechanisms (cosmetic)
+        event_id: event id string for the event
+        event_pol_df: polarity dataframe
+        p_dict: Parameter values created in SKHASH.py, dictionary
+        lookup_dict: dictionary with lookup variables, produced by create_lookup_table()
+    Output:
+        event_dict: dictionary with the grid search inputs of the event. None if the event is skipped.
+    '''
     if p_dict['stfile']: # Perturb earthquake locations and determine azimuth and takeoff angles
         perturbed_origin_depth_km,sr_dist_km,sr_azimuth=fun.perturb_eq_locations(event_pol_df,p_dict['look_dep'],p_dict['perturb_epicentral_location'],nmc=p_dict['nmc'])
-        takeoff=fun.lookup_takeoff(lookup_dict['table'],perturbed_origin_depth_km,sr_dist_km,p_dict['look_dep'],p_dict['look_del'],lookup_dict['deptab'],lookup_dict['delttab'],num_velocity_models=len(p_dict['vmodel_paths']))
+        takeoff=fun.lookup_takeoff(lookup_dict['table'],perturbed_origin_depth_km,sr_dist_km,p_dict['look_dep'],p_dict['look_del'],lookup_dict['deptab'],lookup_dict['delttab'],
+                                   num_velocity_models=len(p_dict['vmodel_paths']),uniform_grid=(p_dict['lookup_grid']=='uniform'))
 
         # Discards any measurements with a takeoff uncertainty > pmax
         if p_dict['pmax']>0:
@@ -55,11 +137,11 @@ def compute_mech(event_x,num_events,event_id,event_pol_df,p_dict,lookup_dict,qua
     if max_azimuthal_gap>p_dict['max_agap']:
         print('{} / {}\t({})\n'.format(event_x,num_events-1,event_id)+
               '\tMaximum azimuthal gap ({}) > max_agap ({}). Skipping.'.format(max_azimuthal_gap.round(3),p_dict['max_agap']))
-        return mech_dict
+        return None
     if max_takeoff_gap>p_dict['max_pgap']:
         print('{} / {}\t({})\n'.format(event_x,num_events-1,event_id)+
               '\tMaximum takeoff angle gap ({}) > max_pgap ({}). Skipping.'.format(max_takeoff_gap.round(3),p_dict['max_pgap']))
-        return mech_dict
+        return None
 
     # P-polarity parameters for determining best-fit solutions
     p_pol=event_pol_df['p_polarity'].values
@@ -83,22 +165,38 @@ def compute_mech(event_x,num_events,event_id,event_pol_df,p_dict,lookup_dict,qua
         qextra=0
         qtotal=0
 
-    # Runs the gridsearch to find potential mech solutions.
-    if p_dict['use_fortran']: # Uses the Python C/API to call Fortran subroutine
-        import functions.gridsearch as gridsearch
-        p_azi_mc,p_the_mc,f_sp_amp,f_p_pol,p_qual=gridsearch_so.prep_subroutine(sr_azimuth,takeoff,p_pol,sp_amp,p_dict['npick0'],p_dict['nmc'])
-        nf,strike_all,dip_all,rake_all,faultnorms_all,faultslips_all=gridsearch.focalamp_mc_wt(p_azi_mc,p_the_mc,f_sp_amp,f_p_pol,p_qual,p_dict['nmc'],p_dict['dang'],p_dict['maxout'],nextra,ntotal,qextra,qtotal,p_dict['min_amp'],len(f_p_pol))
-        faultnorms_all=faultnorms_all[:,:nf]
-        faultslips_all=faultslips_all[:,:nf]
-        strike_all=strike_all[:nf]
-        dip_all=dip_all[:nf]
-        rake_all=rake_all[:nf]
-    else: # Python version
-        faultnorms_all,faultslips_all=fun.focal_gridsearch(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,nextra,ntotal,qextra,qtotal,p_dict['maxout'],dir_cos_dict['ncoor'])
-
-        # Calculates strike,dip,rake from normal,slip vectors for output
-        if ((len(p_dict['outfile2'])>0) | (p_dict['plot_acceptable_solutions'])):
-            strike_all,dip_all,rake_all=fun.sdr_from_vector(faultnorms_all,faultslips_all)
+    return {'event_pol_df':event_pol_df,'sr_azimuth':sr_azimuth,'takeoff':takeoff,'p_pol':p_pol,'sp_amp':sp_amp,
+            'nextra':nextra,'ntotal':ntotal,'qextra':qextra,'qtotal':qtotal}
+
+
+def finish_event(event_x,num_events,event_id,event_dict,faultnorms_all,faultslips_all,p_dict,qual_criteria_dict,cat_df,event_runtime_start):
+    '''
+    Determines the preferred mechanism of an event from its acceptable mechanisms, and formats the lines
+    of outfile1 and outfile2. The lines are returned in mech_dict, and written by the result writer (out.start_result_writer).
+    Input:
+        event_x: The event number (cosmetic)
+        num_events: Total number of events to compute mechanisms (cosmetic)
+        event_id: event id string for the event
+        event_dict: dictionary with the grid search inputs of the event, produced by prepare_event()
+        faultnorms_all: fault normal vectors of the acceptable mechanisms
+        faultslips_all: fault slip vectors of the acceptable mechanisms
+        p_dict: Parameter values created in SKHASH.py, dictionary
+        qual_criteria_dict: dictionary of quality criteria, created in SKHASH.py
+        cat_df: catalog dataframe
+        event_runtime_start: time the computation of the event started (cosmetic)
+    Output:
+        mech_dict: dictionary of mechanism solutions
+    '''
+    mech_dict=empty_mech_dict(event_id)
+    event_pol_df=event_dict['event_pol_df']
+    sr_azimuth=event_dict['sr_azimuth']
+    takeoff=event_dict['takeoff']
+    p_pol=event_dict['p_pol']
+    sp_amp=event_dict['sp_amp']
+
+    # Calculates strike,dip,rake from normal,slip vectors for output
+    if ((len(p_dict['outfile2'])>0) | (p_dict['plot_acceptable_solutions'])):
+        strike_all,dip_all,rake_all=fun.sdr_from_vector(faultnorms_all,faultslips_all)
 
     if (faultnorms_all).shape[1]==0:
         print('{} / {}\t({})\n'.format(event_x,num_events-1,event_id)+
@@ -141,17 +239,16 @@ def compute_mech(event_x,num_events,event_id,event_pol_df,p_dict,lookup_dict,qua
     mech_df[angle_col]=mech_df[angle_col].round(p_dict['output_angle_precision'])
     mech_df[quality_col]=(mech_df[quality_col]*100).round(p_dict['output_quality_precision'])
 
-    # Writes preferred mechanisms to file
-    if p_dict['outfile1']:
-        if len(cat_df):
-            event_df=cat_df.loc[cat_df.event_id==event_id].iloc[0]
-        else:
-            event_df=[]
-        out.write_outfile1(p_dict['outfile1'],mech_df,event_df,event_id)
+    # Formats the preferred mechanisms for outfile1. The lines are also used to create the dataframe returned by SKHASH.run().
+    if len(cat_df):
+        event_df=cat_df.loc[cat_df.event_id==event_id].iloc[0]
+    else:
+        event_df=[]
+    mech_dict['outfile1_lines']=out.format_outfile1(mech_df,event_df,event_id)
 
-    # Writes acceptable mechanisms to file
+    # Formats the acceptable mechanisms for outfile2
     if p_dict['outfile2']:
-        out.write_outfile2(p_dict['outfile2'],event_id,strike_all,dip_all,rake_all,faultnorms_all,faultslips_all,p_dict['output_angle_precision'],p_dict['output_vector_precision'])
+        mech_dict['outfile2_lines']=out.format_outfile2(event_id,strike_all,dip_all,rake_all,faultnorms_all,faultslips_all,p_dict['output_angle_precision'],p_dict['output_vector_precision'])
 
     if (p_dict['stfile']) and (p_dict['outfile_pol_info']):
         out_takeoff=np.round(p_the_mc,p_dict['output_angle_precision'])
@@ -194,7 +291,42 @@ def compute_mech(event_x,num_events,event_id,event_pol_df,p_dict,lookup_dict,qua
                     (time.time()-event_runtime_start) ),flush=True)
 
     # return event_pol_df
-    return {'event_index':event_pol_df.index,'pol_agreement_out':pol_agreement_out,
+    return {'event_id':event_id,'event_index':event_pol_df.index.values,'pol_agreement_out':pol_agreement_out,
             'sp_diff_out':sp_diff_out,'takeoff':out_takeoff,'sr_az':out_sr_az,
             'takeoff_uncertainty':takeoff_uncertainty_out,'azimuth_uncertainty':azimuth_uncertainty_out,
-            'mech_qual':mech_df.loc[0,'qual']}
+            'mech_qual':mech_df.loc[0,'qual'],
+            'outfile1_lines':mech_dict['outfile1_lines'],'outfile2_lines':mech_dict['outfile2_lines']}
+
+
+def merge_mech_results(pol_df,mech_dicts,p_dict):
+    '''
+    Adds the per-measurement results of the events (mech quality, polarity agreement, S/P difference,
+    takeoff and azimuth) to pol_df. The results of all events are concatenated and each column is
+    assigned once, rather than once per event.
+    Input:
+        pol_df: polarity dataframe
+        mech_dicts: list of the mechanism dictionaries returned by compute_mech()
+        p_dict: Parameter values created in SKHASH.py, dictionary
+    Output:
+        pol_df: polarity dataframe with the results
+    '''
+    mech_dicts=[mech_dict for mech_dict in mech_dicts if mech_dict['mech_qual']]
+    if len(mech_dicts)==0:
+        return pol_df
+    event_sizes=[len(mech_dict['event_index']) for mech_dict in mech_dicts]
+    event_index=np.concatenate([mech_dict['event_index'] for mech_dict in mech_dicts])
+
+    # Columns of pol_df and the corresponding keys of the mechanism dictionaries
+    columns=[['mech_quality','mech_qual']]
+    if p_dict['outfile_pol_agree']:
+        columns.append(['pol_agreement','pol_agreement_out'])
+    if p_dict['outfile_sp_agree']:
+        columns.append(['sp_diff','sp_diff_out'])
+    if (p_dict['stfile']) and (p_dict['outfile_pol_info']):
+        columns+=[['takeoff','takeoff'],['azimuth','sr_az'],
+                  ['takeoff_uncertainty','takeoff_uncertainty'],['azimuth_uncertainty','azimuth_uncertainty']]
+
+    for col,key in columns:
+        values=np.concatenate([np.broadcast_to(mech_dict[key],event_size) for mech_dict,event_size in zip(mech_dicts,event_sizes)])
+        pol_df.loc[event_index,col]=values
+    return pol_df
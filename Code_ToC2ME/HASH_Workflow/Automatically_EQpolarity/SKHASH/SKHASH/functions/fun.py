@@ -9,14 +9,40 @@ this code.
 
 # Standard libraries
 import os
+import hashlib
+import multiprocessing
+import concurrent.futures
 
 # External libraries
 import numpy as np
 import pandas as pd
-rng=np.random.default_rng(123) # Used to produce reproducable bootstrapped results.
+rng_seed=123
+rng=np.random.default_rng(rng_seed) # Used to produce reproducable bootstrapped results.
 
+# Local libraries
+import functions.cache as cache # Caching arrays on disk
 
-def lookup_takeoff(table,perturbed_origin_depth_km,sr_dist_km,look_dep,look_del,deptab,delttab,num_velocity_models=1):
+dir_cos_memo={} # Memory-mapped dir_cos_dicts loaded by load_dir_cos(), keyed by the cache folder
+thread_pools={} # Thread pools used by gridsearch_misfit(), keyed by the number of threads
+if hasattr(os,'register_at_fork'): # The threads of a pool are not copied to forked processes (e.g., the workers of a multiprocessing pool)
+	os.register_at_fork(after_in_child=thread_pools.clear)
+
+
+def create_event_rng(event_id):
+	'''
+	Creates the random number generator of an event, seeded by its event id. Used (per_event_seed=True) so that
+	the results of an event do not depend on which other events were computed before it, e.g., when
+	resuming from a checkpoint or when computing events in parallel.
+	Input:
+		event_id: event id string
+	Output:
+		event_rng: numpy random Generator
+	'''
+	event_hash=hashlib.sha256(str(event_id).encode()).digest()
+	return np.random.default_rng([rng_seed,int.from_bytes(event_hash[:8],'little')])
+
+
+def lookup_takeoff(table,perturbed_origin_depth_km,sr_dist_km,look_dep,look_del,deptab,delttab,num_velocity_models=1,uniform_grid=True):
 	'''
 	Given a hypocentral depths and source-receiver distances, queries the takeoff angles
 	using the lookup table
@@ -29,14 +55,85 @@ def lookup_takeoff(table,perturbed_origin_depth_km,sr_dist_km,look_dep,look_del,
 		deptab: array of depths (km) produced by create_lookup_table()
 		delttab: array of distances (km) produced by create_lookup_table()
 		num_velocity_models: the number of velocity models used.
+		uniform_grid: if True, deptab and delttab are on the intervals of look_dep and look_del. If False (e.g., for the knots
+			produced by adaptive_lookup_grid()), the cells are found by bisection.
 	Output:
 		takeoff: the corresponding takeoff angles
 	'''
 	# Determines the lookup table cell for permiated earthquake depths
-	id1=((perturbed_origin_depth_km-look_dep[0])/look_dep[2]).astype(int)
-	id2=id1+1
+	id1,dfrac=lookup_cells(perturbed_origin_depth_km,look_dep,deptab,uniform_grid)
+
+	# Determines the lookup table cell for permiated earthquake epicenters
+	sr_dist_km=clip_distances(sr_dist_km,delttab)
+	ix1,xfrac=lookup_cells(sr_dist_km,look_del,delttab,uniform_grid)
+
+	# Determines which velocity model to use for each trial
+	randomized_vm_ind=random_velocity_models(num_velocity_models,perturbed_origin_depth_km.shape[-1])
+
+	# Uses the lookup table to determine the travel times / takeoff angles
+	return interpolate_takeoff(table,id1,dfrac,ix1,xfrac,randomized_vm_ind)
+
+
+def lookup_takeoff_batch(table,depth_list,dist_list,look_dep,look_del,deptab,delttab,vm_ind_list,uniform_grid=True,out=None):
+	'''
+	Queries the takeoff angles of several events at once. Equivalent to calling lookup_takeoff() for each event, but
+	the picks of all of the events are concatenated and the lookup table is interpolated once, into a single output array.
+	Input:
+		table: Lookup table produced by create_takeoff_table(), 3d array.
+		depth_list: list of the perturbed origin depths (km) of each event produced by perturb_eq_locations, 2d arrays of shape (npick,nmc)
+		dist_list: list of the source-receiver distances (km) of each event produced by perturb_eq_locations, 2d arrays of shape (npick,nmc)
+		look_dep: minimum source depth, maximum, and interval for the lookup table, list
+		look_del: minimum source-station distance, maximum, and interval for the lookup table, list
+		deptab: array of depths (km) produced by create_lookup_table()
+		delttab: array of distances (km) produced by create_lookup_table()
+		vm_ind_list: list of the velocity model of each trial of each event, produced by random_velocity_models()
+		uniform_grid: if True, deptab and delttab are on the intervals of look_dep and look_del.
+		out: array of shape (total number of picks,nmc) in which to write the takeoff angles. If None, it is allocated.
+	Output:
+		takeoff_list: list of the takeoff angles of each event, views of out
+	'''
+	num_picks=[len(sr_dist_km) for sr_dist_km in dist_list]
+	pick_offsets=np.cumsum(num_picks)
+	if out is None:
+		out=np.empty((pick_offsets[-1],depth_list[0].shape[-1]))
+	id1,dfrac=lookup_cells(np.concatenate(depth_list),look_dep,deptab,uniform_grid)
+	sr_dist_km=clip_distances(np.concatenate(dist_list),delttab)
+	ix1,xfrac=lookup_cells(sr_dist_km,look_del,delttab,uniform_grid)
+	vm_ind=np.repeat(np.asarray(vm_ind_list),num_picks,axis=0)
+
+	interpolate_takeoff(table,id1,dfrac,ix1,xfrac,vm_ind,out=out)
+	return np.split(out,pick_offsets[:-1])
+
 
-	# If perturbed locations are outside of the modeled range, sets those perturbations to the model edge
+def lookup_cells(values,look,tab,uniform_grid=True):
+	'''
+	Determines the lookup table cells containing depths or distances.
+	Input:
+		values: depths or distances (km), array
+		look: minimum, maximum, and interval for the lookup table (look_dep or look_del), list
+		tab: depths or distances (km) of the lookup table (deptab or delttab), 1d array
+		uniform_grid: if True, tab is on the interval of look. If False, the cells are found by bisection.
+	Output:
+		ind: index of the lower edge of the cells, int array
+		frac: position within the cells (0 at the lower edge, 1 at the upper edge), array
+	'''
+	if uniform_grid:
+		ind=((values-look[0])/look[2]).astype(int)
+	else:
+		ind=np.clip(np.searchsorted(tab,values,side='right')-1,0,len(tab)-2)
+	frac=(values-tab[ind])/(tab[ind+1]-tab[ind])
+	return ind,frac
+
+
+def clip_distances(sr_dist_km,delttab):
+	'''
+	If perturbed locations are outside of the modeled range, sets those perturbations to the model edge.
+	Input:
+		sr_dist_km: source-receiver distances (km), array. Modified in place.
+		delttab: array of distances (km) produced by create_lookup_table()
+	Output:
+		sr_dist_km: the clipped distances
+	'''
 	dist_flag=sr_dist_km<delttab[0]
 	if np.any(dist_flag):
 		print('*WARNING: Perturbed epicenters(s) are closer than lookup table depth range. Setting these perturbed locations to {} km *'.format(delttab[0]))
@@ -45,37 +142,57 @@ def lookup_takeoff(table,perturbed_origin_depth_km,sr_dist_km,look_dep,look_del,
 	if np.any(dist_flag):
 		print('*WARNING: Perturbed epicenters(s) are further than lookup table depth range. Setting these perturbed locations to {} km *'.format(delttab[-1]))
 		sr_dist_km[dist_flag]=delttab[-1]
+	return sr_dist_km
 
-	# Determines the lookup table cell for permiated earthquake epicenters
-	ix1=((sr_dist_km-look_del[0])/look_del[2]).astype(int)
-	ix2=ix1+1
 
-	# Determines which velocity model to use for each trial
+def random_velocity_models(num_velocity_models,nmc):
+	'''
+	Randomly selects the velocity model used for each trial. The first trial uses the first velocity model.
+	Input:
+		num_velocity_models: the number of velocity models used
+		nmc: number of trials
+	Output:
+		randomized_vm_ind: velocity model index of each trial, 1d int array
+	'''
 	if num_velocity_models>1:
-		randomized_vm_ind=rng.integers(low=0, high=num_velocity_models,size=perturbed_origin_depth_km.shape[-1])
+		randomized_vm_ind=rng.integers(low=0, high=num_velocity_models,size=nmc)
 		randomized_vm_ind[0]=0
 	else:
-		randomized_vm_ind=np.zeros(perturbed_origin_depth_km.shape[-1],dtype=int)
-
-	# Uses the lookup table to determine the travel times / takeoff angles
-	xfrac=(sr_dist_km-delttab[ix1])/(delttab[ix2]-delttab[ix1])
-
-	if id1.ndim==1:
-		id1=np.repeat(id1[np.newaxis,:],len(sr_dist_km),axis=0)
-		id2=np.repeat(id2[np.newaxis,:],len(sr_dist_km),axis=0)
+		randomized_vm_ind=np.zeros(nmc,dtype=int)
+	return randomized_vm_ind
 
-	t1=table[ix1,id1,np.repeat([randomized_vm_ind],len(sr_dist_km),axis=0)]+\
-		xfrac*(table[ix2,id1,np.repeat([randomized_vm_ind],len(sr_dist_km),axis=0)]-
-		table[ix1,id1,np.repeat([randomized_vm_ind],len(sr_dist_km),axis=0)])
 
-	t2=table[ix1,id2,np.repeat([randomized_vm_ind],len(sr_dist_km),axis=0)]+\
-		xfrac*(table[ix2,id2,np.repeat([randomized_vm_ind],len(sr_dist_km),axis=0)]-
-		table[ix1,id2,np.repeat([randomized_vm_ind],len(sr_dist_km),axis=0)])
-
-	dfrac=(perturbed_origin_depth_km-deptab[id1])/(deptab[id2]-deptab[id1])
-	takeoff=t1+dfrac*(t2-t1)
-
-	return takeoff
+def interpolate_takeoff(table,id1,dfrac,ix1,xfrac,vm_ind,out=None):
+	'''
+	Bilinearly interpolates the lookup table. The four corners of every cell are gathered at once,
+	and the interpolation is done in place.
+	Input:
+		table: Lookup table produced by create_takeoff_table(), 3d array of shape (distance,depth,velocity model)
+		id1,dfrac: depth cells and positions within them, produced by lookup_cells()
+		ix1,xfrac: distance cells and positions within them, produced by lookup_cells()
+		vm_ind: velocity model of each trial, int array broadcastable with ix1
+		out: array in which to write the takeoff angles. If None, a new array is created.
+	Output:
+		takeoff: the interpolated takeoff angles
+	'''
+	num_dep,num_vm=table.shape[1],table.shape[2]
+	corner_ind=(ix1*num_dep+id1)*num_vm+vm_ind
+	corner_offsets=np.array([0,num_dep*num_vm,num_vm,(num_dep+1)*num_vm]).reshape((4,)+(1,)*corner_ind.ndim)
+	corners=np.take(table,corner_ind+corner_offsets) # (ix1,id1), (ix2,id1), (ix1,id2), (ix2,id2)
+
+	# Interpolates along distance, then depth
+	t1,t2=corners[1],corners[3]
+	t1-=corners[0]
+	t1*=xfrac
+	t1+=corners[0]
+	t2-=corners[2]
+	t2*=xfrac
+	t2+=corners[2]
+	t2-=t1
+	t2*=dfrac
+	if out is None:
+		out=np.empty(corner_ind.shape)
+	return np.add(t1,t2,out=out)
 
 
 def perturb_eq_locations(event_pol_df,look_dep,perturb_epicentral_location,nmc=1):
@@ -281,6 +398,7 @@ def create_takeoff_table(vmodel_depthvp,deptab,delttab,nump,nx0,nd0,takeoff_az_p
 		takeoff_az_precision: number of decimal places to round resulting table
 	Output:
 		table: produced lookup table of takeoff angles
+	Raises a ValueError if no pair of rays brackets some of the distances.
 	'''
 	if vmodel_depthvp[:,0][-1]<deptab[-1]:
 		vmodel_depthvp=np.vstack((vmodel_depthvp,vmodel_depthvp[-1,:]))
@@ -300,14 +418,17 @@ def create_takeoff_table(vmodel_depthvp,deptab,delttab,nump,nx0,nd0,takeoff_az_p
 	z=np.hstack((z,z[npts-1]))
 	alpha=np.hstack((alpha,alpha[npts-1]))
 
-	for i in range(npts-1,0,-1):
-		for idep in range(ndep-1,-1,-1):
-			if (z[i-1]<=(deptab[idep]-0.00001)) & (z[i]>=(deptab[idep]+.00001)):
-				z=np.insert(z,i,z[i-1])
-				alpha=np.insert(alpha,i,alpha[i-1])
-				z[i]=deptab[idep]
-				frac=(z[i]-z[i-1])/(z[i+1]-z[i-1])
-				alpha[i]=alpha[i-1]+frac*(alpha[i+1]-alpha[i-1])
+	# Inserts the source depths that are within a layer, interpolating the velocity
+	insert_dep=np.unique(deptab)
+	layer_ind=np.searchsorted(z,insert_dep-0.00001,side='right')
+	insert_flag=(layer_ind>=1) & (layer_ind<=npts-1)
+	insert_flag[insert_flag]=z[layer_ind[insert_flag]]>=(insert_dep[insert_flag]+0.00001)
+	insert_dep=insert_dep[insert_flag]
+	layer_ind=layer_ind[insert_flag]
+	frac=(insert_dep-z[layer_ind-1])/(z[layer_ind]-z[layer_ind-1])
+	insert_alpha=alpha[layer_ind-1]+frac*(alpha[layer_ind]-alpha[layer_ind-1])
+	z=np.insert(z,layer_ind,insert_dep)
+	alpha=np.insert(alpha,layer_ind,insert_alpha)
 
 	slow=1/alpha
 	pmax=slow[0]
@@ -383,28 +504,19 @@ def create_takeoff_table(vmodel_depthvp,deptab,delttab,nump,nx0,nd0,takeoff_az_p
 
 	# Ensures values after ray has turned are nan
 	x=((irtr==0) | (irtr==2))
-	idx=np.arange(npmax), x.argmax(axis=1)
-	tmp=(x[idx]==True)
-
-	idx_1=idx[0][tmp],idx[1][tmp]+1
-	tmp_1=idx_1[1]<(len(utop)-1)
-	idx_1=idx_1[0][tmp_1],idx_1[1][tmp_1]
-	for xx in range(len(idx_1[0])):
-		row=idx_1[0][xx]
-		col=idx_1[1][xx]
-		dx[row,col:]=np.nan
-		dt[row,col:]=np.nan
+	turn_col=x.argmax(axis=1)
+	turn_flag=x[np.arange(npmax),turn_col]
+	layer_col=np.arange(len(utop))
+
+	after_turn_flag=layer_col>=np.where(turn_flag & (turn_col+1<len(utop)-1),turn_col+1,len(utop))[:,np.newaxis]
+	dx[after_turn_flag]=np.nan
+	dt[after_turn_flag]=np.nan
 	deltab=np.nansum(dx,axis=1)*2
 	tttab=np.nansum(dt,axis=1)*2
 
-	idx_2=idx[0][tmp],idx[1][tmp]
-	tmp_2=idx_2[1]<(len(utop)-1)
-	idx_2=idx_2[0][tmp_2],idx_2[1][tmp_2]
-	for xx in range(len(idx_2[0])):
-		row=idx_2[0][xx]
-		col=idx_2[1][xx]
-		dx[row,col:]=np.nan
-		dt[row,col:]=np.nan
+	after_turn_flag=layer_col>=np.where(turn_flag & (turn_col<len(utop)-1),turn_col,len(utop))[:,np.newaxis]
+	dx[after_turn_flag]=np.nan
+	dt[after_turn_flag]=np.nan
 
 	depxcor=np.cumsum(dx,axis=1)
 	deptcor=np.cumsum(dt,axis=1)
@@ -423,44 +535,45 @@ def create_takeoff_table(vmodel_depthvp,deptab,delttab,nump,nx0,nd0,takeoff_az_p
 	tmp=(x[idx,np.arange(nd0)]==False)
 	idx[tmp]=npmax-1
 
-	for idep in range(ndep):
-		# upgoing rays from source
-		xsave_up=depxcor[:(idx[idep]),idep]
-		tsave_up=deptcor[:(idx[idep]),idep]
-		usave_up=depucor[:(idx[idep]),idep]
-		psave_up=-1*ptab[:(idx[idep])]
-
-		# downgoing rays from source
-		down_idx=np.where((depxcor[:,idep]!=-999) & (deltab!=-999))[0][::-1]
-		xsave_down=(deltab[down_idx]-depxcor[down_idx,idep])
-		tsave_down=(tttab[down_idx]-deptcor[down_idx,idep])
-		usave_down=depucor[down_idx,idep]
-		psave_down=ptab[down_idx]
-
-		# Merges upgoing and downgoing ray arrays
-		xsave=np.hstack([xsave_up,xsave_down])
-		tsave=np.hstack([tsave_up,tsave_down])
-		usave=np.hstack([usave_up,usave_down])
-		psave=np.hstack([psave_up,psave_down])
-
-		scr1=np.zeros(ndel)
-		for idel in range(1,ndel):
-			del_x=delttab[idel]
-			ind=np.where( (xsave[:-1]<=del_x) & (xsave[1:]>=del_x) )[0]+1
-
-			frac=(del_x-xsave[ind-1])/(xsave[ind]-xsave[ind-1])
-			t1=tsave[ind-1]+frac*(tsave[ind]-tsave[ind-1])
-
-			min_ind=ind[np.argmin(t1)]
-
-			scr1[idel]=psave[min_ind]/usave[min_ind]
-		angle=np.rad2deg(np.arcsin(scr1))
-
-		angle_flag=angle>=0
-		angle*=-1
-		angle[angle_flag]+=180
-
-		table[:,idep]=angle
+	# For each source depth, the upgoing rays (by increasing ray parameter) followed by the downgoing rays (by decreasing ray parameter)
+	up_dep,up_ray=np.nonzero(np.arange(npmax)<idx[:,np.newaxis])
+	down_dep,down_ray=np.nonzero(((depxcor!=-999) & (deltab[:,np.newaxis]!=-999))[::-1].T)
+	down_ray=npmax-1-down_ray
+	ray_order=np.argsort(np.concatenate((up_dep,down_dep)),kind='stable')
+	ray_dep=np.concatenate((up_dep,down_dep))[ray_order]
+	xsave=np.concatenate((depxcor[up_ray,up_dep],deltab[down_ray]-depxcor[down_ray,down_dep]))[ray_order]
+	tsave=np.concatenate((deptcor[up_ray,up_dep],tttab[down_ray]-deptcor[down_ray,down_dep]))[ray_order]
+	usave=np.concatenate((depucor[up_ray,up_dep],depucor[down_ray,down_dep]))[ray_order]
+	psave=np.concatenate((-1*ptab[up_ray],ptab[down_ray]))[ray_order]
+
+	# Finds the distances bracketed by each pair of consecutive rays (x[ind-1]<=del_x<=x[ind])
+	ind=np.where(ray_dep[1:]==ray_dep[:-1])[0]+1
+	first_del=np.maximum(np.searchsorted(delttab,xsave[ind-1],side='left'),1)
+	num_del=np.maximum(np.searchsorted(delttab,xsave[ind],side='right')-first_del,0)
+	ind=np.repeat(ind,num_del)
+	del_ind=np.repeat(first_del-np.cumsum(num_del)+num_del,num_del)+np.arange(len(ind))
+
+	frac=(delttab[del_ind]-xsave[ind-1])/(xsave[ind]-xsave[ind-1])
+	t1=tsave[ind-1]+frac*(tsave[ind]-tsave[ind-1])
+
+	# For each depth and distance, keeps the bracketing ray with the minimum travel time
+	group=ray_dep[ind]*ndel+del_ind
+	nan_flag=np.isnan(t1)
+	min_order=np.lexsort((ind,np.where(nan_flag,0,t1),~nan_flag,group))
+	group,first_ind=np.unique(group[min_order],return_index=True)
+	if len(group)<ndep*(ndel-1):
+		raise ValueError('***Error: No ray reaches some of the lookup table distances (look_del). Try increasing nump.')
+	min_ind=ind[min_order[first_ind]]
+
+	scr1=np.zeros((ndel,ndep))
+	scr1[1:,:]=(psave[min_ind]/usave[min_ind]).reshape(ndep,ndel-1).T
+	angle=np.rad2deg(np.arcsin(scr1))
+
+	angle_flag=angle>=0
+	angle*=-1
+	angle[angle_flag]+=180
+
+	table[:,:]=angle
 
 	if delttab[0]==0:
 		table[0,:]=0. # straight up at zero range
@@ -468,6 +581,30 @@ def create_takeoff_table(vmodel_depthvp,deptab,delttab,nump,nx0,nd0,takeoff_az_p
 	return table
 
 
+def grid_dimensions(dang):
+	'''
+	Determines the dimensions of the grid of test mechanisms used by dir_cos_setup().
+	Input:
+		dang: grid spacing (degrees)
+	Output:
+		the: angles of the fault normal from vertical (degrees), 1d array
+		dphi: azimuthal spacing (degrees) for each value of the, 1d array
+		num_iphi: maximum azimuth index for each value of the, 1d array
+		num_izeta: maximum rotation index
+	'''
+	num_izeta=int(np.floor(179.9/dang))
+	the=np.arange(0,90.001,dang) # angles for grid search
+
+	rthe=np.deg2rad(the)
+	fnumang=360./dang
+	dphi=np.round(fnumang*np.sin(rthe))
+	dphi[dphi!=0]=360./dphi[dphi!=0]
+	dphi[dphi==0]=10000.
+	num_iphi=np.floor(359.9/dphi).astype(int)
+
+	return the,dphi,num_iphi,num_izeta
+
+
 def dir_cos_setup(p_dict):
 	'''
 	Sets up array with direction cosines for all coordinate transformations
@@ -489,61 +626,11 @@ def dir_cos_setup(p_dict):
 		'amptable':np.empty(0)
 	}
 
-	num_izeta=int(np.floor(179.9/p_dict['dang']))
-	the=np.arange(0,90.001,p_dict['dang']) # angles for grid search
-
-	rthe=np.deg2rad(the)
-	costhe=np.cos(rthe)
-	sinthe=np.sin(rthe)
-	fnumang=360./p_dict['dang']
-	dphi=np.round(fnumang*np.sin(rthe))
-	dphi[dphi!=0]=360./dphi[dphi!=0]
-	dphi[dphi==0]=10000.
-	num_iphi=np.floor(359.9/dphi).astype(int)
-
-	dir_cos_dict['ncoor']=np.sum(num_iphi+1)*(num_izeta+1)
-
-	dir_cos_dict['b1']=np.zeros((3,dir_cos_dict['ncoor']))
-	dir_cos_dict['b2']=np.zeros((3,dir_cos_dict['ncoor']))
-	dir_cos_dict['b3']=np.zeros((3,dir_cos_dict['ncoor']))
-	irot=0
-
-	for ithe in range(len(the)):
-		bb1=np.zeros(3)
-		bb3=np.zeros(3)
-		for iphi in range(0,num_iphi[ithe]+1):
-			phi=iphi*dphi[ithe]
-			rphi=np.deg2rad(phi)
-			cosphi=np.cos(rphi)
-			sinphi=np.sin(rphi)
-			bb3[2]=costhe[ithe]
-			bb3[0]=sinthe[ithe]*cosphi
-			bb3[1]=sinthe[ithe]*sinphi
-
-			bb1[2]=-sinthe[ithe]
-			bb1[0]=costhe[ithe]*cosphi
-			bb1[1]=costhe[ithe]*sinphi
-
-			bb2=np.cross(bb1,bb3)*-1
-
-			for izeta in range(0,num_izeta+1):
-				if (irot>dir_cos_dict['ncoor']):
-					raise ValueError('***FOCAL error: # of rotations too big')
-				zeta=izeta*p_dict['dang']
-				rzeta=np.deg2rad(zeta)
-				coszeta=np.cos(rzeta)
-				sinzeta=np.sin(rzeta)
-
-				dir_cos_dict['b3'][2,irot]=bb3[2]
-				dir_cos_dict['b3'][0,irot]=bb3[0]
-				dir_cos_dict['b3'][1,irot]=bb3[1]
-				dir_cos_dict['b1'][0,irot]=bb1[0]*coszeta+bb2[0]*sinzeta
-				dir_cos_dict['b1'][1,irot]=bb1[1]*coszeta+bb2[1]*sinzeta
-				dir_cos_dict['b1'][2,irot]=bb1[2]*coszeta+bb2[2]*sinzeta
-				dir_cos_dict['b2'][0,irot]=bb2[0]*coszeta-bb1[0]*sinzeta
-				dir_cos_dict['b2'][1,irot]=bb2[1]*coszeta-bb1[1]*sinzeta
-				dir_cos_dict['b2'][2,irot]=bb2[2]*coszeta-bb1[2]*sinzeta
-				irot=irot+1
+	if p_dict['mech_sampling']=='so3':
+		dir_cos_dict['b1'],dir_cos_dict['b2'],dir_cos_dict['b3']=so3_dir_cos(p_dict['dang'])
+		dir_cos_dict['ncoor']=dir_cos_dict['b1'].shape[1]
+	else:
+		grid_dir_cos(dir_cos_dict,p_dict['dang'])
 
 	bbb=-1.+np.arange(0,2*ntab+1)*astep
 	_x,_y=np.meshgrid(bbb,bbb)
@@ -570,6 +657,273 @@ def dir_cos_setup(p_dict):
 	return dir_cos_dict
 
 
+def grid_dir_cos(dir_cos_dict,dang):
+	'''
+	Sets up the direction cosines of the test mechanisms on the (the, phi, zeta) grid used by HASH.
+	Input:
+		dir_cos_dict: Coordinate transformation variables, dictionary. The b1, b2, b3, and ncoor keys are set.
+		dang: grid spacing (degrees)
+	'''
+	the,dphi,num_iphi,num_izeta=grid_dimensions(dang)
+
+	rthe=np.deg2rad(the)
+	costhe=np.cos(rthe)
+	sinthe=np.sin(rthe)
+
+	dir_cos_dict['ncoor']=np.sum(num_iphi+1)*(num_izeta+1)
+
+	# Fault normal (bb3) and the vectors perpendicular to it (bb1, bb2) for each (the, phi) pair
+	ithe_row=np.repeat(np.arange(len(the)),num_iphi+1)
+	iphi_row=np.concatenate([np.arange(tmp_num_iphi+1) for tmp_num_iphi in num_iphi])
+	rphi=np.deg2rad(iphi_row*dphi[ithe_row])
+	cosphi=np.cos(rphi)
+	sinphi=np.sin(rphi)
+
+	bb3=np.column_stack((sinthe[ithe_row]*cosphi,sinthe[ithe_row]*sinphi,costhe[ithe_row]))
+	bb1=np.column_stack((costhe[ithe_row]*cosphi,costhe[ithe_row]*sinphi,-sinthe[ithe_row]))
+	bb2=np.cross(bb1,bb3)*-1
+
+	# Rotates bb1 and bb2 about the fault normal by each zeta
+	rzeta=np.deg2rad(np.arange(0,num_izeta+1)*dang)
+	coszeta=np.cos(rzeta)
+	sinzeta=np.sin(rzeta)
+
+	dir_cos_dict['b3']=np.repeat(bb3.T,num_izeta+1,axis=1)
+	dir_cos_dict['b1']=(bb1.T[:,:,np.newaxis]*coszeta+bb2.T[:,:,np.newaxis]*sinzeta).reshape(3,-1)
+	dir_cos_dict['b2']=(bb2.T[:,:,np.newaxis]*coszeta-bb1.T[:,:,np.newaxis]*sinzeta).reshape(3,-1)
+
+
+def so3_dir_cos(dang):
+	'''
+	Sets up the direction cosines of test mechanisms that sample rotation space quasi-uniformly
+	(a Hopf fibration grid). The fault normals form a Fibonacci lattice on the upper hemisphere,
+	so that each normal represents an equal area. The rotations about each normal are spaced by about dang,
+	and are offset by a different fraction of the spacing for each normal, so that the rotations of
+	neighboring normals interleave. Compared to grid_dir_cos(), the normals along the equator are not
+	duplicated, which reduces the number of test mechanisms without increasing the distance to the nearest one.
+	Input:
+		dang: approximate grid spacing (degrees)
+	Output:
+		b1,b2,b3: direction cosines of the test mechanisms, arrays of shape (3,ncoor)
+	'''
+	rdang=np.deg2rad(dang)
+	num_normal=max(1,int(round(2*np.pi/rdang**2)))
+	num_izeta=max(1,int(round(180/dang)))
+	zeta_step=np.pi/num_izeta
+
+	normal_ind=np.arange(num_normal)
+	costhe=1-(normal_ind+0.5)/num_normal
+	sinthe=np.sqrt(1-costhe**2)
+	rphi=(normal_ind*np.pi*(3-np.sqrt(5)))%(2*np.pi) # golden angle increments
+	cosphi=np.cos(rphi)
+	sinphi=np.sin(rphi)
+
+	bb3=np.column_stack((sinthe*cosphi,sinthe*sinphi,costhe))
+	bb1=np.column_stack((costhe*cosphi,costhe*sinphi,-sinthe))
+	bb2=np.cross(bb1,bb3)*-1
+
+	zeta_offset=((normal_ind*(np.sqrt(5)-1)/2)%1)*zeta_step
+	rzeta=zeta_offset[:,np.newaxis]+np.arange(num_izeta)*zeta_step
+	coszeta=np.cos(rzeta)
+	sinzeta=np.sin(rzeta)
+
+	b3=np.repeat(bb3.T,num_izeta,axis=1)
+	b1=(bb1.T[:,:,np.newaxis]*coszeta+bb2.T[:,:,np.newaxis]*sinzeta).reshape(3,-1)
+	b2=(bb2.T[:,:,np.newaxis]*coszeta-bb1.T[:,:,np.newaxis]*sinzeta).reshape(3,-1)
+	return b1,b2,b3
+
+
+def grid_node_angles(dang):
+	'''
+	Determines the grid angles of each test mechanism created by dir_cos_setup(), in the same order.
+	Input:
+		dang: grid spacing (degrees)
+	Output:
+		the_node: angle of the fault normal from vertical (degrees), 1d array
+		phi_node: azimuth of the fault normal (degrees), 1d array
+		zeta_node: rotation of the slip vector about the fault normal (degrees), 1d array
+	'''
+	the,dphi,num_iphi,num_izeta=grid_dimensions(dang)
+	ithe_node=np.repeat(np.arange(len(the)),(num_iphi+1)*(num_izeta+1))
+	iphi_node=np.concatenate([np.repeat(np.arange(tmp_num_iphi+1),num_izeta+1) for tmp_num_iphi in num_iphi])
+	izeta_node=np.tile(np.arange(num_izeta+1),np.sum(num_iphi+1))
+
+	return the[ithe_node],iphi_node*dphi[ithe_node],izeta_node*dang
+
+
+def mech_frame_similarity(b1a,b2a,b3a,b1b,b2b,b3b):
+	'''
+	Computes the similarity between two sets of test mechanisms given their direction cosines.
+	The similarity is the trace of the rotation between the mechanisms, maximized over the
+	four equivalent ways of describing a mechanism (swapping the fault and auxiliary planes,
+	and reversing both vectors). The minimum rotation angle is arccos((similarity-1)/2).
+	Input:
+		b1a,b2a,b3a: direction cosines of the first set of mechanisms, arrays of shape (3,n)
+		b1b,b2b,b3b: direction cosines of the second set of mechanisms, arrays of shape (3,m)
+	Output:
+		similarity: array of shape (n,m)
+	'''
+	frames_a=np.vstack((b1a,b2a,b3a))
+	similarity=np.full((b1a.shape[1],b1b.shape[1]),-np.inf)
+	for frames_b in [np.vstack((b1b,b2b,b3b)),np.vstack((-b1b,b2b,-b3b)),np.vstack((b3b,-b2b,b1b)),np.vstack((-b3b,-b2b,-b1b))]:
+		similarity=np.maximum(similarity,frames_a.T@frames_b)
+	return similarity
+
+
+def coarse_grid_setup(dir_cos_dict,p_dict):
+	'''
+	Sets up the coarse grid of test mechanisms used by the coarse-to-fine grid search.
+	The neighbors of each coarse mechanism are determined, and each test mechanism of the fine
+	grid (dir_cos_dict) is assigned to a similar coarse mechanism.
+	Input:
+		dir_cos_dict: Coordinate transformation variables of the fine grid, produced by dir_cos_setup()
+		p_dict: Parameter values created in SKHASH.py, dictionary
+	Output:
+		dir_cos_dict: Coordinate transformation variables, with the coarse grid added as dir_cos_dict['coarse']
+	'''
+	coarse_dang=p_dict['coarse_dang']
+	coarse_dict=dir_cos_setup(dict(p_dict,dang=coarse_dang,ampfile=''))
+	coarse_dict['amptable']=dir_cos_dict['amptable']
+
+	# Coarse mechanisms within 1.8 grid steps (which includes the diagonal neighbors) are considered neighbors
+	min_similarity=1+2*np.cos(np.deg2rad(1.8*coarse_dang))
+	chunk_size=1024
+	neighbor_ind=[]
+	neighbor_count=np.zeros(coarse_dict['b1'].shape[1],dtype=int)
+	for chunk_start in range(0,coarse_dict['b1'].shape[1],chunk_size):
+		chunk_slice=slice(chunk_start,chunk_start+chunk_size)
+		similarity=mech_frame_similarity(coarse_dict['b1'][:,chunk_slice],coarse_dict['b2'][:,chunk_slice],coarse_dict['b3'][:,chunk_slice],
+										coarse_dict['b1'],coarse_dict['b2'],coarse_dict['b3'])
+		row,col=np.where(similarity>=min_similarity)
+		neighbor_ind.append(col)
+		neighbor_count[chunk_start+np.arange(similarity.shape[0])]=np.bincount(row,minlength=similarity.shape[0])
+	coarse_dict['neighbor_ind']=np.concatenate(neighbor_ind)
+	coarse_dict['neighbor_count']=neighbor_count
+
+	# Assigns each fine mechanism to the coarse mechanism with the nearest grid angles, then moves it to
+	# the most similar neighboring coarse mechanism until no neighbor is more similar.
+	# The nearest grid angles can be far from the most similar mechanism near the=0, where phi and zeta trade off.
+	if p_dict['mech_sampling']=='so3': # No grid angles, so the most similar coarse mechanism is found directly
+		fine_parent=np.zeros(dir_cos_dict['b1'].shape[1],dtype=int)
+		for chunk_start in range(0,len(fine_parent),chunk_size):
+			chunk_slice=slice(chunk_start,chunk_start+chunk_size)
+			similarity=mech_frame_similarity(dir_cos_dict['b1'][:,chunk_slice],dir_cos_dict['b2'][:,chunk_slice],dir_cos_dict['b3'][:,chunk_slice],
+											coarse_dict['b1'],coarse_dict['b2'],coarse_dict['b3'])
+			fine_parent[chunk_slice]=np.argmax(similarity,axis=1)
+	else:
+		the_node,phi_node,zeta_node=grid_node_angles(p_dict['dang'])
+		coarse_the,coarse_dphi,coarse_num_iphi,coarse_num_izeta=grid_dimensions(coarse_dang)
+		ithe_parent=np.clip(np.round(the_node/coarse_dang).astype(int),0,len(coarse_the)-1)
+		iphi_parent=np.round(phi_node/coarse_dphi[ithe_parent]).astype(int)
+		iphi_parent[iphi_parent>coarse_num_iphi[ithe_parent]]=0 # wraps around at 360 deg
+		izeta_parent=np.clip(np.round(zeta_node/coarse_dang).astype(int),0,coarse_num_izeta)
+		row_offset=np.concatenate(([0],np.cumsum((coarse_num_iphi+1)*(coarse_num_izeta+1))[:-1]))
+		fine_parent=row_offset[ithe_parent]+iphi_parent*(coarse_num_izeta+1)+izeta_parent
+
+	# Neighbors of each coarse mechanism as a 2d array, padded with the coarse mechanism itself
+	neighbor_pad=np.repeat(np.arange(len(neighbor_count))[:,np.newaxis],neighbor_count.max(),axis=1)
+	neighbor_pad[np.arange(neighbor_count.max())<neighbor_count[:,np.newaxis]]=coarse_dict['neighbor_ind']
+
+	fine_frames=np.vstack((dir_cos_dict['b1'],dir_cos_dict['b2'],dir_cos_dict['b3']))
+	b1,b2,b3=coarse_dict['b1'],coarse_dict['b2'],coarse_dict['b3']
+	coarse_frames=[np.vstack((b1,b2,b3)),np.vstack((-b1,b2,-b3)),np.vstack((b3,-b2,b1)),np.vstack((-b3,-b2,-b1))]
+	chunk_size=8192
+	for chunk_start in range(0,len(fine_parent),chunk_size):
+		chunk_slice=slice(chunk_start,chunk_start+chunk_size)
+		chunk_parent=fine_parent[chunk_slice]
+		while True:
+			candidate=neighbor_pad[chunk_parent]
+			similarity=np.max([np.einsum('jn,jnk->nk',fine_frames[:,chunk_slice],tmp_frames[:,candidate]) for tmp_frames in coarse_frames],axis=0)
+			new_parent=candidate[np.arange(len(candidate)),np.argmax(similarity,axis=1)]
+			if np.all(new_parent==chunk_parent):
+				break
+			chunk_parent=new_parent
+		fine_parent[chunk_slice]=chunk_parent
+	coarse_dict['fine_parent']=fine_parent
+
+	dir_cos_dict['coarse']=coarse_dict
+	return dir_cos_dict
+
+
+def coarse_candidates(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,nextra,ntotal,qextra,qtotal,
+						min_ratio_trial_solutions=0.5,min_num_sp_solutions=10,max_memory_mb=0,bitpacked_polarity=False,misfit_fun=None,num_threads=1):
+	'''
+	Performs the coarse stage of the coarse-to-fine grid search. The coarse mechanisms that meet the
+	misfit criteria in any trial, along with their neighbors, are kept. The fine mechanisms assigned
+	to these coarse mechanisms are returned as the candidates for the fine grid search.
+	Input: see focal_gridsearch()
+	Output:
+		candidate_ind: indices of the fine test mechanisms to consider
+	'''
+	coarse_dict=dir_cos_dict['coarse']
+	fit,afit=gridsearch_misfit(sr_azimuth,takeoff,p_pol,sp_amp,coarse_dict,max_memory_mb=max_memory_mb,bitpacked_polarity=bitpacked_polarity,misfit_fun=misfit_fun,num_threads=num_threads)
+	coarse_flag=good_mech_flag(fit,afit,nextra,ntotal,qextra,qtotal,
+							min_ratio_trial_solutions=min_ratio_trial_solutions,min_num_sp_solutions=min_num_sp_solutions)
+
+	keep_flag=coarse_flag.copy()
+	keep_flag[coarse_dict['neighbor_ind'][np.repeat(coarse_flag,coarse_dict['neighbor_count'])]]=True
+
+	return np.where(keep_flag[coarse_dict['fine_parent']])[0]
+
+
+def dir_cos_cache_folder(p_dict):
+	'''
+	Determines the folder used to cache the coordinate transformation variables for the given parameters.
+	Input:
+		p_dict: Parameter values created in SKHASH.py, dictionary
+	Output:
+		cache_folder: path of the cache folder
+	'''
+	key_params={'version':1,'dang':p_dict['dang'],'coarse_dang':p_dict['coarse_dang'],'mech_sampling':p_dict['mech_sampling'],
+				'amptable':bool(p_dict['ampfile']),'min_amp':p_dict['min_amp']}
+	return os.path.join(p_dict['dir_cos_cache_dir'],'dir_cos_{}'.format(cache.cache_key(key_params)[:16]))
+
+
+def cached_dir_cos_setup(p_dict):
+	'''
+	Loads the coordinate transformation variables from the disk cache (dir_cos_cache_dir), creating
+	them with dir_cos_setup() (and coarse_grid_setup(), if coarse_dang>0) if they have not been cached.
+	The arrays are memory-mapped, so parallel workers can share them by passing only the cache folder.
+	Input:
+		p_dict: Parameter values created in SKHASH.py, dictionary
+	Output:
+		dir_cos_dict: Coordinate transformation variables, dictionary. dir_cos_dict['cache_folder'] is the cache folder.
+	'''
+	cache_folder=dir_cos_cache_folder(p_dict)
+	if not(os.path.isdir(cache_folder)):
+		dir_cos_dict=dir_cos_setup(p_dict)
+		if p_dict['coarse_dang']:
+			dir_cos_dict=coarse_grid_setup(dir_cos_dict,p_dict)
+		arrays={key:value for key,value in dir_cos_dict.items() if key!='coarse'}
+		if 'coarse' in dir_cos_dict:
+			arrays.update({'coarse.'+key:value for key,value in dir_cos_dict['coarse'].items() if key!='amptable'})
+		cache.save_arrays(cache_folder,arrays)
+	return load_dir_cos(cache_folder)
+
+
+def load_dir_cos(cache_folder):
+	'''
+	Loads the memory-mapped coordinate transformation variables cached by cached_dir_cos_setup().
+	The result is kept, so each process loads the cache folder at most once.
+	Input:
+		cache_folder: path of the cache folder
+	Output:
+		dir_cos_dict: Coordinate transformation variables, dictionary
+	'''
+	if cache_folder not in dir_cos_memo:
+		arrays=cache.load_arrays(cache_folder)
+		dir_cos_dict={key:value for key,value in arrays.items() if not(key.startswith('coarse.'))}
+		dir_cos_dict['ncoor']=int(dir_cos_dict['ncoor'])
+		coarse_dict={key[7:]:value for key,value in arrays.items() if key.startswith('coarse.')}
+		if coarse_dict:
+			coarse_dict['ncoor']=int(coarse_dict['ncoor'])
+			coarse_dict['amptable']=dir_cos_dict['amptable']
+			dir_cos_dict['coarse']=coarse_dict
+		dir_cos_dict['cache_folder']=cache_folder
+		dir_cos_memo[cache_folder]=dir_cos_dict
+	return dir_cos_memo[cache_folder]
+
+
 def average_mech(norm1in,norm2in):
 	'''
 	Computes the average mech of the solutions.
@@ -943,7 +1297,8 @@ def mech_probability(norm1in,norm2in,cangle,prob_max,iterative_avg=False):
 	return mech_df
 
 
-def focal_gridsearch(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,nextra,ntotal,qextra,qtotal,maxout,ncoor,min_ratio_trial_solutions=0.5,min_num_sp_solutions=10):
+def focal_gridsearch(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,nextra,ntotal,qextra,qtotal,maxout,ncoor,min_ratio_trial_solutions=0.5,min_num_sp_solutions=10,max_memory_mb=0,bitpacked_polarity=False,misfit_fun=None,
+					early_rejection=False,early_rejection_trials=0,num_threads=1):
 	'''
 	Performs a grid search to find focal mechanisms using P-polarity and S/P ratio information using the python routine.
 	Input:
@@ -960,28 +1315,150 @@ def focal_gridsearch(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,nextra,ntotal,
 		ncoor: number of test mechanisms
 		min_ratio_trial_solutions: minimum ratio of trial solutions from polarities before criteria loosened
 		min_num_sp_solutions: minimum ratio of trial solutions from S/P ratios before criteria loosened
+		max_memory_mb: if >0, the misfits are computed in tiles so that the temporary arrays use at most roughly this many MB
+		bitpacked_polarity: if True, the polarity misfits are computed using polarity_misfit_bitpacked()
+		misfit_fun: if provided, the function used to compute the misfits (see gridsearch_misfit())
+		early_rejection: if True and there are no S/P ratios, the two-stage search in early_rejection_flag() is used.
+			The acceptable mechanisms are identical to the exhaustive search.
+		early_rejection_trials: number of trials, in addition to the unperturbed trial, used as references by early_rejection_flag()
+		num_threads: if >1, the misfits are computed by this many threads, each computing a part of the test mechanisms (see gridsearch_misfit())
 	Output:
 		faultnorms_all: fault normal vectors
 		faultslips_all: fault slip vectors
 	'''
-	ntab=180
-	astep=1/ntab
+	# If a coarse grid was set up, only the fine test mechanisms near acceptable coarse mechanisms are considered
+	coor_ind=None
+	if 'coarse' in dir_cos_dict:
+		coor_ind=coarse_candidates(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,nextra,ntotal,qextra,qtotal,
+							min_ratio_trial_solutions=min_ratio_trial_solutions,min_num_sp_solutions=min_num_sp_solutions,
+							max_memory_mb=max_memory_mb,bitpacked_polarity=bitpacked_polarity,misfit_fun=misfit_fun,num_threads=num_threads)
+
+	if early_rejection and not(np.any(np.isfinite(sp_amp))):
+		good_fp_ind=np.where(early_rejection_flag(sr_azimuth,takeoff,p_pol,dir_cos_dict,nextra,ntotal,num_reference_trials=early_rejection_trials,
+							coor_ind=coor_ind,max_memory_mb=max_memory_mb,bitpacked_polarity=bitpacked_polarity,misfit_fun=misfit_fun,num_threads=num_threads))[0]
+		if len(good_fp_ind)>maxout: # If more than maxout solutions meet criteria, randomly select maxout solutions
+			good_fp_ind=rng.choice(good_fp_ind,maxout,replace=False)
+	else:
+		fit,afit=gridsearch_misfit(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,max_memory_mb=max_memory_mb,bitpacked_polarity=bitpacked_polarity,
+								coor_ind=coor_ind,misfit_fun=misfit_fun,num_threads=num_threads)
 
+		good_fp_ind=select_mechs(fit,afit,nextra,ntotal,qextra,qtotal,maxout,
+								min_ratio_trial_solutions=min_ratio_trial_solutions,min_num_sp_solutions=min_num_sp_solutions)
+	if coor_ind is not None:
+		good_fp_ind=coor_ind[good_fp_ind]
+
+	faultnorms_all=np.vstack((dir_cos_dict['b3'][0,good_fp_ind],dir_cos_dict['b3'][1,good_fp_ind],dir_cos_dict['b3'][2,good_fp_ind]))
+	faultslips_all=np.vstack((dir_cos_dict['b1'][0,good_fp_ind],dir_cos_dict['b1'][1,good_fp_ind],dir_cos_dict['b1'][2,good_fp_ind]))
+
+	return faultnorms_all,faultslips_all
+
+
+def early_rejection_flag(sr_azimuth,takeoff,p_pol,dir_cos_dict,nextra,ntotal,num_reference_trials=0,
+						coor_ind=None,max_memory_mb=0,bitpacked_polarity=False,misfit_fun=None,num_threads=1):
 	'''
-	Transforms the spherical coordinates to cartesian
+	Determines the acceptable test mechanisms using P-polarities only, in two stages.
+	Stage one scores every mechanism on the reference trials: the unperturbed trial (0) and
+	num_reference_trials other trials, evenly spaced. A polarity's predicted sign in another trial can
+	only differ from its sign in a reference trial if the reference ray is within the angle between the
+	two rays of one of the mechanism's nodal planes. The weights of these polarities bound how much each
+	mechanism's misfit can change between the reference trial and the other trial.
+	Stage two scores each of the other trials only on the mechanisms whose lower bound does not exceed the
+	largest possible misfit threshold of that trial. As the best mechanism of every trial always survives,
+	the misfit thresholds, and the acceptable mechanisms, are identical to good_mech_flag() applied to the
+	exhaustive grid search.
+	Input:
+		sr_azimuth: source-receiver azimuths, 2d array
+		takeoff: takeoff angles, 2d array
+		p_pol: polarity weights, 1d array
+		dir_cos_dict: coordinate transformation dictionary, produced by dir_cos_setup()
+		nextra: number of polarity additional misfits allowed above minimum
+		ntotal: total number of allowed polarity misfits
+		num_reference_trials: number of trials, in addition to the unperturbed trial, to score on every mechanism
+		coor_ind, max_memory_mb, bitpacked_polarity, misfit_fun: see gridsearch_misfit()
+		num_threads: number of threads computing the misfits of the reference trials (see gridsearch_misfit())
+	Output:
+		good_flag: boolean array of shape (ncoor), True for the acceptable test mechanisms
 	'''
-	pol_ind=np.where(p_pol!=0)[0]
+	if coor_ind is not None:
+		dir_cos_dict=dict(dir_cos_dict,b1=dir_cos_dict['b1'][:,coor_ind],b2=dir_cos_dict['b2'][:,coor_ind],b3=dir_cos_dict['b3'][:,coor_ind])
+	sr_azimuth=np.broadcast_to(sr_azimuth,takeoff.shape)
+	no_sp_amp=np.full(len(p_pol),np.nan)
+	nmc=takeoff.shape[1]
+
+	ref_trials=np.unique(np.round(np.linspace(0,nmc-1,num_reference_trials+1)).astype(int))
+	other_trials=np.setdiff1d(np.arange(nmc),ref_trials)
+
+	# Stage one: exact misfits of the reference trials
+	fit_ref,afit_ref=gridsearch_misfit(sr_azimuth[:,ref_trials],takeoff[:,ref_trials],p_pol,no_sp_amp,dir_cos_dict,
+							max_memory_mb=max_memory_mb,bitpacked_polarity=bitpacked_polarity,misfit_fun=misfit_fun,num_threads=num_threads)
+	good_flag=good_mech_flag(fit_ref,None,nextra,ntotal,0,0)
+	if len(other_trials)==0:
+		return good_flag
 
-	takeoff_r=np.deg2rad(takeoff[pol_ind])
-	sr_azimuth_r=np.deg2rad(sr_azimuth[pol_ind])
+	pol_ind=np.where(p_pol!=0)[0]
+	pol_weight=np.abs(p_pol[pol_ind])
+	xyz=ray_vectors(takeoff[pol_ind],sr_azimuth[pol_ind])
+
+	# For each reference trial, the distance (sine of the angle) of each reference ray to the nearest nodal plane of
+	# each mechanism, and the sine of the angle between each reference ray and the ray of each trial
+	plane_dist=[]
+	sin_angle=[]
+	for ref_trial in ref_trials:
+		p_b1=np.abs(np.tensordot(xyz[:,:,ref_trial],dir_cos_dict['b1'],axes=[[0],[0]]))
+		p_b3=np.abs(np.tensordot(xyz[:,:,ref_trial],dir_cos_dict['b3'],axes=[[0],[0]]))
+		plane_dist.append(np.minimum(p_b1,p_b3))
+		angle=np.arccos(np.clip(np.sum(xyz[:,:,[ref_trial]]*xyz,axis=0),-1,1))
+		sin_angle.append(np.where(angle<(np.pi/2),np.sin(angle)+1e-9,np.inf))
+
+	# Stage two: exact misfits of the other trials, each for its surviving mechanisms
+	for trial_x in other_trials:
+		lower_bound=-np.inf
+		upper_bound=np.inf
+		for ref_x in range(len(ref_trials)):
+			uncertain_weight=pol_weight@(plane_dist[ref_x]<=sin_angle[ref_x][:,[trial_x]])
+			lower_bound=np.maximum(lower_bound,fit_ref[ref_x]-uncertain_weight)
+			upper_bound=np.minimum(upper_bound,fit_ref[ref_x]+uncertain_weight)
+		max_qmissmax=max(upper_bound.min()+nextra,ntotal) # Largest possible misfit threshold of the trial
+		survivor_ind=np.where(lower_bound<=(max_qmissmax+1e-6))[0]
+
+		fit,afit=gridsearch_misfit(sr_azimuth[:,[trial_x]],takeoff[:,[trial_x]],p_pol,no_sp_amp,dir_cos_dict,
+							max_memory_mb=max_memory_mb,bitpacked_polarity=bitpacked_polarity,coor_ind=survivor_ind,misfit_fun=misfit_fun)
+		good_flag[survivor_ind]|=good_mech_flag(fit,None,nextra,ntotal,0,0)
+
+	return good_flag
+
+
+def ray_vectors(takeoff,sr_azimuth):
+	'''
+	Transforms takeoff angles and source-receiver azimuths (degrees) to cartesian ray vectors.
+	Input:
+		takeoff: takeoff angles, 2d array
+		sr_azimuth: source-receiver azimuths, 2d array
+	Output:
+		xyz: ray vectors, array of shape (3,n,nmc)
+	'''
+	takeoff_r=np.deg2rad(takeoff)
+	sr_azimuth_r=np.deg2rad(sr_azimuth)
 
 	xyz=np.zeros((3,takeoff_r.shape[0],takeoff_r.shape[1]))
 	xyz[0,:]=np.sin(takeoff_r)*np.cos(sr_azimuth_r)
 	xyz[1,:]=np.sin(takeoff_r)*np.sin(sr_azimuth_r)
 	xyz[2,:]=-np.cos(takeoff_r)
+	return xyz
 
-	p_b1=np.tensordot(xyz,dir_cos_dict['b1'],axes=[[0],[0]])
-	p_b3=np.tensordot(xyz,dir_cos_dict['b3'],axes=[[0],[0]])
+
+def polarity_misfit(xyz,p_pol,b1,b3):
+	'''
+	Computes the weighted P-polarity misfit of the trial mechanisms.
+	Input:
+		xyz: ray vectors of the polarity measurements, array of shape (3,n,nmc)
+		p_pol: nonzero polarity weights, 1d array
+		b1,b3: direction cosines of the trial mechanisms, arrays of shape (3,ncoor)
+	Output:
+		fit: weighted number of misfit polarities, array of shape (nmc,ncoor)
+	'''
+	p_b1=np.tensordot(xyz,b1,axes=[[0],[0]])
+	p_b3=np.tensordot(xyz,b3,axes=[[0],[0]])
 
 	# # Slower (but probably more comprehensible) implementation of the above
 	# p_b1=b1[0,:]*xyz[0,:,:,np.newaxis]+\
@@ -993,62 +1470,369 @@ def focal_gridsearch(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,nextra,ntotal,
 
 	prod=((p_b1<0)!=(p_b3<0)) # If True, predicted sign is negative. If False, predicted sign is positive
 
-	qmiss=(prod != (p_pol[pol_ind]<0)[:,np.newaxis,np.newaxis])*np.abs(p_pol[pol_ind])[:,np.newaxis,np.newaxis]
+	qmiss=(prod != (p_pol<0)[:,np.newaxis,np.newaxis])*np.abs(p_pol)[:,np.newaxis,np.newaxis]
 
-	fit=np.sum(qmiss,axis=0)
+	return np.sum(qmiss,axis=0)
 
-	# Calculates max misfit for each trial
-	qmissmax=fit.min(axis=1)+nextra
-	qmissmax[qmissmax<ntotal]=ntotal
 
-	sp_finite_ind=np.where(np.isfinite(sp_amp))[0]
-	qacount=len(sp_finite_ind)
-	if qacount>0:
-		takeoff_r=np.deg2rad(takeoff[sp_finite_ind])
-		sr_azimuth_r=np.deg2rad(sr_azimuth[sp_finite_ind])
+def pack_bits(flags):
+	'''
+	Packs boolean flags along the last axis into uint64 words (64 flags per word, little bit order).
+	Input:
+		flags: boolean array whose last axis has a length that is a multiple of 64
+	Output:
+		words: uint64 array of shape flags.shape[:-1]+(flags.shape[-1]//64,)
+	'''
+	if flags.shape[-1]%64:
+		raise ValueError('***Error in pack_bits: the length of the last axis must be a multiple of 64')
+	return np.packbits(flags,axis=-1,bitorder='little').view(np.uint64)
+
+
+def unpack_bits(words,num_flags):
+	'''
+	Unpacks the uint64 words created by pack_bits() into the first num_flags boolean flags of the last axis.
+	'''
+	return np.unpackbits(np.ascontiguousarray(words).view(np.uint8),axis=-1,count=num_flags,bitorder='little').astype(bool)
+
+
+def add_bit_sliced(counter_words,words):
+	'''
+	Adds one bit to the bit-sliced counters of each flag set in words. counter_words[l] holds bit l
+	of the counts, so that each counter is incremented with a ripple-carry of bitwise operations.
+	Input:
+		counter_words: uint64 array of shape (num_bits,)+words.shape, updated in place
+		words: uint64 array
+	'''
+	carry=words
+	for bit_x in range(counter_words.shape[0]):
+		next_carry=counter_words[bit_x]&carry
+		counter_words[bit_x]^=carry
+		if not(next_carry.any()):
+			break
+		carry=next_carry
+
+
+def polarity_misfit_bitpacked(xyz,p_pol,b1,b3,max_weight_planes=8):
+	'''
+	Computes the weighted P-polarity misfit of the trial mechanisms like polarity_misfit(), but for each
+	polarity the predicted signs of the test mechanisms are packed into uint64 words (64 mechanisms per word).
+	The words are XORed with the observed sign, and the misfits are accumulated in bit-sliced counters,
+	with a separate set of counters for each distinct polarity weight. The floating point temporaries
+	only cover one polarity at a time, so the memory use is roughly (2*8 bytes)*nmc*ncoor rather than
+	scaling with the number of polarities.
+
+	For unweighted polarities (or weights that are powers of two), the results are identical to
+	polarity_misfit(). For other weights, the misfits may differ in the last floating point digit
+	because the weights are summed in a different order.
+
+	If there are more than max_weight_planes distinct weights, polarity_misfit() is used instead.
+	Input:
+		xyz: ray vectors of the polarity measurements, array of shape (3,n,nmc)
+		p_pol: nonzero polarity weights, 1d array
+		b1,b3: direction cosines of the trial mechanisms, arrays of shape (3,ncoor)
+		max_weight_planes: maximum number of distinct polarity weights
+	Output:
+		fit: weighted number of misfit polarities, array of shape (nmc,ncoor)
+	'''
+	weights,weight_ind=np.unique(np.abs(p_pol),return_inverse=True)
+	if len(weights)>max_weight_planes:
+		return polarity_misfit(xyz,p_pol,b1,b3)
+
+	nmc=xyz.shape[2]
+	ncoor=b1.shape[1]
+
+	# Pads the test mechanisms to a multiple of 64. The padded mechanisms are discarded at the end.
+	ncoor_pad=-(-ncoor//64)*64
+	if ncoor_pad>ncoor:
+		b1=np.concatenate((b1,np.zeros((3,ncoor_pad-ncoor))),axis=1)
+		b3=np.concatenate((b3,np.zeros((3,ncoor_pad-ncoor))),axis=1)
+
+	num_bits=max(1,int(np.bincount(weight_ind).max()).bit_length())
+	counter_words=np.zeros((len(weights),num_bits,nmc,ncoor_pad//64),dtype=np.uint64)
+	for pol_x in range(len(p_pol)):
+		p_b1=np.dot(xyz[:,pol_x,:].T,b1)
+		p_b3=np.dot(xyz[:,pol_x,:].T,b3)
+
+		# Bits are set where the predicted sign disagrees with the observed sign
+		miss_words=pack_bits((p_b1<0)!=(p_b3<0))
+		if p_pol[pol_x]<0:
+			miss_words=~miss_words
+		add_bit_sliced(counter_words[weight_ind[pol_x]],miss_words)
+
+	fit=np.zeros((nmc,ncoor))
+	for weight_x,weight in enumerate(weights):
+		counts=np.zeros((nmc,ncoor),dtype=np.int32)
+		for bit_x in range(num_bits):
+			counts+=unpack_bits(counter_words[weight_x,bit_x],ncoor).astype(np.int32)<<bit_x
+		fit+=counts*weight
+	return fit
+
+
+def sp_misfit(xyz,sp_amp,b1,b2,b3,dir_cos_dict):
+	'''
+	Computes the S/P ratio misfit of the trial mechanisms.
+	Input:
+		xyz: ray vectors of the S/P measurements, array of shape (3,n,nmc)
+		sp_amp: finite log10 S/P ratios, 1d array
+		b1,b2,b3: direction cosines of the trial mechanisms, arrays of shape (3,ncoor)
+		dir_cos_dict: coordinate transformation dictionary, produced by dir_cos_setup()
+	Output:
+		afit: sum of the absolute log10 S/P misfits, array of shape (nmc,ncoor)
+	'''
+	sp_rat=sp_ratio(xyz,b1,b2,b3,dir_cos_dict)
+
+	qamiss=np.abs(sp_amp[:,np.newaxis,np.newaxis]-sp_rat)
+	return np.sum(qamiss,axis=0)
+
+
+def sp_ratio(xyz,b1,b2,b3,dir_cos_dict):
+	'''
+	Computes the predicted log10 S/P ratios of the trial mechanisms.
+	Input:
+		xyz: ray vectors, array of shape (3,n,nmc)
+		b1,b2,b3: direction cosines of the trial mechanisms, arrays of shape (3,ncoor)
+		dir_cos_dict: coordinate transformation dictionary, produced by dir_cos_setup()
+	Output:
+		sp_rat: predicted log10 S/P ratios, array of shape (n,nmc,ncoor)
+	'''
+	ntab=180
+	astep=1/ntab
+
+	p_b3=np.tensordot(xyz,b3,axes=[[0],[0]])
+
+	p_proj1=xyz[0,:,:,np.newaxis]-(p_b3*b3[0,:])
+	p_proj2=xyz[1,:,:,np.newaxis]-(p_b3*b3[1,:])
+	p_proj3=xyz[2,:,:,np.newaxis]-(p_b3*b3[2,:])
+
+	plen=np.sqrt(p_proj1**2+p_proj2**2+p_proj3**2)
+	p_proj1=p_proj1/plen
+	p_proj2=p_proj2/plen
+	p_proj3=p_proj3/plen
+
+	pp_b1=b1[0,:]*p_proj1+b1[1,:]*p_proj2+b1[2,:]*p_proj3
+	pp_b2=b2[0,:]*p_proj1+b2[1,:]*p_proj2+b2[2,:]*p_proj3
+	i=np.round((p_b3+1.)/astep).astype(int)
+
+	theta=dir_cos_dict['thetable'][i]
+	i=np.round((pp_b2+1.)/astep).astype(int)
+	j=np.round((pp_b1+1.)/astep).astype(int)
+	phi=dir_cos_dict['phitable'][i,j]
+
+	i=np.round(phi/(np.pi*astep)).astype(int)
+	i[i>(2*ntab-1)]=0
+	j=np.round(theta/(np.pi*astep)).astype(int)
+	j[j>(ntab-1)]=0
+
+	p_amp=dir_cos_dict['amptable'][0,j,i]
+	s_amp=dir_cos_dict['amptable'][1,j,i]
+
+	sp_rat=np.zeros(p_amp.shape)
+	sp_rat[p_amp==0]=4.0
+	sp_rat[s_amp==0]=-2.0
+	nonzero_flag=((p_amp!=0) & (s_amp!=0))
+	sp_rat[nonzero_flag]=np.log10(4.9*s_amp[nonzero_flag]/p_amp[nonzero_flag])
+	return sp_rat
+
+
+def gridsearch_memory_estimate(num_pol,num_sp,nmc,ncoor,bitpacked_polarity=False):
+	'''
+	Approximates the peak memory (bytes) of the temporary arrays created by an untiled grid search.
+	Input:
+		num_pol: number of nonzero P-polarities
+		num_sp: number of finite S/P ratios
+		nmc: number of trials
+		ncoor: number of test mechanisms
+		bitpacked_polarity: if True, considers the memory use of polarity_misfit_bitpacked()
+	Output:
+		approximate number of bytes
+	'''
+	# Approximate number of bytes used per (measurement,trial,mechanism) element
+	pol_element_bytes=32
+	sp_element_bytes=200
+	if bitpacked_polarity: # Only one polarity is expanded at a time, plus the misfit counts and output
+		pol_bytes=pol_element_bytes+16
+	else:
+		pol_bytes=num_pol*pol_element_bytes
+	return (pol_bytes+num_sp*sp_element_bytes)*nmc*ncoor
 
-		xyz=np.zeros((3,takeoff_r.shape[0],takeoff_r.shape[1]))
-		xyz[0,:]=np.sin(takeoff_r)*np.cos(sr_azimuth_r)
-		xyz[1,:]=np.sin(takeoff_r)*np.sin(sr_azimuth_r)
-		xyz[2,:]=-np.cos(takeoff_r)
 
-		p_b3=np.tensordot(xyz,dir_cos_dict['b3'],axes=[[0],[0]])
+def gridsearch_tile_size(num_pol,num_sp,nmc,ncoor,max_memory_mb,bitpacked_polarity=False):
+	'''
+	Determines the number of trials and test mechanisms to consider at once so that
+	the temporary arrays of the grid search use at most roughly max_memory_mb.
+	Input:
+		num_pol: number of nonzero P-polarities
+		num_sp: number of finite S/P ratios
+		nmc: number of trials
+		ncoor: number of test mechanisms
+		max_memory_mb: memory budget (MB). If <=0, no tiling is done.
+		bitpacked_polarity: if True, considers the memory use of polarity_misfit_bitpacked()
+	Output:
+		trial_step: number of trials per tile
+		coor_step: number of test mechanisms per tile
+	'''
+	if max_memory_mb<=0:
+		return nmc,ncoor
+	pair_bytes=gridsearch_memory_estimate(num_pol,num_sp,1,1,bitpacked_polarity=bitpacked_polarity)
+	if pair_bytes==0:
+		return nmc,ncoor
+	max_pairs=int(max_memory_mb*1e6/pair_bytes)
+	if max_pairs>=nmc*ncoor:
+		return nmc,ncoor
+
+	# Tiles over the test mechanisms first. Only tiles over the trials when the tiles would become tiny.
+	min_coor_step=min(ncoor,256)
+	if max_pairs>=nmc*min_coor_step:
+		return nmc,max_pairs//nmc
+	return max(1,max_pairs//min_coor_step),min_coor_step
+
+
+def gridsearch_misfit(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,max_memory_mb=0,bitpacked_polarity=False,coor_ind=None,misfit_fun=None,num_threads=1):
+	'''
+	Computes the polarity and S/P misfits for every trial and test mechanism.
+	If max_memory_mb>0, the misfits are accumulated over tiles of test mechanisms (and trials,
+	if needed) to bound the memory use. If num_threads>1, the test mechanisms are split into tiles
+	computed by a pool of threads (NumPy releases the GIL), which share max_memory_mb.
+	The results are identical to the untiled computation.
+	Input:
+		sr_azimuth: source-receiver azimuths, 2d array
+		takeoff: takeoff angles, 2d array
+		p_pol: polarity weights, 1d array
+		sp_amp: log10 S/P ratios, 1d array
+		dir_cos_dict: coordinate transformation dictionary, produced by dir_cos_setup()
+		max_memory_mb: memory budget (MB) for the temporary arrays. If <=0, no tiling is done.
+		bitpacked_polarity: if True, the polarity misfits are computed using polarity_misfit_bitpacked()
+		coor_ind: indices of the test mechanisms to consider. If None, all test mechanisms are considered.
+		misfit_fun: if provided, a function that computes both misfits, called as
+			misfit_fun(xyz_pol,p_pol,xyz_sp,sp_amp,b1,b2,b3,dir_cos_dict) and returning (fit,afit).
+			Used by the compiled grid search backends (functions/gridsearch_backends.py). If max_memory_mb>0,
+			it is called on each tile.
+		num_threads: number of threads computing the tiles. Not used with misfit_fun.
+	Output:
+		fit: weighted polarity misfits, array of shape (nmc,ncoor)
+		afit: S/P misfits, array of shape (nmc,ncoor). None if there are no S/P ratios.
+	'''
+	if coor_ind is not None:
+		dir_cos_dict=dict(dir_cos_dict,b1=dir_cos_dict['b1'][:,coor_ind],b2=dir_cos_dict['b2'][:,coor_ind],b3=dir_cos_dict['b3'][:,coor_ind])
+
+	if bitpacked_polarity:
+		pol_misfit_fun=polarity_misfit_bitpacked
+	else:
+		pol_misfit_fun=polarity_misfit
+
+	nmc=takeoff.shape[1]
+	ncoor=dir_cos_dict['b1'].shape[1]
+
+	pol_ind=np.where(p_pol!=0)[0]
+	xyz_pol=ray_vectors(takeoff[pol_ind],sr_azimuth[pol_ind])
 
-		p_proj1=xyz[0,:,:,np.newaxis]-(p_b3*dir_cos_dict['b3'][0,:])
-		p_proj2=xyz[1,:,:,np.newaxis]-(p_b3*dir_cos_dict['b3'][1,:])
-		p_proj3=xyz[2,:,:,np.newaxis]-(p_b3*dir_cos_dict['b3'][2,:])
+	sp_finite_ind=np.where(np.isfinite(sp_amp))[0]
+	if len(sp_finite_ind)>0:
+		xyz_sp=ray_vectors(takeoff[sp_finite_ind],sr_azimuth[sp_finite_ind])
+
+	if misfit_fun is not None:
+		trial_step,coor_step=gridsearch_tile_size(len(pol_ind),len(sp_finite_ind),nmc,ncoor,max_memory_mb)
+		if (trial_step>=nmc) & (coor_step>=ncoor):
+			return misfit_fun(xyz_pol,p_pol[pol_ind],xyz_sp if len(sp_finite_ind)>0 else None,sp_amp[sp_finite_ind],
+								dir_cos_dict['b1'],dir_cos_dict['b2'],dir_cos_dict['b3'],dir_cos_dict)
+		fit=np.zeros((nmc,ncoor))
+		afit=None
+		if len(sp_finite_ind)>0:
+			afit=np.zeros((nmc,ncoor))
+		for trial_start in range(0,nmc,trial_step):
+			trial_slice=slice(trial_start,trial_start+trial_step)
+			for coor_start in range(0,ncoor,coor_step):
+				coor_slice=slice(coor_start,coor_start+coor_step)
+				tile_fit,tile_afit=misfit_fun(xyz_pol[:,:,trial_slice],p_pol[pol_ind],xyz_sp[:,:,trial_slice] if len(sp_finite_ind)>0 else None,sp_amp[sp_finite_ind],
+											dir_cos_dict['b1'][:,coor_slice],dir_cos_dict['b2'][:,coor_slice],dir_cos_dict['b3'][:,coor_slice],dir_cos_dict)
+				fit[trial_slice,coor_slice]=tile_fit
+				if afit is not None:
+					afit[trial_slice,coor_slice]=tile_afit
+		return fit,afit
+
+	if num_threads>1: # The threads compute their tiles at the same time, so they share the memory budget
+		trial_step,coor_step=gridsearch_tile_size(len(pol_ind),len(sp_finite_ind),nmc,ncoor,max_memory_mb/num_threads,bitpacked_polarity=bitpacked_polarity)
+		coor_step=min(coor_step,-(-ncoor//num_threads))
+	else:
+		trial_step,coor_step=gridsearch_tile_size(len(pol_ind),len(sp_finite_ind),nmc,ncoor,max_memory_mb,bitpacked_polarity=bitpacked_polarity)
+	if (trial_step>=nmc) & (coor_step>=ncoor):
+		fit=pol_misfit_fun(xyz_pol,p_pol[pol_ind],dir_cos_dict['b1'],dir_cos_dict['b3'])
+		afit=None
+		if len(sp_finite_ind)>0:
+			afit=sp_misfit(xyz_sp,sp_amp[sp_finite_ind],dir_cos_dict['b1'],dir_cos_dict['b2'],dir_cos_dict['b3'],dir_cos_dict)
+		return fit,afit
+
+	fit=np.zeros((nmc,ncoor))
+	afit=None
+	if len(sp_finite_ind)>0:
+		afit=np.zeros((nmc,ncoor))
+
+	def compute_tile(tile):
+		trial_slice,coor_slice=tile
+		b1=dir_cos_dict['b1'][:,coor_slice]
+		b3=dir_cos_dict['b3'][:,coor_slice]
+		fit[trial_slice,coor_slice]=pol_misfit_fun(xyz_pol[:,:,trial_slice],p_pol[pol_ind],b1,b3)
+		if len(sp_finite_ind)>0:
+			b2=dir_cos_dict['b2'][:,coor_slice]
+			afit[trial_slice,coor_slice]=sp_misfit(xyz_sp[:,:,trial_slice],sp_amp[sp_finite_ind],b1,b2,b3,dir_cos_dict)
+
+	tiles=[(slice(trial_start,trial_start+trial_step),slice(coor_start,coor_start+coor_step))
+			for trial_start in range(0,nmc,trial_step) for coor_start in range(0,ncoor,coor_step)]
+	if num_threads>1:
+		list(get_thread_pool(num_threads).map(compute_tile,tiles))
+	else:
+		for tile in tiles:
+			compute_tile(tile)
+	return fit,afit
 
-		plen=np.sqrt(p_proj1**2+p_proj2**2+p_proj3**2)
-		p_proj1=p_proj1/plen
-		p_proj2=p_proj2/plen
-		p_proj3=p_proj3/plen
 
-		pp_b1=dir_cos_dict['b1'][0,:]*p_proj1+dir_cos_dict['b1'][1,:]*p_proj2+dir_cos_dict['b1'][2,:]*p_proj3
-		pp_b2=dir_cos_dict['b2'][0,:]*p_proj1+dir_cos_dict['b2'][1,:]*p_proj2+dir_cos_dict['b2'][2,:]*p_proj3
-		i=np.round((p_b3+1.)/astep).astype(int)
+def get_thread_pool(num_threads):
+	'''
+	Returns a pool of num_threads threads, created the first time it is requested (in each process).
+	'''
+	if not(num_threads in thread_pools):
+		thread_pools[num_threads]=concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+	return thread_pools[num_threads]
 
-		theta=dir_cos_dict['thetable'][i]
-		i=np.round((pp_b2+1.)/astep).astype(int)
-		j=np.round((pp_b1+1.)/astep).astype(int)
-		phi=dir_cos_dict['phitable'][i,j]
 
-		i=np.round(phi/(np.pi*astep)).astype(int)
-		i[i>(2*ntab-1)]=0
-		j=np.round(theta/(np.pi*astep)).astype(int)
-		j[j>(ntab-1)]=0
+def select_mechs(fit,afit,nextra,ntotal,qextra,qtotal,maxout,min_ratio_trial_solutions=0.5,min_num_sp_solutions=10):
+	'''
+	Given the polarity and S/P misfits, determines the indices of the acceptable test mechanisms.
+	If more than maxout mechanisms are acceptable, maxout of them are randomly selected.
+	Input: see good_mech_flag()
+		maxout: maximum number of fault planes to return
+	Output:
+		good_fp_ind: indices of the acceptable test mechanisms
+	'''
+	good_fp_ind=np.where(good_mech_flag(fit,afit,nextra,ntotal,qextra,qtotal,
+							min_ratio_trial_solutions=min_ratio_trial_solutions,min_num_sp_solutions=min_num_sp_solutions))[0]
 
-		p_amp=dir_cos_dict['amptable'][0,j,i]
-		s_amp=dir_cos_dict['amptable'][1,j,i]
+	if len(good_fp_ind)>maxout: # If more than maxout solutions meet criteria, randomly select maxout solutions
+		good_fp_ind=rng.choice(good_fp_ind,maxout,replace=False)
 
-		sp_rat=np.zeros(p_amp.shape)
-		sp_rat[p_amp==0]=4.0
-		sp_rat[s_amp==0]=-2.0
-		nonzero_flag=((p_amp!=0) & (s_amp!=0))
-		sp_rat[nonzero_flag]=np.log10(4.9*s_amp[nonzero_flag]/p_amp[nonzero_flag])
+	return good_fp_ind
 
-		qamiss=np.abs(sp_amp[sp_finite_ind][:,np.newaxis,np.newaxis]-sp_rat)
-		afit=np.sum(qamiss,axis=0)
 
+def good_mech_flag(fit,afit,nextra,ntotal,qextra,qtotal,min_ratio_trial_solutions=0.5,min_num_sp_solutions=10):
+	'''
+	Given the polarity and S/P misfits, determines which test mechanisms are acceptable in any trial.
+	Input:
+		fit: weighted polarity misfits, array of shape (nmc,ncoor)
+		afit: S/P misfits, array of shape (nmc,ncoor). None if there are no S/P ratios.
+		nextra: number of polarity additional misfits allowed above minimum
+		ntotal: total number of allowed polarity misfits
+		qextra: additional amplitude misfit allowed above minimum
+		qtotal: total allowed amplitude misfit
+		min_ratio_trial_solutions: minimum ratio of trial solutions from polarities before criteria loosened
+		min_num_sp_solutions: minimum ratio of trial solutions from S/P ratios before criteria loosened
+	Output:
+		good_flag: boolean array of shape (ncoor), True for the acceptable test mechanisms
+	'''
+	# Calculates max misfit for each trial
+	qmissmax=fit.min(axis=1)+nextra
+	qmissmax[qmissmax<ntotal]=ntotal
+
+	if afit is not None:
 		# Calculates max misfit for each trial
 		qamissmax=afit.min(axis=1)+qextra
 		qamissmax[qamissmax<qtotal]=qtotal
@@ -1067,19 +1851,11 @@ def focal_gridsearch(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,nextra,ntotal,
 			qamissmax=qmis0min+nextra
 			qamissmax[qamissmax<qtotal]=qtotal
 			goodmech_flag=( (fit<=qmissmax[:,np.newaxis]) & (afit<=qamissmax[:,np.newaxis]) )
-			good_fp_ind=np.where(np.any(goodmech_flag,axis=0))[0]
 
 	else:
 		goodmech_flag=( (fit<=qmissmax[:,np.newaxis]) )
-		good_fp_ind=np.where(np.any(goodmech_flag,axis=0))[0]
 
-	if len(good_fp_ind)>maxout: # If more than maxout solutions meet criteria, randomly select maxout solutions
-		good_fp_ind=rng.choice(good_fp_ind,maxout,replace=False)
-
-	faultnorms_all=np.vstack((dir_cos_dict['b3'][0,good_fp_ind],dir_cos_dict['b3'][1,good_fp_ind],dir_cos_dict['b3'][2,good_fp_ind]))
-	faultslips_all=np.vstack((dir_cos_dict['b1'][0,good_fp_ind],dir_cos_dict['b1'][1,good_fp_ind],dir_cos_dict['b1'][2,good_fp_ind]))
-
-	return faultnorms_all,faultslips_all
+	return np.any(goodmech_flag,axis=0)
 
 
 def determine_max_gap(in_azimuth_deg,in_takeoff_deg):
@@ -1277,6 +2053,93 @@ def calculate_misfit(p_azi_mc,p_the_mc,p_pol,sp_amp,str_avg,dip_avg,rak_avg):
 	return mfrac,mavg,stdr,pol_agreement_out,sp_diff_out
 
 
+def lookup_table_cache_path(vmodel_depthvp,deptab,delttab,p_dict):
+	'''
+	Determines the path of a cached lookup table. The filename is a hash of the velocity model
+	contents and of the parameters used to create the table, so that a table is only reused
+	when it would be identical.
+	Input:
+		vmodel_depthvp: velocity model, array of depth (km) and vp (km/s), after QC
+		deptab: array of depths (km)
+		delttab: array of distances (km)
+		p_dict: Parameter values created in SKHASH.py, dictionary
+	Output:
+		path: path of the cached lookup table (.npy)
+	'''
+	key_params={'version':1,'vmodel_depthvp':np.asarray(vmodel_depthvp,dtype=float).tolist(),
+				'deptab':np.asarray(deptab,dtype=float).tolist(),'delttab':np.asarray(delttab,dtype=float).tolist(),
+				'nump':int(p_dict['nump']),'nx0':int(p_dict['nx0']),'nd0':int(p_dict['nd0']),
+				'takeoff_precision':int(p_dict['output_angle_precision'])}
+	return os.path.join(p_dict['lookup_table_cache_dir'],'lookup_{}.npy'.format(cache.cache_key(key_params)[:32]))
+
+
+def adaptive_knots(samples,lower,upper,num_knots,uniform_weight=0.25,num_bins=4096):
+	'''
+	Places knots on an interval, dense where samples fall. The knots are the quantiles of a mixture of the
+	distribution of the samples and a uniform distribution, so that the whole interval is covered. Each sample
+	is spread over +/-(upper-lower)/num_knots, so that clustered samples do not collapse the knots.
+	Input:
+		samples: values to resolve, 1d array. Values outside of the interval are moved to its edges.
+		lower,upper: interval
+		num_knots: number of knots
+		uniform_weight: weight of the uniform distribution in the mixture, >0 and <=1
+		num_bins: number of bins used to estimate the distribution of the samples
+	Output:
+		knots: increasing knots (rounded to 0.001), starting at lower and ending at upper, 1d array.
+			Knots that are identical once rounded are merged, so there may be fewer than num_knots.
+	'''
+	bin_edges=np.linspace(lower,upper,num_bins+1)
+	density=np.full(num_bins,uniform_weight/num_bins)
+	if len(samples):
+		counts=np.histogram(np.clip(samples,lower,upper),bins=bin_edges)[0]
+		half_width=max(1,int(round(num_bins/num_knots)))
+		counts=np.convolve(counts,np.ones(2*half_width+1),mode='same')
+		density+=(1-uniform_weight)*counts/counts.sum()
+	cdf=np.concatenate(([0],np.cumsum(density)))
+
+	knots=np.unique(np.round(np.interp(np.linspace(0,cdf[-1],num_knots),cdf,bin_edges),3))
+	knots[0]=lower
+	knots[-1]=upper
+	return knots
+
+
+def adaptive_lookup_grid(pol_df,p_dict):
+	'''
+	Determines the depth and distance knots of the lookup table when lookup_grid='adaptive'. The knots are
+	dense where the hypocenters and source-station distances (+/-2 standard deviations of their uncertainties)
+	of the measurements fall, within the look_dep and look_del ranges (see adaptive_knots()).
+	Input:
+		pol_df: polarity dataframe, with the origin_depth_km, vert_uncert_km, sr_dist_km, and horz_uncert_km columns
+		p_dict: Parameter values created in SKHASH.py, dictionary
+	Output:
+		p_dict: p_dict, with lookup_dep_knots and lookup_del_knots (unless provided by the user), nd0, and nx0 set.
+	'''
+	sigma=np.array([-2,-1,0,1,2])
+	if not(p_dict['lookup_dep_knots']):
+		dep_samples=(pol_df['origin_depth_km'].values[:,np.newaxis]+pol_df['vert_uncert_km'].values[:,np.newaxis]*sigma).flatten()
+		p_dict['lookup_dep_knots']=adaptive_knots(dep_samples,p_dict['look_dep'][0],p_dict['look_dep'][1],p_dict['lookup_num_knots'][0]).tolist()
+	if not(p_dict['lookup_del_knots']):
+		del_samples=(pol_df['sr_dist_km'].values[:,np.newaxis]+pol_df['horz_uncert_km'].values[:,np.newaxis]*sigma).flatten()
+		p_dict['lookup_del_knots']=adaptive_knots(del_samples,p_dict['look_del'][0],p_dict['look_del'][1],p_dict['lookup_num_knots'][1]).tolist()
+	p_dict['nd0']=len(p_dict['lookup_dep_knots'])
+	p_dict['nx0']=len(p_dict['lookup_del_knots'])
+	print('Adaptive lookup table: {} depth knots ({}-{} km), {} distance knots ({}-{} km)'.format(p_dict['nd0'],p_dict['lookup_dep_knots'][0],p_dict['lookup_dep_knots'][-1],
+			p_dict['nx0'],p_dict['lookup_del_knots'][0],p_dict['lookup_del_knots'][-1]))
+	return p_dict
+
+
+def lookup_table_task(task_args):
+	'''
+	Creates the lookup table of a velocity model. Used by create_lookup_table() to create tables in parallel.
+	Input:
+		task_args: tuple of the velocity model index, followed by the inputs of create_takeoff_table()
+	Output:
+		vmodel_ind: velocity model index
+		table: lookup table of takeoff angles
+	'''
+	return task_args[0],create_takeoff_table(*task_args[1:])
+
+
 def create_lookup_table(p_dict):
 	'''
 	Reads in the velocity model inputs, does minor QCing, and creates lookup table (if necessary).
@@ -1287,25 +2150,36 @@ def create_lookup_table(p_dict):
 			depth(km) vp(km/s)
 		p_dict['look_dep']: list of: minimum source depth, maximum, and interval for the lookup table
 		p_dict['look_del']: list of: minimum source-station distance, maximum, and interval for the lookup table
+		p_dict['lookup_grid']: if 'adaptive', the depths and distances are p_dict['lookup_dep_knots'] and p_dict['lookup_del_knots'] (see adaptive_lookup_grid())
 		p_dict['nump']: number of rays traced
 		p_dict['nx0']: maximum source-station distance (km) bins for look-up tables
 		p_dict['nd0']: maximum source depth (km) bins for look-up tables
 		p_dict['output_angle_precision']: Number of decimal places to output for take off angles
 		p_dict['recompute_lookup_table']: a boolean. If True, the lookup tables will be recomputed, even if a matching lookup table exists.
 		p_dict['write_lookup_table']: a boolean. If True, the lookup table will be written to the disk. A '.npz' file suffix will be added to the path.
+		p_dict['lookup_table_cache_dir']: if provided, the lookup tables are cached in this folder, keyed by the velocity model contents and
+			the parameters above (see lookup_table_cache_path()). Cached tables are reused regardless of recompute_lookup_table.
+		p_dict['lookup_table_cache_max_mb']: maximum size (MB) of the cached lookup tables. The least recently used tables are removed.
+		p_dict['num_cpus']: number of processes used to create the lookup tables of several velocity models
 	Output:
 		deptab: array of depths (km)
 		delttab: array of distances (km)
 		table: Lookup table (array)
 	'''
 
-	deptab=np.arange(p_dict['look_dep'][0],p_dict['look_dep'][1]+p_dict['look_dep'][2],p_dict['look_dep'][2]) # array of depths (km)
-	delttab=np.arange(p_dict['look_del'][0],p_dict['look_del'][1]+p_dict['look_del'][2],p_dict['look_del'][2]) # array of distances (km)
+	if p_dict['lookup_grid']=='adaptive':
+		deptab=np.asarray(p_dict['lookup_dep_knots'],dtype=float) # array of depths (km)
+		delttab=np.asarray(p_dict['lookup_del_knots'],dtype=float) # array of distances (km)
+	else:
+		deptab=np.arange(p_dict['look_dep'][0],p_dict['look_dep'][1]+p_dict['look_dep'][2],p_dict['look_dep'][2]) # array of depths (km)
+		delttab=np.arange(p_dict['look_del'][0],p_dict['look_del'][1]+p_dict['look_del'][2],p_dict['look_del'][2]) # array of distances (km)
 
 	if (p_dict['recompute_lookup_table']==False) or (p_dict['write_lookup_table']):
 		lookup_table_params=np.asarray([p_dict['nump'],p_dict['nx0'],p_dict['nd0'],p_dict['output_angle_precision']])
 
+	vmodel_list=[]
 	table_list=[]
+	table_cache_paths=[]
 	for vmodel_ind,vmodel_path in enumerate(p_dict['vmodel_paths']):
 		lookup_vmodel_path=vmodel_path+'.lookup.npz'
 		vmodel_depthvp=pd.read_csv(vmodel_path,names=['depth','vp_km_s'],sep=',',comment='#').values
@@ -1328,37 +2202,75 @@ def create_lookup_table(p_dict):
 		if len(drop_constant_vel_ind)>0:
 			vmodel_depthvp=np.delete(vmodel_depthvp,drop_constant_vel_ind,axis=0)
 
-		compute_lookup_table=True
-		if os.path.exists(lookup_vmodel_path) & (p_dict['recompute_lookup_table']==False):
+		table=None
+		table_cache_path=''
+		if p_dict['lookup_table_cache_dir']:
+			table_cache_path=lookup_table_cache_path(vmodel_depthvp,deptab,delttab,p_dict)
+			table=cache.load_array(table_cache_path)
+			if table is not None:
+				print('Loaded cached lookup table ({}/{}): {}'.format(vmodel_ind,len(p_dict['vmodel_paths'])-1,table_cache_path))
+
+		if (table is None) & os.path.exists(lookup_vmodel_path) & (p_dict['recompute_lookup_table']==False):
 			print('Loading precomputed lookup table ({}/{}): {}'.format(vmodel_ind,len(p_dict['vmodel_paths'])-1,lookup_vmodel_path))
+			tmp_lookup=None
 			try:
 				tmp_lookup=np.load(lookup_vmodel_path)
-			except:
+			except Exception:
 				print('\tError loading lookup table. Recomputing.')
 
 			# Ensures the lookup table .npz file contains the expected variable names
-			if tmp_lookup.files==['table', 'lookup_table_params', deptab, delttab]:
-				# Ensures that the parameters used to create the lookup table are identical to the current parameters.
+			if tmp_lookup is None:
+				pass
+			elif sorted(tmp_lookup.files)==sorted(['table','lookup_table_params','deptab','delttab','vmodel_depthvp']):
+				# Ensures that the velocity model and the parameters used to create the lookup table are identical to the current ones.
 				if np.array_equal(tmp_lookup['lookup_table_params'],lookup_table_params) &\
-					np.array_equal(tmp_lookup[deptab],deptab) &\
-					np.array_equal(tmp_lookup[delttab],delttab):
+					np.array_equal(tmp_lookup['deptab'],deptab) &\
+					np.array_equal(tmp_lookup['delttab'],delttab) &\
+					np.array_equal(tmp_lookup['vmodel_depthvp'],vmodel_depthvp):
 					table=tmp_lookup['table']
-					compute_lookup_table=False
 					print('\tLoad successful.')
 				else:
-					print('\tThe parameters used to create the lookup table differ from your current set parameters. Recomputing lookup table.')
+					print('\tThe velocity model or the parameters used to create the lookup table differ from your current set parameters. Recomputing lookup table.')
 			else:
 				print('\tIssue with interpreting previously saved lookup table. Recomputing lookup table.')
 
-		if compute_lookup_table:
-			print('Creating lookup table ({}/{}): {}'.format(vmodel_ind,len(p_dict['vmodel_paths'])-1,vmodel_path))
-			table=create_takeoff_table(vmodel_depthvp,deptab,delttab,p_dict['nump'],p_dict['nx0'],p_dict['nd0'],p_dict['output_angle_precision'])
+		vmodel_list.append(vmodel_depthvp)
+		table_list.append(table)
+		table_cache_paths.append(table_cache_path)
+
+	# Creates the missing lookup tables. If several are needed, they are created in parallel.
+	compute_inds=[vmodel_ind for vmodel_ind,table in enumerate(table_list) if table is None]
+	task_args=[(vmodel_ind,vmodel_list[vmodel_ind],deptab,delttab,p_dict['nump'],p_dict['nx0'],p_dict['nd0'],p_dict['output_angle_precision'])
+				for vmodel_ind in compute_inds]
+	num_processes=min(p_dict['num_cpus'],len(compute_inds))
+	if num_processes>1:
+		print('Creating {} lookup tables using {} processes...'.format(len(compute_inds),num_processes),flush=True)
+		with multiprocessing.Pool(processes=num_processes) as pool:
+			for num_created,(vmodel_ind,table) in enumerate(pool.imap_unordered(lookup_table_task,task_args),1):
+				table_list[vmodel_ind]=table
+				print('\tCreated lookup table ({}/{}): {}'.format(num_created,len(compute_inds),p_dict['vmodel_paths'][vmodel_ind]),flush=True)
+	else:
+		for tmp_task_args in task_args:
+			vmodel_ind=tmp_task_args[0]
+			print('Creating lookup table ({}/{}): {}'.format(vmodel_ind,len(p_dict['vmodel_paths'])-1,p_dict['vmodel_paths'][vmodel_ind]))
+			table_list[vmodel_ind]=lookup_table_task(tmp_task_args)[1]
 			print('\tCreated table.')
 
-			if p_dict['write_lookup_table']:
-				np.savez(lookup_vmodel_path,table=table,lookup_table_params=lookup_table_params,deptab=deptab,delttab=delttab)
-				print('\tSaved lookup table: {}'.format(lookup_vmodel_path))
-		table_list.append(table)
+	for vmodel_ind in compute_inds:
+		if p_dict['write_lookup_table']:
+			lookup_vmodel_path=p_dict['vmodel_paths'][vmodel_ind]+'.lookup.npz'
+			np.savez(lookup_vmodel_path,table=table_list[vmodel_ind],lookup_table_params=lookup_table_params,deptab=deptab,delttab=delttab,vmodel_depthvp=vmodel_list[vmodel_ind])
+			print('\tSaved lookup table: {}'.format(lookup_vmodel_path))
+		if table_cache_paths[vmodel_ind]:
+			cache.save_array(table_cache_paths[vmodel_ind],table_list[vmodel_ind])
+			print('\tCached lookup table: {}'.format(table_cache_paths[vmodel_ind]))
+
+	# Removes the least recently used cached tables, except those of this run
+	if compute_inds and p_dict['lookup_table_cache_dir']:
+		table_mb=sum([table_list[vmodel_ind].nbytes for vmodel_ind in range(len(table_list))])/1e6
+		if table_mb>p_dict['lookup_table_cache_max_mb']:
+			print('*WARNING: The lookup tables of this run ({:.3g} MB) exceed the lookup table cache budget (lookup_table_cache_max_mb={}). They are kept in the cache, but older tables are removed.'.format(table_mb,p_dict['lookup_table_cache_max_mb']))
+		cache.evict_lru(p_dict['lookup_table_cache_dir'],p_dict['lookup_table_cache_max_mb'],prefix='lookup_',keep_paths=table_cache_paths)
 	table=np.dstack(table_list)
 
 	return {'deptab':deptab,'delttab':delttab,'table':table}
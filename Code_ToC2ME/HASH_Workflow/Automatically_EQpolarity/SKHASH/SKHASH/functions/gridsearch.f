@@ -41,22 +41,22 @@ C    Modifications made by Skoumal.
 C    Last modified Feb 2023
 
 C ntab = of tables
-C npick0 = maximum number of picks per event
-C nmc0 = maximum number of trials of location/take-off angles
 C nmax0 = maximum number of acceptable mechanisms output
 C ncoor = number of test mechanisms
 C dang0 = minimum grid spacing, in degrees
-      integer, parameter :: ntab=180, npick0=15000
-      integer, parameter :: nmc0=500, nmax0=500
+C The pick and trial arrays are sized by npsta and nmc, so there is
+C no maximum number of picks or trials.
+      integer, parameter :: ntab=180
+      integer, parameter :: nmax0=500
       integer, parameter :: ncoor=31032
       real, parameter :: dang0=5.0
 
 C input and output arrays
-      REAL, dimension(npick0,nmc0) :: p_azi_mc,p_the_mc
       INTEGER npsta, nf
       INTEGER nmc,dang,maxout
+      REAL, dimension(npsta,nmc) :: p_azi_mc,p_the_mc
       integer p_pol(npsta)
-      real p_a1(npick0),p_a2(npick0),p_a3(npick0),p_qual(npsta)
+      real p_a1(npsta),p_a2(npsta),p_a3(npsta),p_qual(npsta)
       real faultnorm(3),slip(3),faults(3,nmax0),slips(3,nmax0)
       real strike(nmax0),dip(nmax0),rake(nmax0),sp_amp(npsta)
       real min_amp
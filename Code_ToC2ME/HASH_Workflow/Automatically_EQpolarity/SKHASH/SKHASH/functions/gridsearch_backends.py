@@ -0,0 +1,351 @@
+'''
+Registry of the grid search backends used to find the acceptable focal mechanisms.
+
+    python: NumPy grid search (fun.focal_gridsearch). Always available.
+    fortran: Fortran subroutine (gridsearch.f), compiled with f2py ahead of time into gridsearch_build_dir.
+    numba: NumPy grid search whose misfit kernel is compiled by Numba. Requires the numba package.
+
+The backend is selected with $gridsearch_backend. If 'auto', each available backend is timed on a
+synthetic event at startup and the fastest is used.
+'''
+
+# Standard libraries
+import os
+import sys
+import glob
+import time
+import functools
+import shutil
+import tempfile
+import subprocess
+import importlib.util
+
+# External libraries
+import numpy as np
+
+# Local libraries
+import functions.fun as fun # Computing mechanisms
+import functions.cache as cache # Caching arrays on disk
+import functions.ray_cache as ray_cache # Caching predictions of quantized ray directions
+import functions.gridsearch_so as gridsearch_so # For preparing the fortran gridsearch inputs
+
+backend_names=['python','fortran','numba']
+fortran_source_path=os.path.join(os.path.dirname(os.path.abspath(__file__)),'gridsearch.f')
+loaded_fortran_modules={} # Fortran extension modules loaded by load_fortran_module(), keyed by the build folder
+
+
+def default_build_dir():
+    '''
+    Returns the default folder for compiled backends (functions/build).
+    '''
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)),'build')
+
+
+def fortran_build_folder(build_dir):
+    '''
+    Determines the folder of the compiled Fortran module. The folder is keyed by the Fortran source
+    and the Python version, so a module compiled from an older gridsearch.f is never loaded.
+    Input:
+        build_dir: folder containing the compiled backends. If empty, default_build_dir() is used.
+    Output:
+        build_folder: path of the folder containing the compiled Fortran module
+    '''
+    with open(fortran_source_path) as f:
+        source=f.read()
+    key=cache.cache_key({'source':source,'python':sys.version,'numpy':np.__version__})
+    return os.path.join(build_dir or default_build_dir(),'gridsearch_{}'.format(key[:16]))
+
+
+def build_fortran_module(build_dir=''):
+    '''
+    Compiles the Fortran grid search subroutine with f2py, without prompting the user.
+    The module is compiled in a temporary folder, which is renamed once the build succeeds.
+    Input:
+        build_dir: folder containing the compiled backends. If empty, default_build_dir() is used.
+    Output:
+        build_folder: path of the folder containing the compiled Fortran module
+    '''
+    build_folder=fortran_build_folder(build_dir)
+    if glob.glob(os.path.join(build_folder,'gridsearch*.so'))+glob.glob(os.path.join(build_folder,'gridsearch*.pyd')):
+        return build_folder
+
+    print('Compiling the Fortran grid search subroutine in {}. This may take a minute...'.format(build_folder))
+    os.makedirs(os.path.dirname(build_folder),exist_ok=True)
+    tmp_folder=tempfile.mkdtemp(dir=os.path.dirname(build_folder),prefix='.tmp_')
+    try:
+        shutil.copy(fortran_source_path,tmp_folder)
+        result=subprocess.run([sys.executable,'-m','numpy.f2py','-c','gridsearch.f','-m','gridsearch'],
+                            cwd=tmp_folder,stdin=subprocess.DEVNULL,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,text=True)
+        if result.returncode!=0:
+            message='***Error: The Fortran grid search subroutine could not be compiled. f2py output:\n{}'.format(result.stdout[-2000:])
+            if (sys.version_info.major==3) & (sys.version_info.minor>=12):
+                message+='\nHave you installed the \'meson\' and \'ninja\' packages? (pip3 install meson ninja)'
+            raise ValueError(message)
+        os.remove(os.path.join(tmp_folder,'gridsearch.f'))
+        try:
+            os.rename(tmp_folder,build_folder)
+        except OSError:
+            if not(os.path.isdir(build_folder)): # Another process may have built it first
+                raise
+    finally:
+        if os.path.isdir(tmp_folder):
+            shutil.rmtree(tmp_folder)
+    return build_folder
+
+
+def load_fortran_module(build_dir='',build=True):
+    '''
+    Loads the compiled Fortran grid search module, compiling it first if needed.
+    Input:
+        build_dir: folder containing the compiled backends. If empty, default_build_dir() is used.
+        build: if False, a ValueError is raised rather than compiling the module.
+    Output:
+        gridsearch: the Fortran extension module
+    '''
+    build_folder=fortran_build_folder(build_dir)
+    if build_folder not in loaded_fortran_modules:
+        if build:
+            build_fortran_module(build_dir)
+        module_paths=glob.glob(os.path.join(build_folder,'gridsearch*.so'))+glob.glob(os.path.join(build_folder,'gridsearch*.pyd'))
+        if not(module_paths):
+            raise ValueError('***Error: The Fortran grid search module has not been compiled in {}.'.format(build_folder))
+        spec=importlib.util.spec_from_file_location('gridsearch',module_paths[0])
+        gridsearch=importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(gridsearch)
+        loaded_fortran_modules[build_folder]=gridsearch
+    return loaded_fortran_modules[build_folder]
+
+
+def misfit_kernel(xyz_pol,p_pol,xyz_sp,sp_amp,b1,b2,b3,thetable,phitable,amptable,fit,afit):
+    '''
+    Computes the polarity and S/P misfits one test mechanism and trial at a time.
+    Equivalent to fun.polarity_misfit() and fun.sp_misfit(), but without their temporary arrays.
+    Compiled by Numba in numba_misfit().
+    '''
+    ntab=180
+    astep=1/ntab
+    for k in range(b1.shape[1]):
+        for m in range(fit.shape[0]):
+            qmiss=0.
+            for i in range(xyz_pol.shape[1]):
+                p_b1=b1[0,k]*xyz_pol[0,i,m]+b1[1,k]*xyz_pol[1,i,m]+b1[2,k]*xyz_pol[2,i,m]
+                p_b3=b3[0,k]*xyz_pol[0,i,m]+b3[1,k]*xyz_pol[1,i,m]+b3[2,k]*xyz_pol[2,i,m]
+                if ((p_b1<0)!=(p_b3<0))!=(p_pol[i]<0):
+                    qmiss+=abs(p_pol[i])
+            fit[m,k]=qmiss
+
+            qamiss=0.
+            for i in range(xyz_sp.shape[1]):
+                p_b3=b3[0,k]*xyz_sp[0,i,m]+b3[1,k]*xyz_sp[1,i,m]+b3[2,k]*xyz_sp[2,i,m]
+                p_proj1=xyz_sp[0,i,m]-p_b3*b3[0,k]
+                p_proj2=xyz_sp[1,i,m]-p_b3*b3[1,k]
+                p_proj3=xyz_sp[2,i,m]-p_b3*b3[2,k]
+                plen=np.sqrt(p_proj1*p_proj1+p_proj2*p_proj2+p_proj3*p_proj3)
+                p_proj1=p_proj1/plen
+                p_proj2=p_proj2/plen
+                p_proj3=p_proj3/plen
+                pp_b1=b1[0,k]*p_proj1+b1[1,k]*p_proj2+b1[2,k]*p_proj3
+                pp_b2=b2[0,k]*p_proj1+b2[1,k]*p_proj2+b2[2,k]*p_proj3
+
+                theta=thetable[int(np.rint((p_b3+1.)/astep))]
+                phi=phitable[int(np.rint((pp_b2+1.)/astep)),int(np.rint((pp_b1+1.)/astep))]
+                i_phi=int(np.rint(phi/(np.pi*astep)))
+                if i_phi>(2*ntab-1):
+                    i_phi=0
+                j_theta=int(np.rint(theta/(np.pi*astep)))
+                if j_theta>(ntab-1):
+                    j_theta=0
+                p_amp=amptable[0,j_theta,i_phi]
+                s_amp=amptable[1,j_theta,i_phi]
+                if s_amp==0:
+                    sp_rat=-2.0
+                elif p_amp==0:
+                    sp_rat=4.0
+                else:
+                    sp_rat=np.log10(4.9*s_amp/p_amp)
+                qamiss+=abs(sp_amp[i]-sp_rat)
+            if xyz_sp.shape[1]>0:
+                afit[m,k]=qamiss
+
+
+compiled_misfit_kernel=None # misfit_kernel() compiled by Numba, created by numba_misfit()
+
+
+def numba_misfit(xyz_pol,p_pol,xyz_sp,sp_amp,b1,b2,b3,dir_cos_dict):
+    '''
+    Computes the polarity and S/P misfits using the Numba-compiled misfit_kernel().
+    Called by fun.gridsearch_misfit() (see its misfit_fun argument).
+    '''
+    global compiled_misfit_kernel
+    if compiled_misfit_kernel is None:
+        import numba # Imported only when used, as importing numba is slow
+        compiled_misfit_kernel=numba.njit(cache=True)(misfit_kernel)
+
+    nmc=xyz_pol.shape[2]
+    ncoor=b1.shape[1]
+    fit=np.zeros((nmc,ncoor))
+    if xyz_sp is None: # afit is not written when there are no S/P ratios
+        xyz_sp=np.zeros((3,0,nmc))
+        amptable=np.zeros((2,1,1))
+        afit=np.zeros((0,0))
+    else:
+        amptable=np.asarray(dir_cos_dict['amptable'])
+        afit=np.zeros((nmc,ncoor))
+    compiled_misfit_kernel(np.ascontiguousarray(xyz_pol),np.asarray(p_pol,dtype=float),np.ascontiguousarray(xyz_sp),np.asarray(sp_amp,dtype=float),
+                        np.ascontiguousarray(b1),np.ascontiguousarray(b2),np.ascontiguousarray(b3),
+                        np.asarray(dir_cos_dict['thetable']),np.asarray(dir_cos_dict['phitable']),amptable,fit,afit)
+    if len(sp_amp)==0:
+        afit=None
+    return fit,afit
+
+
+def python_gridsearch(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,nextra,ntotal,qextra,qtotal,p_dict):
+    '''
+    Grid search using the python routine. If ray_cache_resolution>0, the misfits are gathered from the ray direction cache.
+    The cache is gathered for all the test mechanisms at once (its memory is bounded by ray_cache_max_memory_mb), so it is not tiled.
+    '''
+    misfit_fun=None
+    max_memory_mb=p_dict['max_gridsearch_memory_mb']
+    if p_dict['ray_cache_resolution']>0:
+        misfit_fun=functools.partial(ray_cache.cached_misfit,ray_cache.get_ray_cache(dir_cos_dict,p_dict['ray_cache_resolution'],p_dict['ray_cache_max_memory_mb']))
+        max_memory_mb=0
+    return fun.focal_gridsearch(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,nextra,ntotal,qextra,qtotal,p_dict['maxout'],dir_cos_dict['ncoor'],
+                                max_memory_mb=max_memory_mb,bitpacked_polarity=p_dict['bitpacked_polarity'],misfit_fun=misfit_fun,
+                                early_rejection=p_dict['early_rejection'],early_rejection_trials=p_dict['early_rejection_trials'],
+                                num_threads=p_dict['gridsearch_threads'])
+
+
+def numba_gridsearch(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,nextra,ntotal,qextra,qtotal,p_dict):
+    '''
+    Grid search using the python routine with the Numba-compiled misfit kernel. If max_gridsearch_memory_mb>0,
+    the kernel is run on tiles of test mechanisms, like the Python grid search.
+    '''
+    return fun.focal_gridsearch(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,nextra,ntotal,qextra,qtotal,p_dict['maxout'],dir_cos_dict['ncoor'],
+                                max_memory_mb=p_dict['max_gridsearch_memory_mb'],misfit_fun=numba_misfit,early_rejection=p_dict['early_rejection'],early_rejection_trials=p_dict['early_rejection_trials'])
+
+
+def fortran_gridsearch(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,nextra,ntotal,qextra,qtotal,p_dict):
+    '''
+    Grid search using the compiled Fortran subroutine. dir_cos_dict is not used.
+    '''
+    gridsearch=load_fortran_module(p_dict['gridsearch_build_dir'],build=False)
+    p_azi_mc,p_the_mc,f_sp_amp,f_p_pol,p_qual=gridsearch_so.prep_subroutine(sr_azimuth,takeoff,p_pol,sp_amp)
+    nf,strike_all,dip_all,rake_all,faultnorms_all,faultslips_all=gridsearch.focalamp_mc_wt(p_azi_mc,p_the_mc,f_sp_amp,f_p_pol,p_qual,
+                                                    dang=p_dict['dang'],maxout=p_dict['maxout'],nextra=nextra,ntotal=ntotal,
+                                                    qextra=qextra,qtotal=qtotal,min_amp=p_dict['min_amp'])
+    return faultnorms_all[:,:nf],faultslips_all[:,:nf]
+
+
+gridsearch_funs={'python':python_gridsearch,'fortran':fortran_gridsearch,'numba':numba_gridsearch}
+
+
+def check_backend(backend_name,p_dict):
+    '''
+    Determines whether a backend can be used with the given parameters, preparing it (e.g., compiling) if needed.
+    Input:
+        backend_name: name of the backend
+        p_dict: Parameter values created in SKHASH.py, dictionary
+    Output:
+        reason: empty string if the backend is available. Otherwise, the reason it is not available.
+    '''
+    if backend_name=='python':
+        return ''
+    elif backend_name=='numba':
+        if importlib.util.find_spec('numba') is None:
+            return 'the numba package is not installed'
+        return ''
+    elif backend_name=='fortran':
+        if (p_dict['dang']<5) | (p_dict['dang']!=int(p_dict['dang'])):
+            return 'the Fortran subroutine requires an integer dang >= 5'
+        if p_dict['maxout']>500:
+            return 'the Fortran subroutine returns at most 500 mechanisms (maxout)'
+        if p_dict['mech_sampling']!='grid':
+            return 'the Fortran subroutine only supports mech_sampling=grid'
+        try:
+            load_fortran_module(p_dict['gridsearch_build_dir'])
+        except Exception as e:
+            return str(e).replace('***Error: ','')
+        return ''
+    else:
+        raise ValueError('***Error: Unknown grid search backend ({}). Options: {}'.format(backend_name,', '.join(['auto']+backend_names)))
+
+
+def benchmark_backend(backend_name,p_dict,dir_cos_dict,num_repeats=2):
+    '''
+    Times a backend on a synthetic event. The global random number generator (fun.rng) is restored afterwards,
+    so the benchmark does not change the results.
+    Input:
+        backend_name: name of the backend
+        p_dict: Parameter values created in SKHASH.py, dictionary
+        dir_cos_dict: coordinate transformation dictionary, produced by dir_cos_setup()
+        num_repeats: the fastest of this many runs is reported, after one warm-up run (e.g., for compilation)
+    Output:
+        runtime: runtime (sec)
+    '''
+    bench_rng=np.random.default_rng(0)
+    npick=30
+    sr_azimuth=bench_rng.uniform(0,360,npick)[:,np.newaxis]+bench_rng.normal(0,5,(npick,p_dict['nmc']))
+    sr_azimuth=np.mod(sr_azimuth,360)
+    takeoff=np.clip(bench_rng.uniform(20,160,npick)[:,np.newaxis]+bench_rng.normal(0,5,(npick,p_dict['nmc'])),1e-6,180)
+    p_pol=bench_rng.choice([-1.,1.],npick)
+    sp_amp=np.full(npick,np.nan)
+    if len(dir_cos_dict['amptable'])>0:
+        sp_amp[:5]=bench_rng.normal(0.5,0.4,5)
+
+    rng_state=fun.rng.bit_generator.state
+    runtimes=[]
+    for repeat_x in range(num_repeats+1):
+        start_time=time.time()
+        gridsearch_funs[backend_name](sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,2,3,1.,2.,p_dict)
+        runtimes.append(time.time()-start_time)
+    fun.rng.bit_generator.state=rng_state
+    return min(runtimes[1:])
+
+
+def select_backend(p_dict,dir_cos_dict):
+    '''
+    Determines the grid search backend to use and reports it. If p_dict['gridsearch_backend']=='auto', the
+    available backends are timed on a synthetic event and the fastest is selected.
+    Input:
+        p_dict: Parameter values created in SKHASH.py, dictionary
+        dir_cos_dict: coordinate transformation dictionary, produced by dir_cos_setup(). Only needed for 'auto'.
+    Output:
+        backend_name: name of the selected backend
+    '''
+    backend_name=p_dict['gridsearch_backend']
+    if backend_name!='auto':
+        reason=check_backend(backend_name,p_dict)
+        if reason:
+            raise ValueError('***Error: The {} grid search backend is not available: {}.'.format(backend_name,reason))
+        print('Grid search backend: {}'.format(backend_name))
+        return backend_name
+
+    runtimes={}
+    for tmp_backend_name in backend_names:
+        reason=check_backend(tmp_backend_name,p_dict)
+        if reason:
+            print('\t{} grid search backend unavailable: {}'.format(tmp_backend_name,reason))
+            continue
+        runtimes[tmp_backend_name]=benchmark_backend(tmp_backend_name,p_dict,dir_cos_dict)
+        print('\t{} grid search backend: {:.3f} sec per synthetic event'.format(tmp_backend_name,runtimes[tmp_backend_name]))
+    backend_name=min(runtimes,key=runtimes.get)
+    print('Grid search backend: {} (fastest available)'.format(backend_name))
+    if backend_name!='python':
+        unused_params=[param for param,used_flag in [('max_gridsearch_memory_mb',(p_dict['max_gridsearch_memory_mb']>0) & (backend_name=='fortran')),
+                                                     ('bitpacked_polarity',p_dict['bitpacked_polarity']),
+                                                     ('gridsearch_threads',p_dict['gridsearch_threads']>1),
+                                                     ('ray_cache_resolution',p_dict['ray_cache_resolution']>0)] if used_flag]
+        if unused_params:
+            print('*WARNING: These parameters are only used by the Python grid search: {}'.format(', '.join(unused_params)))
+    return backend_name
+
+
+def focal_gridsearch(sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,nextra,ntotal,qextra,qtotal,p_dict):
+    '''
+    Performs the grid search using the backend selected by select_backend() (p_dict['gridsearch_backend']).
+    Input: see fun.focal_gridsearch()
+    Output:
+        faultnorms_all: fault normal vectors
+        faultslips_all: fault slip vectors
+    '''
+    return gridsearch_funs[p_dict['gridsearch_backend']](sr_azimuth,takeoff,p_pol,sp_amp,dir_cos_dict,nextra,ntotal,qextra,qtotal,p_dict)
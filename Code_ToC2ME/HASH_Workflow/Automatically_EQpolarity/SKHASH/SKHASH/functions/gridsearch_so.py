@@ -1,63 +1,33 @@
 '''
-Functions for creating the fortran gridsearch module.
+Functions for creating and calling the fortran gridsearch module.
 '''
 
-# Standard libraries
-import os
-import glob
-import sys
-
 # External libraries
 import numpy as np
-from numpy import f2py
 
 
-def create():
+def create(build_dir=''):
     '''
-    Gives the user the option to automatically create a Python C/API extension
-    module for the gridsearch algorithm.
-
-    If the module is created, the user should re-run SKHASH and the module
-    should be automatically used.
+    Creates the Python C/API extension module for the Fortran gridsearch algorithm
+    without prompting the user. The module is compiled into build_dir (functions/build
+    by default) and is automatically used by the fortran grid search backend.
+    Input:
+        build_dir: folder containing the compiled backends
+    Output:
+        build_folder: path of the folder containing the compiled module
     '''
-    usr_input=input('The Fortran subroutine module does not exist, but you have \'use_fortran=True\'. Would you like to create this module? [y / n]\n')
-    usr_input=usr_input.strip().lower()
-    if (usr_input!='y') & (usr_input!='yes'):
-        print('\nThe module will not be created. If you would like to create the module manually, the following may help.')
-        print('\tStep 1. Navigate to the SKHASH/functions folder, e.g.:\n\t\tcd functions')
-        print('\tStep 2. Run the following command:\n\t\tpython3 -m numpy.f2py -c gridsearch.f -m gridsearch')
-        return 0
-    else:
-        print('\nCreating module. This may take a minute...')
-        with open("functions/gridsearch.f") as sourcefile:
-            sourcecode = sourcefile.read()
-        result=f2py.compile(sourcecode, modulename='gridsearch')
-        if result==0:
-            so_filepaths=glob.glob('gridsearch.cpython-*-*.so')
-            for so_filepath in so_filepaths:
-                os.rename(so_filepath,os.path.join('functions',so_filepath))
-            try:
-                import functions.gridsearch as gridsearch
-                print('\n\nThe fortran extension module has been successfully created!\n')
-                return 1
-            except Exception as e:
-                raise ValueError('There was an issue loading the module. Error message:\n{}'.format(e))
-        else:
-            if ((sys.version_info.major==3) & (sys.version_info.minor>=12)):
-                raise ValueError('The compiled extension module could not be created. Have you installed the \'meson\' and \'ninja\' packages? (pip3 install meson ninja)')
-            else:    
-                raise ValueError('The compiled extension module could not be created.')
+    import functions.gridsearch_backends as gridsearch_backends
+    return gridsearch_backends.build_fortran_module(build_dir)
 
 
-def prep_subroutine(sr_azimuth,takeoff,p_pol,sp_amp,npick0,nmc):
+def prep_subroutine(sr_azimuth,takeoff,p_pol,sp_amp):
     '''
     Gets the polarities, S/P ratios, azimuth, and takeoff information in the
-    correct format to call the Fortan subroutine.
+    correct format to call the Fortan subroutine. The subroutine arrays are
+    sized by the number of picks and trials, so no padding is needed.
     '''
-    p_azi_mc=np.zeros((npick0,500))
-    p_the_mc=np.zeros((npick0,500))
-    p_azi_mc[:sr_azimuth.shape[0],:nmc]=sr_azimuth
-    p_the_mc[:sr_azimuth.shape[0],:nmc]=takeoff
+    p_azi_mc=np.asfortranarray(np.broadcast_to(sr_azimuth,takeoff.shape),dtype=np.float32)
+    p_the_mc=np.asfortranarray(takeoff,dtype=np.float32)
 
     npsta=sr_azimuth.shape[0]
 
@@ -98,6 +98,11 @@ def read_control_file(control_filepath,p_dict):
     # Some basic variable type fixing
     p_dict['look_dep']=[int(x) for x in p_dict['look_dep']]
     p_dict['look_del']=[int(x) for x in p_dict['look_del']]
+    p_dict['lookup_num_knots']=[int(x) for x in p_dict['lookup_num_knots']]
+    for key in ['lookup_dep_knots','lookup_del_knots']:
+        if type(p_dict[key])!=list:
+            p_dict[key]=[p_dict[key]]
+        p_dict[key]=[float(x) for x in p_dict[key]]
     if type(p_dict['vmodel_paths'])==str:
         p_dict['vmodel_paths']=[p_dict['vmodel_paths']]
 
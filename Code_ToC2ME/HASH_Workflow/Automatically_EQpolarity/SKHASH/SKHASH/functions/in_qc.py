@@ -151,7 +151,7 @@ def check_input_params(p_dict,qual_criteria_dict):
 	# For any filepath vars, replaces '~' with user's home directory
 	for path_var in ['controlfile','catfile','stfile','plfile','corfile','fpfile','impfile','conpfile',
 				  	'dlpfile','ampfile','relampfile','simulpsfile','outfile1','outfile2','outfile_pol_agree',
-					'outfile_sp_agree','outfile_pol_info','outfolder_plots']:
+					'outfile_sp_agree','outfile_pol_info','outfolder_plots','checkpoint_file']:
 		if p_dict[path_var]:
 			if p_dict[path_var][0]=='~':
 				p_dict[path_var]=os.path.expanduser(p_dict[path_var])
@@ -221,7 +221,8 @@ def check_input_params(p_dict,qual_criteria_dict):
 		'outfile_pol_agree',
 		'outfile_sp_agree',
 		'outfile_pol_info',
-		'outfolder_plots']
+		'outfolder_plots',
+		'checkpoint_file']
 	tmp_dict = {key: p_dict[key] for key in filepath_vars if p_dict[key]!=''}
 	if len(tmp_dict)!=len(set(tmp_dict.values())):
 		rev_multidict = {}
@@ -230,8 +231,9 @@ def check_input_params(p_dict,qual_criteria_dict):
 		tmp=[values for key, values in rev_multidict.items() if len(values) > 1]
 		raise ValueError('Filepaths for the following variables are repeated: {}'.format(tmp[0]))
 
-	# Ensures existing files are not overwritten by the output, if desired
-	if (not(p_dict['overwrite_output_file'])):
+	# Ensures existing files are not overwritten by the output, if desired.
+	# When resuming from a checkpoint file, the outputs are recreated from it.
+	if (not(p_dict['overwrite_output_file'])) & (not(p_dict['checkpoint_file']) or not(os.path.exists(p_dict['checkpoint_file']))):
 		if p_dict['outfile1']:
 			if os.path.exists(p_dict['outfile1']):
 				raise ValueError('Preferred mechanism output file (outfile1={}) already exists. Either change the outfile1 path, remove this file, or set overwrite_output_file=True.'.format(p_dict['outfile1']))
@@ -282,6 +284,65 @@ def check_input_params(p_dict,qual_criteria_dict):
 		raise ValueError('The max number of acceptable focal mechanisms (maxout) must be at least 1 (ideally larger!).')
 	if p_dict['nmc']<1:
 		raise ValueError('The number of trials (nmc) must be at least 1 (ideally larger!).')
+	if not(p_dict['gridsearch_backend'] in ['auto','python','fortran','numba']):
+		raise ValueError('Unknown grid search backend (gridsearch_backend: {}). Must be one of: auto, python, fortran, numba.'.format(p_dict['gridsearch_backend']))
+	if not(p_dict['mech_sampling'] in ['grid','so3']):
+		raise ValueError('Unknown test mechanism sampling (mech_sampling: {}). Must be one of: grid, so3.'.format(p_dict['mech_sampling']))
+	if not(p_dict['lookup_grid'] in ['uniform','adaptive']):
+		raise ValueError('Unknown lookup table grid (lookup_grid: {}). Must be one of: uniform, adaptive.'.format(p_dict['lookup_grid']))
+	if p_dict['lookup_grid']=='adaptive':
+		if (len(p_dict['lookup_num_knots'])!=2) or (min(p_dict['lookup_num_knots'])<2):
+			raise ValueError('lookup_num_knots must be two values (the number of depth and distance knots), each >=2.')
+		for knot_var,look_var in [('lookup_dep_knots','look_dep'),('lookup_del_knots','look_del')]:
+			knots=p_dict[knot_var]
+			if knots:
+				if (len(knots)<2) or np.any(np.diff(knots)<=0):
+					raise ValueError('The knots ({}) must contain at least two increasing values.'.format(knot_var))
+				if (knots[0]!=p_dict[look_var][0]) or (knots[-1]!=p_dict[look_var][1]):
+					raise ValueError('The knots ({}) must start and end at the range of {} ({}-{} km).'.format(knot_var,look_var,p_dict[look_var][0],p_dict[look_var][1]))
+	if p_dict['max_gridsearch_memory_mb']<0:
+		raise ValueError('The grid search memory budget (max_gridsearch_memory_mb) must be >=0. To disable tiling, set max_gridsearch_memory_mb=0.')
+	elif (p_dict['max_gridsearch_memory_mb']>0) & (p_dict['gridsearch_backend']=='fortran'):
+		print('*WARNING: The grid search memory budget (max_gridsearch_memory_mb={}) is only used by the Python and Numba grid searches. The Fortran grid search computes the misfits one mechanism at a time and is not tiled.'.format(p_dict['max_gridsearch_memory_mb']))
+	if p_dict['bitpacked_polarity'] & (p_dict['gridsearch_backend'] in ['fortran','numba']):
+		print('*WARNING: The bit-packed polarity misfit (bitpacked_polarity=True) is only used by the Python grid search.')
+	if (p_dict['early_rejection_trials']<0) | (p_dict['early_rejection_trials']>=p_dict['nmc']):
+		raise ValueError('The number of early rejection reference trials (early_rejection_trials) must be >=0 and less than the number of trials (nmc).')
+	if p_dict['coarse_dang']<0:
+		raise ValueError('The coarse grid spacing (coarse_dang) must be >=0. To search the full grid, set coarse_dang=0.')
+	elif (p_dict['coarse_dang']>0) & (p_dict['coarse_dang']<=p_dict['dang']):
+		raise ValueError('The coarse grid spacing (coarse_dang={}) must be larger than the grid spacing (dang={}).'.format(p_dict['coarse_dang'],p_dict['dang']))
+	elif (p_dict['coarse_dang']>0) & (p_dict['gridsearch_backend']=='fortran'):
+		print('*WARNING: The coarse-to-fine grid search (coarse_dang={}) is only available in the Python grid search. The Fortran grid search will search the full grid.'.format(p_dict['coarse_dang']))
+	if p_dict['ray_cache_resolution']<0:
+		raise ValueError('The ray direction cache resolution (ray_cache_resolution) must be >=0. To disable the cache, set ray_cache_resolution=0.')
+	elif (p_dict['ray_cache_resolution']>0) & (p_dict['gridsearch_backend'] in ['fortran','numba']):
+		print('*WARNING: The ray direction cache (ray_cache_resolution={}) is only used by the Python grid search.'.format(p_dict['ray_cache_resolution']))
+	if p_dict['ray_cache_max_memory_mb']<=0:
+		raise ValueError('The ray direction cache memory budget (ray_cache_max_memory_mb) must be >0.')
+	if p_dict['lookup_table_cache_dir'] and os.path.isfile(p_dict['lookup_table_cache_dir']):
+		raise ValueError('The lookup table cache folder (lookup_table_cache_dir: {}) is a file.'.format(p_dict['lookup_table_cache_dir']))
+	if p_dict['lookup_table_cache_max_mb']<=0:
+		raise ValueError('The maximum size of the lookup table cache (lookup_table_cache_max_mb) must be >0.')
+	if p_dict['incremental'] and not(p_dict['checkpoint_file']):
+		raise ValueError('The incremental mode (incremental=True) requires a checkpoint file (checkpoint_file), in which the results of the events are stored.')
+	if p_dict['checkpoint_file'] and not(p_dict['per_event_seed']):
+		print('*WARNING: Using a checkpoint file (checkpoint_file: {}), so the random numbers of each event are seeded by its event id (per_event_seed=True).'.format(p_dict['checkpoint_file']))
+		p_dict['per_event_seed']=True
+	if p_dict['output_flush_interval']<0:
+		raise ValueError('The output flush interval (output_flush_interval) must be >=0. To write the results of each event as soon as it is computed, set output_flush_interval=0.')
+	if p_dict['gridsearch_threads']<1:
+		raise ValueError('The number of grid search threads (gridsearch_threads) must be >=1.')
+	elif (p_dict['gridsearch_threads']>1) & (p_dict['gridsearch_backend'] in ['fortran','numba']):
+		print('*WARNING: The grid search threads (gridsearch_threads={}) are only used by the Python grid search.'.format(p_dict['gridsearch_threads']))
+	if p_dict['intra_event_min_picks']<0:
+		raise ValueError('The minimum number of picks of the events whose grid search is split across threads (intra_event_min_picks) must be >=0. To disable it, set intra_event_min_picks=0.')
+	if p_dict['memory_budget_mb']<0:
+		raise ValueError('The memory budget (memory_budget_mb) must be >=0. To disable it, set memory_budget_mb=0.')
+	if not(p_dict['parallel_schedule'] in ['cost','ordered']):
+		raise ValueError('The parallel schedule (parallel_schedule: {}) must be either \'cost\' or \'ordered\'.'.format(p_dict['parallel_schedule']))
+	if p_dict['dir_cos_cache_dir'] and os.path.isfile(p_dict['dir_cos_cache_dir']):
+		raise ValueError('The direction cosine cache folder (dir_cos_cache_dir: {}) is a file.'.format(p_dict['dir_cos_cache_dir']))
 
 	if p_dict['min_quality_report']:
 		if not(p_dict['min_quality_report'] in qual_criteria_dict['qual_letter']):
@@ -490,7 +551,7 @@ def check_model_eq(cat_df,pol_df,p_dict):
 		p_dict['look_del'][1]=new_del2
 
 	num_source_depth_bins=int((p_dict['look_dep'][1]-p_dict['look_dep'][0])/3+1)
-	if num_source_depth_bins>p_dict['nd0']:
+	if (num_source_depth_bins>p_dict['nd0']) & (p_dict['lookup_grid']=='uniform'):
 		raise ValueError('Given the lookup depth range of {}-{}km with interval {}km look_dep), the {} source depth bins needed exceeds the maximum number of source depth bins {} (nd0).'.format(p_dict['look_dep'][0],p_dict['look_dep'][1],p_dict['look_dep'][2],num_source_depth_bins,p_dict['nd0']))
 
 	if p_dict['delmin']<=0:
@@ -10,9 +10,29 @@ import numpy as np
 import pandas as pd
 
 
-def read_station_file(pol_df,p_dict):
+def read_station_file(pol_df,p_dict,station_df=None):
 	'''
-	Reads input station file.
+	Reads input station file, keeping the stations that have polarity or S/P amp information.
+	If station_df is given (i.e., the station file was already read by load_station_file()), the file is not read again.
+	'''
+	if station_df is None:
+		station_df=load_station_file(p_dict)
+
+	# Selects only the station metadata that has polarity or S/P amp information
+	# debug line YC
+	#pd.set_option('display.max_rows',  None) 
+	#print(pol_df['sta_code'][0])
+	#print(station_df['sta_code'][0])
+	#print(station_df['sta_code'].isin(pol_df['sta_code'].unique()))
+	
+	station_df=station_df.loc[station_df['sta_code'].isin(pol_df['sta_code'].unique()),:].reset_index(drop=True)
+
+	return station_df
+
+
+def load_station_file(p_dict):
+	'''
+	Reads input station file, selecting the needed columns.
 	'''
 	if (p_dict['input_format_stfile']=='skhash'):
 		station_df=read_skhash_station_file(p_dict['stfile'],p_dict['merge_on'])
@@ -48,15 +68,6 @@ def read_station_file(pol_df,p_dict):
 		# Selects only the desired columns
 		station_df=station_df.filter(['sta_code','station_lat','station_lon','station_depth_km'])
 
-	# Selects only the station metadata that has polarity or S/P amp information
-	# debug line YC
-	#pd.set_option('display.max_rows',  None) 
-	#print(pol_df['sta_code'][0])
-	#print(station_df['sta_code'][0])
-	#print(station_df['sta_code'].isin(pol_df['sta_code'].unique()))
-	
-	station_df=station_df.loc[station_df['sta_code'].isin(pol_df['sta_code'].unique()),:].reset_index(drop=True)
-
 	# Drops duplicate records
 	station_df=station_df.drop_duplicates().reset_index(drop=True)
 
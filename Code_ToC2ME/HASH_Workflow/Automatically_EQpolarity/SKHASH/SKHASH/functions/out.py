@@ -1,11 +1,21 @@
+# Standard libraries
+import io
+import os
+import time
+import queue
+import threading
+
 # External libraries
 import numpy as np
 import pandas as pd
 
+# Local libraries
+import functions.checkpoint as checkpoint # Checkpointing the computed events
 
-def create_outfile1(outfile1,cat_df,pol_df):
+
+def outfile1_header(cat_df,pol_df):
     '''
-    Creates the outfile of the preferred mech solutions
+    Creates the header line of the outfile of the preferred mech solutions
     '''
     header_str_out='event_id,strike,dip,rake,quality,fault_plane_uncertainty,aux_plane_uncertainty,num_p_pol,num_sp_ratios,'+\
                         'polarity_misfit,prob_mech,sta_distribution_ratio,sp_misfit,mult_solution_flag'
@@ -16,11 +26,32 @@ def create_outfile1(outfile1,cat_df,pol_df):
         if 'event_mag' in pol_df:
             header_str_out+='magnitude,'
         header_str_out+='origin_lat,origin_lon,origin_depth_km,horz_uncert_km,vert_uncert_km'
+    return header_str_out
+
+
+def create_outfile1(outfile1,cat_df,pol_df):
+    '''
+    Creates the outfile of the preferred mech solutions
+    '''
     with open(outfile1, "w") as f_outfile1:
-        f_outfile1.write(header_str_out+'\n')
+        f_outfile1.write(outfile1_header(cat_df,pol_df)+'\n')
     return True
 
 
+def mech_dataframe(mech_dicts,cat_df,pol_df):
+    '''
+    Creates a dataframe of the preferred mech solutions of the events, with the columns of outfile1.
+    Input:
+        mech_dicts: list of the mechanism dictionaries of the events, with their outfile1 lines (see queue_results())
+        cat_df: catalog dataframe
+        pol_df: polarity dataframe
+    Output:
+        mech_df: dataframe of the preferred mech solutions
+    '''
+    lines=''.join([mech_dict['outfile1_lines'] for mech_dict in mech_dicts])
+    return pd.read_csv(io.StringIO(outfile1_header(cat_df,pol_df)+'\n'+lines),dtype={'event_id':str})
+
+
 def create_outfile2(outfile2):
     '''
     Creates the outfile of the acceptable mech solutions
@@ -30,9 +61,9 @@ def create_outfile2(outfile2):
     return True
 
 
-def write_outfile1(outfile1,mech_df,event_df,event_id):
+def format_outfile1(mech_df,event_df,event_id):
     '''
-    Writes mech solutions for an event to outfile1.
+    Formats the lines of outfile1 (preferred mech solutions) of an event.
     '''
     event_str_output=''
     if len(event_df):
@@ -47,57 +78,200 @@ def write_outfile1(outfile1,mech_df,event_df,event_id):
         event_str_output+=str(event_df['horz_uncert_km'])+','
         event_str_output+=str(event_df['vert_uncert_km'])
 
+    if len(mech_df)>1:
+        mech_df['mflag']=True
+    else:
+        mech_df['mflag']=False
+    lines=''
+    for imult in range(len(mech_df)):
+        lines+=('{},{},{},{},{},'+
+                '{},{},{},{},{},'+
+                '{},{},{},{}{}\n').format(
+            event_id,
+            mech_df.loc[imult,'str_avg'], # strike
+            mech_df.loc[imult,'dip_avg'], # dip
+            mech_df.loc[imult,'rak_avg'], # rake
+            mech_df.loc[imult,'qual'], # ad-hoc mech quality
+            mech_df.loc[imult,'rms_diff'], # fault plane uncertainty
+            mech_df.loc[imult,'rms_diff_aux'], # aux plane uncertainty
+            mech_df.loc[imult,'num_p_pol'], # num p polarity picks
+            mech_df.loc[imult,'num_sp_ratios'], # num S/P ratios
+            mech_df.loc[imult,'mfrac'], # weighted percent misfit of first motions
+            mech_df.loc[imult,'prob'], # probability mechanism close to solution
+            mech_df.loc[imult,'stdr'], # 100*(station distribtuion ratio)
+            mech_df.loc[imult,'mavg'], # 100*(average log10(S/P) misfit)
+            mech_df.loc[imult,'mflag'], # Flag indicating whether there are multiple solutions for the event
+            event_str_output
+            )
+    return lines
+
+
+def write_outfile1(outfile1,mech_df,event_df,event_id):
+    '''
+    Writes mech solutions for an event to outfile1.
+    '''
     with open(outfile1, "a") as f_outfile1:
-        if len(mech_df)>1:
-            mech_df['mflag']=True
-        else:
-            mech_df['mflag']=False
-        for imult in range(len(mech_df)):
-            f_outfile1.write(('{},{},{},{},{},'+
-                              '{},{},{},{},{},'+
-                              '{},{},{},{}{}\n').format(
-                event_id,
-                mech_df.loc[imult,'str_avg'], # strike
-                mech_df.loc[imult,'dip_avg'], # dip
-                mech_df.loc[imult,'rak_avg'], # rake
-                mech_df.loc[imult,'qual'], # ad-hoc mech quality
-                mech_df.loc[imult,'rms_diff'], # fault plane uncertainty
-                mech_df.loc[imult,'rms_diff_aux'], # aux plane uncertainty
-                mech_df.loc[imult,'num_p_pol'], # num p polarity picks
-                mech_df.loc[imult,'num_sp_ratios'], # num S/P ratios
-                mech_df.loc[imult,'mfrac'], # weighted percent misfit of first motions
-                mech_df.loc[imult,'prob'], # probability mechanism close to solution
-                mech_df.loc[imult,'stdr'], # 100*(station distribtuion ratio)
-                mech_df.loc[imult,'mavg'], # 100*(average log10(S/P) misfit)
-                mech_df.loc[imult,'mflag'], # Flag indicating whether there are multiple solutions for the event
-                event_str_output
-                ))
+        f_outfile1.write(format_outfile1(mech_df,event_df,event_id))
     return True
 
 
+def format_outfile2(event_id,strike_all,dip_all,rake_all,faultnorms_all,faultslips_all,output_angle_precision,output_vector_precision):
+    '''
+    Formats the lines of outfile2 (acceptable mech solutions) of an event.
+    The values are formatted as pandas.DataFrame.to_csv() would.
+    '''
+    columns=[np.round(strike_all,output_angle_precision),np.round(dip_all,output_angle_precision),np.round(rake_all,output_angle_precision)]
+    columns+=[np.round(faultnorms_all[x,:],output_vector_precision) for x in range(3)]
+    columns+=[np.round(faultslips_all[x,:],output_vector_precision) for x in range(3)]
+    row_format=str(event_id)+',{},{},{},{},{},{},{},{},{},{}\n'
+    return ''.join([row_format.format(mech_number,*row) for mech_number,row in enumerate(zip(*[column.tolist() for column in columns]))])
+
+
 def write_outfile2(outfile2,event_id,strike_all,dip_all,rake_all,faultnorms_all,faultslips_all,output_angle_precision,output_vector_precision):
     '''
     Writes acceptable mech solutions for an event to outfile2.
     '''
-    acceptable_mechs_df=pd.DataFrame(columns=['event_id','mech_number','strike','dip','rake',
-                                              'norm_N','norm_E','norm_Z','norm_aux_N','norm_aux_E','norm_aux_Z'],
-                                              index=np.arange(len(strike_all)))
-
-    acceptable_mechs_df['event_id']=event_id
-    acceptable_mechs_df['mech_number']=np.arange(len(acceptable_mechs_df))
-    acceptable_mechs_df['strike']=np.round(strike_all,output_angle_precision)
-    acceptable_mechs_df['dip']=np.round(dip_all,output_angle_precision)
-    acceptable_mechs_df['rake']=np.round(rake_all,output_angle_precision)
-    acceptable_mechs_df['norm_N']=np.round(faultnorms_all[0,:],output_vector_precision)
-    acceptable_mechs_df['norm_E']=np.round(faultnorms_all[1,:],output_vector_precision)
-    acceptable_mechs_df['norm_Z']=np.round(faultnorms_all[2,:],output_vector_precision)
-    acceptable_mechs_df['norm_aux_N']=np.round(faultslips_all[0,:],output_vector_precision)
-    acceptable_mechs_df['norm_aux_E']=np.round(faultslips_all[1,:],output_vector_precision)
-    acceptable_mechs_df['norm_aux_Z']=np.round(faultslips_all[2,:],output_vector_precision)
-    acceptable_mechs_df.to_csv(outfile2,mode='a',sep=',',index=False,header=False)
+    with open(outfile2, "a") as f_outfile2:
+        f_outfile2.write(format_outfile2(event_id,strike_all,dip_all,rake_all,faultnorms_all,faultslips_all,output_angle_precision,output_vector_precision))
     return True
 
 
+def start_result_writer(p_dict,event_keys=None):
+    '''
+    Starts a thread that appends the lines of the events to outfile1 and outfile2, and the records of
+    the events to the checkpoint file (checkpoint_file). The lines are written in the order they are
+    received, in batches every p_dict['output_flush_interval'] seconds.
+    Input:
+        p_dict: Parameter values created in SKHASH.py, dictionary
+        event_keys: in incremental mode, the fingerprints and rows of the events produced by checkpoint.event_fingerprints(),
+            recorded in the checkpoint file with the events
+    Output:
+        writer_dict: dictionary with the queue receiving the lines (queue), the thread (thread), and the exception
+            raised by the thread, if any (errors). Lines are given to the thread with queue_result(), and the thread is
+            stopped with stop_result_writer().
+    '''
+    outfiles={key:p_dict[key] for key in ['outfile1','outfile2','checkpoint_file'] if p_dict[key]}
+    result_queue=queue.Queue()
+    errors=[]
+    thread=threading.Thread(target=result_writer,args=(result_queue,outfiles,p_dict['output_flush_interval'],errors),daemon=True)
+    thread.start()
+    return {'queue':result_queue,'thread':thread,'errors':errors,'checkpoint':('checkpoint_file' in outfiles),'event_keys':event_keys}
+
+
+def queue_result(writer_dict,mech_dict,journal=True):
+    '''
+    Gives the output lines of an event (produced by compute_mech.finish_event()) to the writer thread.
+    The outfile2 lines are removed from mech_dict, so they are not kept in memory once written. The outfile1
+    lines are kept to create the dataframe of the preferred mech solutions (mech_dataframe()).
+    If checkpointing, the event is also recorded in the checkpoint file, unless journal=False
+    (i.e., for the events read from the checkpoint file).
+    If the writer thread failed (e.g., the disk is full), its exception is raised.
+    '''
+    if writer_dict['errors']:
+        raise writer_dict['errors'][0]
+    outfile1_lines=mech_dict['outfile1_lines']
+    outfile2_lines=mech_dict.pop('outfile2_lines')
+    result={'outfile1':outfile1_lines,'outfile2':outfile2_lines}
+    if writer_dict['checkpoint'] and journal:
+        event_key=None
+        if writer_dict['event_keys'] is not None:
+            event_key=writer_dict['event_keys'][mech_dict['event_id']]
+        result['checkpoint_file']=checkpoint.format_record(mech_dict,outfile1_lines,outfile2_lines,event_key=event_key)
+    if any(result.values()):
+        writer_dict['queue'].put(result)
+
+
+def queue_results(writer_dict,event_ids,mech_dicts,completed_dict=None):
+    '''
+    Gives the results of the events to the writer thread in the order of event_ids, taking the results of
+    the events read from the checkpoint file from completed_dict and the others from mech_dicts.
+    Input:
+        writer_dict: dictionary produced by start_result_writer()
+        event_ids: list of the event ids
+        mech_dicts: iterable of the mechanism dictionaries of the events not in completed_dict, in the order of event_ids
+        completed_dict: dictionary of the mechanism dictionaries read from the checkpoint file, keyed by event id
+    Output:
+        event_results: list of the mechanism dictionaries of the events
+    '''
+    if completed_dict is None:
+        completed_dict={}
+    mech_dicts=iter(mech_dicts)
+    event_results=[]
+    for event_id in event_ids:
+        if event_id in completed_dict:
+            mech_dict=completed_dict.pop(event_id)
+            queue_result(writer_dict,mech_dict,journal=False)
+        else:
+            mech_dict=next(mech_dicts)
+            queue_result(writer_dict,mech_dict)
+        event_results.append(mech_dict)
+    return event_results
+
+
+def stop_result_writer(writer_dict,raise_error=True):
+    '''
+    Writes any remaining lines and stops the writer thread.
+    If raise_error=True and the writer thread failed, its exception is raised.
+    '''
+    writer_dict['queue'].put(None)
+    writer_dict['thread'].join()
+    if raise_error and writer_dict['errors']:
+        raise writer_dict['errors'][0]
+
+
+def result_writer(result_queue,outfiles,flush_interval,errors):
+    '''
+    Appends the lines received from a queue to the output files until None is received. Run by start_result_writer().
+    Input:
+        result_queue: queue of dictionaries, with the lines of each file keyed by the file parameter name (e.g., 'outfile1')
+        outfiles: dictionary of the output file paths, keyed by the file parameter name. The checkpoint file
+            (checkpoint_file) is synced to disk each time it is written.
+        flush_interval: the lines are written at most every flush_interval seconds. If 0, they are written as soon as they are received.
+        errors: list to which an exception raised while writing is appended, so that it is raised in the main thread.
+            The thread then stops.
+    '''
+    try:
+        write_results(result_queue,outfiles,flush_interval)
+    except Exception as e:
+        errors.append(e)
+
+
+def write_results(result_queue,outfiles,flush_interval):
+    '''
+    Appends the lines received from a queue to the output files until None is received (see result_writer()).
+    '''
+    file_handles={}
+    buffers={key:[] for key in outfiles}
+    try:
+        for key,path in outfiles.items():
+            file_handles[key]=open(path,'a')
+        last_flush=time.time()
+        stop=False
+        while not(stop):
+            try:
+                result=result_queue.get(timeout=max(flush_interval,0.01))
+                if result is None:
+                    stop=True
+                else:
+                    for key in buffers:
+                        if result.get(key):
+                            buffers[key].append(result[key])
+            except queue.Empty:
+                pass
+            if stop or (time.time()-last_flush>=flush_interval):
+                for key,lines in buffers.items():
+                    if lines:
+                        file_handles[key].write(''.join(lines))
+                        file_handles[key].flush()
+                        if key=='checkpoint_file':
+                            os.fsync(file_handles[key].fileno())
+                        lines.clear()
+                last_flush=time.time()
+    finally:
+        for file_handle in file_handles.values():
+            file_handle.close()
+
+
 def pol_agree(pol_df,p_dict):
     '''
     Writes the polarity agreement records for all events to outfile_pol_agree
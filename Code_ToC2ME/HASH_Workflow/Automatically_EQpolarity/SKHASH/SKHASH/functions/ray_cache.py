@@ -0,0 +1,240 @@
+'''
+Cache of the predicted P-polarity signs and S/P ratios of quantized ray directions.
+
+The ray directions (takeoff angle, azimuth) are quantized to cells of roughly $ray_cache_resolution
+degrees. For each cell, the predicted P-polarity sign (packed into bits) and, if needed, the predicted
+log10 S/P ratio of every test mechanism are computed once at the center of the cell. They are then
+gathered for every ray in the cell, for all events and trials. Once the cache exceeds its memory budget,
+the least recently used cells are replaced.
+
+As each ray is moved to the center of its cell, the misfits are approximate. The predicted polarities
+can only differ for rays within about ray_cache_resolution degrees of a nodal plane.
+'''
+
+# Standard libraries
+import collections
+
+# External libraries
+import numpy as np
+
+# Local libraries
+import functions.fun as fun # Computing mechanisms
+
+ray_caches={} # Cache created by get_ray_cache(), keyed by the cell size. A process holds at most one cache.
+min_cache_cells=1024 # Minimum number of cells held by a cache, regardless of its memory budget
+
+
+def cell_grid(resolution):
+	'''
+	Sets up the quantization of the ray directions. The takeoff angles are divided into rows of about
+	resolution degrees, and each row is divided into azimuth cells of about resolution degrees.
+	Input:
+		resolution: cell size (degrees)
+	Output:
+		grid_dict: dictionary with the number of rows (num_rows), the number of cells in each row (num_azimuth),
+			the index of the first cell of each row (row_start), and the total number of cells (num_cells)
+	'''
+	num_rows=int(np.ceil(180/resolution))
+	row_center=(np.arange(num_rows)+0.5)*180/num_rows
+	num_azimuth=np.maximum(1,np.round(360*np.sin(np.deg2rad(row_center))/resolution)).astype(int)
+	row_start=np.concatenate(([0],np.cumsum(num_azimuth)[:-1]))
+	return {'num_rows':num_rows,'num_azimuth':num_azimuth,'row_start':row_start,'num_cells':int(num_azimuth.sum())}
+
+
+def cell_index(xyz,grid_dict):
+	'''
+	Determines the cells of ray vectors.
+	Input:
+		xyz: ray vectors, array of shape (3,...)
+		grid_dict: cell grid, produced by cell_grid()
+	Output:
+		cells: cell indices, int array with the shape of xyz[0]
+	'''
+	takeoff=np.rad2deg(np.arccos(np.clip(-xyz[2],-1,1)))
+	sr_azimuth=np.rad2deg(np.arctan2(xyz[1],xyz[0]))%360
+
+	row=np.minimum((takeoff*grid_dict['num_rows']/180).astype(int),grid_dict['num_rows']-1)
+	num_azimuth=grid_dict['num_azimuth'][row]
+	col=(sr_azimuth*num_azimuth/360).astype(int)%num_azimuth
+	return grid_dict['row_start'][row]+col
+
+
+def cell_center_vectors(cells,grid_dict):
+	'''
+	Determines the ray vectors of the centers of cells.
+	Input:
+		cells: cell indices, 1d array
+		grid_dict: cell grid, produced by cell_grid()
+	Output:
+		xyz: ray vectors, array of shape (3,n,1)
+	'''
+	row=np.searchsorted(grid_dict['row_start'],cells,side='right')-1
+	num_azimuth=grid_dict['num_azimuth'][row]
+	takeoff=(row+0.5)*180/grid_dict['num_rows']
+	sr_azimuth=(cells-grid_dict['row_start'][row]+0.5)*360/num_azimuth
+	return fun.ray_vectors(takeoff[:,np.newaxis],sr_azimuth[:,np.newaxis])
+
+
+def ray_cache_setup(dir_cos_dict,resolution,max_memory_mb):
+	'''
+	Creates an empty ray direction cache for the test mechanisms of dir_cos_dict.
+	Input:
+		dir_cos_dict: coordinate transformation dictionary, produced by dir_cos_setup()
+		resolution: cell size (degrees)
+		max_memory_mb: approximate memory budget (MB) of the cached signs and S/P ratios
+	Output:
+		cache_dict: ray direction cache
+	'''
+	ncoor=dir_cos_dict['b1'].shape[1]
+	sign_bytes=(ncoor+7)//8
+	sp_flag=len(dir_cos_dict['amptable'])>0 # S/P ratios are only predicted when an S/P amplitude table is used
+	cell_bytes=sign_bytes
+	if sp_flag:
+		cell_bytes+=4*ncoor
+	capacity=max(min_cache_cells,int(max_memory_mb*1e6/cell_bytes))
+
+	# The arrays are allocated lazily by the OS, so unused cells do not take up memory
+	cache_dict={'b1':dir_cos_dict['b1'],'grid':cell_grid(resolution),'capacity':capacity,'max_memory_mb':max_memory_mb,
+				'slots':collections.OrderedDict(),
+				'sign':np.empty((capacity,sign_bytes),dtype=np.uint8),
+				'sp':None,'sp_valid':np.zeros(capacity,dtype=bool),
+				'hits':0,'misses':0}
+	if sp_flag:
+		cache_dict['sp']=np.empty((capacity,ncoor),dtype=np.float32)
+	return cache_dict
+
+
+def get_ray_cache(dir_cos_dict,resolution,max_memory_mb):
+	'''
+	Returns the ray direction cache of the test mechanisms of dir_cos_dict, creating it if needed.
+	Only one cache is kept, so that max_memory_mb bounds the memory of all cached cells. The cache is
+	replaced when the test mechanisms, the cell size, or the memory budget change. Copies of the same
+	test mechanisms (e.g., loaded again from the direction cosine cache) reuse the cache.
+	Input:
+		dir_cos_dict: coordinate transformation dictionary, produced by dir_cos_setup()
+		resolution: cell size (degrees)
+		max_memory_mb: approximate memory budget (MB) of the cached signs and S/P ratios
+	Output:
+		cache_dict: ray direction cache
+	'''
+	b1=dir_cos_dict['b1']
+	cache_dict=ray_caches.get(resolution)
+	if (cache_dict is not None) and (cache_dict['max_memory_mb']==max_memory_mb) and \
+			((cache_dict['b1'] is b1) or ((cache_dict['b1'].shape==b1.shape) and np.array_equal(cache_dict['b1'],b1))):
+		cache_dict['b1']=b1 # cached_misfit() recognizes the test mechanisms of the cache by identity
+		return cache_dict
+
+	ray_caches.clear() # Releases the previous cache (and its test mechanisms) before allocating the new one
+	ray_caches[resolution]=ray_cache_setup(dir_cos_dict,resolution,max_memory_mb)
+	return ray_caches[resolution]
+
+
+def lookup_slots(cache_dict,cells,dir_cos_dict,sp=False):
+	'''
+	Determines where the signs (and S/P ratios) of cells are stored, computing those of the cells not in the cache.
+	Input:
+		cache_dict: ray direction cache, produced by ray_cache_setup()
+		cells: cell indices, 1d array. Must not contain more unique cells than the capacity of the cache.
+		dir_cos_dict: coordinate transformation dictionary, produced by dir_cos_setup()
+		sp: if True, the S/P ratios of the cells are also computed if needed
+	Output:
+		slots: indices of the cells in cache_dict['sign'] and cache_dict['sp'], 1d array
+	'''
+	unique_cells,inverse=np.unique(cells,return_inverse=True)
+	unique_slots=np.zeros(len(unique_cells),dtype=int)
+	slot_dict=cache_dict['slots']
+
+	missing_ind=[]
+	for x,cell in enumerate(unique_cells.tolist()):
+		slot=slot_dict.get(cell)
+		if slot is None:
+			missing_ind.append(x)
+		else:
+			slot_dict.move_to_end(cell)
+			unique_slots[x]=slot
+	cache_dict['hits']+=len(unique_cells)-len(missing_ind)
+	cache_dict['misses']+=len(missing_ind)
+
+	if missing_ind:
+		for x in missing_ind:
+			if len(slot_dict)<cache_dict['capacity']:
+				slot=len(slot_dict)
+			else: # Replaces the least recently used cell
+				slot=slot_dict.popitem(last=False)[1]
+			slot_dict[unique_cells[x]]=slot
+			unique_slots[x]=slot
+		new_slots=unique_slots[missing_ind]
+		xyz=cell_center_vectors(unique_cells[missing_ind],cache_dict['grid'])
+		p_b1=np.tensordot(xyz,dir_cos_dict['b1'],axes=[[0],[0]])[:,0,:]
+		p_b3=np.tensordot(xyz,dir_cos_dict['b3'],axes=[[0],[0]])[:,0,:]
+		cache_dict['sign'][new_slots]=np.packbits((p_b1<0)!=(p_b3<0),axis=1) # If 1, predicted sign is negative
+		cache_dict['sp_valid'][new_slots]=False
+
+	if sp:
+		sp_missing_ind=np.where(~cache_dict['sp_valid'][unique_slots])[0]
+		if len(sp_missing_ind):
+			new_slots=unique_slots[sp_missing_ind]
+			xyz=cell_center_vectors(unique_cells[sp_missing_ind],cache_dict['grid'])
+			cache_dict['sp'][new_slots]=fun.sp_ratio(xyz,dir_cos_dict['b1'],dir_cos_dict['b2'],dir_cos_dict['b3'],dir_cos_dict)[:,0,:]
+			cache_dict['sp_valid'][new_slots]=True
+
+	return unique_slots[inverse.reshape(-1)]
+
+
+def cached_misfit(cache_dict,xyz_pol,p_pol,xyz_sp,sp_amp,b1,b2,b3,dir_cos_dict):
+	'''
+	Computes the polarity and S/P misfits by gathering the predictions of the quantized ray directions from the cache.
+	Has the same inputs and outputs as the misfit_fun of fun.gridsearch_misfit(). If the test mechanisms are
+	not those of the cache (e.g., a subset of them, or the coarse grid), the misfits are computed directly.
+	Input:
+		cache_dict: ray direction cache, produced by ray_cache_setup()
+		xyz_pol: ray vectors of the polarity measurements, array of shape (3,n,nmc)
+		p_pol: nonzero polarity weights, 1d array
+		xyz_sp: ray vectors of the S/P measurements, array of shape (3,n,nmc). None if there are no S/P ratios.
+		sp_amp: finite log10 S/P ratios, 1d array
+		b1,b2,b3: direction cosines of the trial mechanisms, arrays of shape (3,ncoor)
+		dir_cos_dict: coordinate transformation dictionary, produced by dir_cos_setup()
+	Output:
+		fit: weighted polarity misfits, array of shape (nmc,ncoor)
+		afit: S/P misfits, array of shape (nmc,ncoor). None if there are no S/P ratios.
+	'''
+	num_sp=0 if xyz_sp is None else xyz_sp.shape[1]
+	if not(b1 is cache_dict['b1']) or (max(xyz_pol.shape[1],num_sp)>cache_dict['capacity']):
+		fit=fun.polarity_misfit(xyz_pol,p_pol,b1,b3)
+		afit=None
+		if xyz_sp is not None:
+			afit=fun.sp_misfit(xyz_sp,sp_amp,b1,b2,b3,dir_cos_dict)
+		return fit,afit
+
+	nmc=xyz_pol.shape[2]
+	ncoor=b1.shape[1]
+
+	neg_pol=(p_pol<0).astype(np.uint8)[:,np.newaxis]
+	abs_pol=np.abs(p_pol)
+	pol_cells=cell_index(xyz_pol,cache_dict['grid'])
+	fit=np.zeros((nmc,ncoor))
+	for trial_x in range(nmc):
+		slots=lookup_slots(cache_dict,pol_cells[:,trial_x],dir_cos_dict)
+		qmiss=np.unpackbits(cache_dict['sign'][slots],axis=1,count=ncoor)^neg_pol
+		fit[trial_x]=abs_pol@qmiss
+
+	afit=None
+	if xyz_sp is not None:
+		sp_cells=cell_index(xyz_sp,cache_dict['grid'])
+		afit=np.zeros((nmc,ncoor))
+		for trial_x in range(nmc):
+			slots=lookup_slots(cache_dict,sp_cells[:,trial_x],dir_cos_dict,sp=True)
+			afit[trial_x]=np.sum(np.abs(sp_amp[:,np.newaxis]-cache_dict['sp'][slots]),axis=0)
+	return fit,afit
+
+
+def ray_cache_summary():
+	'''
+	Summarizes the use of the ray direction caches of this process.
+	Output:
+		summary: string
+	'''
+	hits=sum([cache_dict['hits'] for cache_dict in ray_caches.values()])
+	misses=sum([cache_dict['misses'] for cache_dict in ray_caches.values()])
+	num_cells=sum([len(cache_dict['slots']) for cache_dict in ray_caches.values()])
+	return 'Ray direction cache: {} cells cached, {:.1f}% of cell lookups were hits'.format(num_cells,100*hits/max(1,hits+misses))
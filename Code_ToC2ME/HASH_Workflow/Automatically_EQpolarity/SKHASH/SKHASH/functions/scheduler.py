@@ -0,0 +1,318 @@
+'''
+Functions for scheduling the events computed by the processes of a multiprocessing pool.
+
+The runtime of each event is estimated from its number of P-polarities and S/P ratios, the
+number of trials (nmc), and the number of test mechanisms. The most expensive events are
+computed first, and the inexpensive events are grouped into tasks to reduce the overhead of
+sending each task to the pool.
+
+If a memory budget is given (memory_budget_mb), the peak memory of the grid search of each task
+is estimated as well. Tasks are held back until the estimated memory of the running tasks allows
+them, and events too large for the budget are searched alone, in tiles.
+'''
+
+# Standard libraries
+import time
+import threading
+
+# External libraries
+import numpy as np
+import pandas as pd
+
+# Local libraries
+import functions.fun as fun # Computing mechanisms
+
+# Approximate runtimes (sec) of the python grid search, used to estimate the cost of the events.
+# Only their ratios matter.
+pol_cost=1.5e-8 # per P-polarity, trial, and test mechanism
+sp_cost=2e-7 # per S/P ratio, trial, and test mechanism
+event_cost=0.1 # per event (e.g., selecting the preferred mechanism)
+plot_cost=0.6 # per event, when plotting the mechanisms (outfolder_plots)
+
+# Approximate number of bytes of the misfit arrays kept per trial and test mechanism, in addition to the
+# temporary arrays of the grid search (fun.gridsearch_memory_estimate)
+fit_element_bytes=16
+
+
+def event_counts(pol_df,event_ids):
+	'''
+	Counts the nonzero P-polarities (num_pol) and finite S/P ratios (num_sp) of each event.
+	Input:
+		pol_df: polarity dataframe
+		event_ids: list of the event ids
+	Output:
+		count_df: dataframe indexed by event_ids
+	'''
+	count_df=pd.DataFrame({'event_id':pol_df['event_id'].values,
+							'num_pol':(pol_df['p_polarity'].fillna(0)!=0).values})
+	if 'sp_ratio' in pol_df.columns:
+		count_df['num_sp']=np.isfinite(pol_df['sp_ratio'].values.astype(float))
+	else:
+		count_df['num_sp']=False
+	return count_df.groupby('event_id').sum().reindex(event_ids,fill_value=0)
+
+
+def estimate_event_costs(pol_df,event_ids,p_dict,num_mech):
+	'''
+	Estimates the runtime of each event.
+	Input:
+		pol_df: polarity dataframe
+		event_ids: list of the event ids
+		p_dict: Parameter values created in SKHASH.py, dictionary
+		num_mech: number of test mechanisms. If None (e.g., the Fortran grid search), it is estimated from the grid spacing (dang).
+	Output:
+		costs: estimated runtime (sec) of each event of event_ids, array
+	'''
+	if num_mech is None:
+		num_mech=estimate_num_mech(p_dict)
+	count_df=event_counts(pol_df,event_ids)
+	costs=p_dict['nmc']*num_mech*(count_df['num_pol'].values*pol_cost+count_df['num_sp'].values*sp_cost)+event_cost
+	if p_dict['outfolder_plots']:
+		costs+=plot_cost
+	return costs
+
+
+def estimate_num_mech(p_dict):
+	'''
+	Approximates the number of test mechanisms of the grid of spacing dang, e.g., when the direction cosines
+	are not computed in python (Fortran grid search).
+	'''
+	return 31032*(5/p_dict['dang'])**3 # Number of test mechanisms of the HASH grid with dang=5
+
+
+def estimate_event_memory(pol_df,event_ids,p_dict,num_mech):
+	'''
+	Estimates the peak memory used by the grid search of each event.
+	Input:
+		pol_df: polarity dataframe
+		event_ids: list of the event ids
+		p_dict: Parameter values created in SKHASH.py, dictionary
+		num_mech: number of test mechanisms. If None, it is estimated from the grid spacing (dang).
+	Output:
+		memory_mb: estimated peak memory (MB) of each event of event_ids, array
+	'''
+	if num_mech is None:
+		num_mech=estimate_num_mech(p_dict)
+	count_df=event_counts(pol_df,event_ids)
+
+	# The Fortran and Numba grid searches compute the misfits one mechanism at a time, so they only use the misfit arrays
+	search_bytes=np.zeros(len(count_df))
+	if p_dict['gridsearch_backend']=='python':
+		search_bytes=np.array([fun.gridsearch_memory_estimate(num_pol,num_sp,p_dict['nmc'],num_mech,bitpacked_polarity=p_dict['bitpacked_polarity'])
+								for num_pol,num_sp in zip(count_df['num_pol'].values,count_df['num_sp'].values)],dtype=float)
+		if p_dict['max_gridsearch_memory_mb']>0:
+			search_bytes=np.minimum(search_bytes,p_dict['max_gridsearch_memory_mb']*1e6)
+	return (search_bytes+fit_element_bytes*p_dict['nmc']*num_mech)/1e6
+
+
+def cost_schedule(event_xs,costs,num_cpus,tasks_per_cpu=4,max_task_events=0):
+	'''
+	Groups events into tasks, ordered from the most to the least expensive. Events that cost more than
+	the target task cost (the total cost divided by num_cpus*tasks_per_cpu) are computed alone, and the
+	other events are grouped into tasks of about the target cost.
+	Input:
+		event_xs: event numbers to schedule
+		costs: estimated cost of each event of event_xs, array
+		num_cpus: number of processes of the pool
+		tasks_per_cpu: the target task cost is set so that there are at least this many tasks per process
+		max_task_events: maximum number of events in a task. If 0, there is no maximum.
+	Output:
+		tasks: list of the event numbers of each task
+	'''
+	costs=np.asarray(costs,dtype=float)
+	target_cost=costs.sum()/(num_cpus*tasks_per_cpu)
+
+	tasks=[]
+	task=[]
+	task_cost=0
+	for event_ind in np.argsort(-costs,kind='stable'):
+		if costs[event_ind]>=target_cost:
+			tasks.append([event_xs[event_ind]])
+			continue
+		task.append(event_xs[event_ind])
+		task_cost+=costs[event_ind]
+		if (task_cost>=target_cost) or (len(task)==max_task_events):
+			tasks.append(sorted(task))
+			task=[]
+			task_cost=0
+	if task:
+		tasks.append(sorted(task))
+	return tasks
+
+
+def ordered_schedule(event_xs,task_events=1):
+	'''
+	Groups consecutive events into tasks of task_events events, in the order of the events.
+	'''
+	return [event_xs[task_start:task_start+task_events] for task_start in range(0,len(event_xs),task_events)]
+
+
+def intra_event_threads(pol_df,event_ids,event_costs,p_dict):
+	'''
+	Determines the number of threads computing the grid search of each event. Events with at least
+	intra_event_min_picks P-polarities and S/P ratios are given a share of the num_cpus cores proportional to
+	their share of the estimated cost of all events, so that a large event does not leave the other cores idle
+	once the other events are computed. Other events use gridsearch_threads threads.
+	The extra threads of the large events run on cores set aside from the pool workers (at most half of the
+	cores), so that the threads and the workers do not oversubscribe the cores, even if all the large events
+	are computed at the same time.
+	Input:
+		pol_df: polarity dataframe
+		event_ids: list of the event ids
+		event_costs: estimated cost of each event of event_ids, produced by estimate_event_costs()
+		p_dict: Parameter values created in SKHASH.py, dictionary
+	Output:
+		num_threads: number of threads of each event of event_ids, array
+		num_workers: number of pool workers
+	'''
+	num_threads=np.full(len(event_ids),p_dict['gridsearch_threads'])
+	if p_dict['intra_event_min_picks']<=0:
+		return num_threads,p_dict['num_cpus']
+	count_df=event_counts(pol_df,event_ids)
+	large_flag=(count_df['num_pol'].values+count_df['num_sp'].values)>=p_dict['intra_event_min_picks']
+	if not(large_flag.any()):
+		return num_threads,p_dict['num_cpus']
+	core_share=np.round(p_dict['num_cpus']*np.asarray(event_costs)/np.sum(event_costs)).astype(int)
+	extra_threads=np.clip(core_share[large_flag]-p_dict['gridsearch_threads'],0,None)
+	num_reserved=min(int(np.sum(extra_threads)),p_dict['num_cpus']//2)
+	if num_reserved<np.sum(extra_threads): # The reserved cores are divided between the large events
+		extra_threads=np.floor(extra_threads*num_reserved/np.sum(extra_threads)).astype(int)
+	num_threads[large_flag]=p_dict['gridsearch_threads']+extra_threads
+	return num_threads,p_dict['num_cpus']-num_reserved
+
+
+def isolate_events(tasks,event_xs):
+	'''
+	Moves events into tasks of their own, placed before the task they were part of.
+	Input:
+		tasks: list of the event numbers of each task
+		event_xs: event numbers to isolate
+	Output:
+		tasks: list of the event numbers of each task
+	'''
+	event_xs=set(event_xs)
+	isolated_tasks=[]
+	for task in tasks:
+		isolated_tasks.extend([[event_x] for event_x in task if event_x in event_xs])
+		task=[event_x for event_x in task if not(event_x in event_xs)]
+		if task:
+			isolated_tasks.append(task)
+	return isolated_tasks
+
+
+def memory_schedule(tasks,event_memory_mb,p_dict):
+	'''
+	Determines the estimated peak memory of each task, and routes the events whose grid search alone
+	exceeds the memory budget (p_dict['memory_budget_mb']) to the tiled grid search. These events must be
+	in tasks of their own (see isolate_events()), whose grid search is tiled to memory_budget_mb/num_cpus.
+	Input:
+		tasks: list of the event numbers of each task
+		event_memory_mb: dictionary of the estimated peak memory (MB) of each event, keyed by event number
+		p_dict: Parameter values created in SKHASH.py, dictionary
+	Output:
+		task_memory_mb: estimated peak memory (MB) of each task, list
+		task_tile_mb: memory budget (MB) of the tiled grid search of each task. None for the tasks of
+			events that fit in the memory budget, list
+	'''
+	tile_mb=p_dict['memory_budget_mb']/p_dict['num_cpus']
+	task_memory_mb=[]
+	task_tile_mb=[]
+	for task in tasks:
+		memory_mb=[event_memory_mb[event_x] for event_x in task]
+		if (len(task)==1) and (memory_mb[0]>p_dict['memory_budget_mb']):
+			task_memory_mb.append(tile_mb)
+			task_tile_mb.append(tile_mb)
+		else:
+			task_memory_mb.append(max(memory_mb))
+			task_tile_mb.append(None)
+	return task_memory_mb,task_tile_mb
+
+
+def submit_tasks(pool,worker,task_args,task_memory_mb=None,memory_budget_mb=0):
+	'''
+	Submits tasks to a multiprocessing pool in order. If memory_budget_mb>0, each task is held back until the
+	estimated memory of the running tasks plus its own is within the budget. A task is always submitted
+	when no other task is running, so tasks larger than the budget are still computed.
+	Input:
+		pool: multiprocessing pool
+		worker: function computing a task
+		task_args: arguments of worker for each task, list of tuples
+		task_memory_mb: estimated peak memory (MB) of each task, list. Only needed if memory_budget_mb>0.
+		memory_budget_mb: memory budget (MB). If <=0, all tasks are submitted at once.
+	Output:
+		get_result: function returning the result of a task from its index in task_args. While waiting,
+			the tasks that fit in the memory budget are submitted.
+	'''
+	if memory_budget_mb<=0:
+		task_memory_mb=[0]*len(task_args)
+	condition=threading.Condition()
+	state={'running_mb':0.,'next_task_x':0,'finished':set()}
+	async_results=[]
+
+	def task_finished(task_x):
+		# Called by the result handler thread of the pool once the task is done (or failed)
+		def callback(result):
+			with condition:
+				state['running_mb']-=task_memory_mb[task_x]
+				state['finished'].add(task_x)
+				condition.notify_all()
+		return callback
+
+	def submit_ready_tasks():
+		while state['next_task_x']<len(task_args):
+			task_x=state['next_task_x']
+			if (memory_budget_mb>0) and (state['running_mb']>0) and (state['running_mb']+task_memory_mb[task_x]>memory_budget_mb):
+				break
+			state['running_mb']+=task_memory_mb[task_x]
+			state['next_task_x']+=1
+			async_results.append(pool.apply_async(worker,args=task_args[task_x],
+									callback=task_finished(task_x),error_callback=task_finished(task_x)))
+
+	def get_result(task_x):
+		with condition:
+			submit_ready_tasks()
+			while not(task_x in state['finished']):
+				condition.wait()
+				submit_ready_tasks()
+		return async_results[task_x].get()
+	return get_result
+
+
+def ordered_results(tasks,get_result,event_xs,utilization_dict):
+	'''
+	Yields the mechanism dictionaries of the events in the order of event_xs, as the tasks computing them finish.
+	Input:
+		tasks: list of the event numbers of each task
+		get_result: function returning the result of a task, produced by submit_tasks(). The results are
+			produced by compute_mech.compute_mech_task_worker().
+		event_xs: event numbers in the order their results are yielded
+		utilization_dict: dictionary in which the total CPU time of the tasks (busy_time) and the time the last
+			task finished (end_time) are recorded
+	'''
+	task_of_event={event_x:task_x for task_x,task in enumerate(tasks) for event_x in task}
+	finished_dict={}
+	for event_x in event_xs:
+		if not(event_x in finished_dict):
+			task_x=task_of_event[event_x]
+			task_result=get_result(task_x)
+			finished_dict.update(zip(tasks[task_x],task_result['mech_dicts']))
+			utilization_dict['busy_time']+=task_result['busy_time']
+			utilization_dict['end_time']=time.time()
+		yield finished_dict.pop(event_x)
+
+
+def utilization_summary(utilization_dict,num_tasks,num_events,num_cpus):
+	'''
+	Summarizes the fraction of the time the processes of the pool spent computing events.
+	Input:
+		utilization_dict: dictionary with the start time of the pool (start_time), and the busy_time
+			and end_time recorded by ordered_results()
+		num_tasks: number of tasks
+		num_events: number of events
+		num_cpus: number of processes of the pool
+	Output:
+		summary: string
+	'''
+	core_time=num_cpus*max(utilization_dict['end_time']-utilization_dict['start_time'],1e-9)
+	return 'Parallel schedule: {} events in {} tasks. Core utilization: {:.1f}% ({:.2f} of {:.2f} core-sec)'.format(
+		num_events,num_tasks,100*utilization_dict['busy_time']/core_time,utilization_dict['busy_time'],core_time)
@@ -0,0 +1,284 @@
+'''
+Functions for running SKHASH as a long-lived local service.
+
+The service keeps the inputs that do not depend on the events warm between requests: the
+lookup tables, the test mechanisms (dir_cos_dict), and the station file. Each request posts
+the contents of the event input files (e.g., fpfile, catfile) as JSON, and the mechanisms
+are computed with SKHASH.run(). The request latencies are recorded in a histogram.
+
+Endpoints:
+	POST /mechanism: computes the mechanisms of the posted events. The body is a JSON object whose
+		keys are input file parameters (event_params) and whose values are the contents of the files.
+		Input files that are not posted are not used, even if the control file gives them.
+		Parameters can be overwritten with the key "params" (except the input and output files).
+	GET /metrics: request latency histogram, in the Prometheus text format
+	GET /health: returns "ok"
+'''
+
+# Standard libraries
+import os
+import io
+import sys
+import json
+import time
+import hashlib
+import tempfile
+import contextlib
+import http.server
+
+# Input files that can be posted with each request
+event_params=['fpfile','impfile','conpfile','dlpfile','catfile','ampfile','relampfile','simulpsfile']
+
+# Output files. The service returns the mechanisms rather than writing them.
+output_params=['outfile1','outfile2','outfile_pol_agree','outfile_sp_agree','outfile_pol_info','outfolder_plots','checkpoint_file']
+
+# Upper bounds (sec) of the latency histogram buckets
+latency_buckets=[0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,float('inf')]
+
+
+def warm_key(p_dict,key_params):
+	'''
+	Creates a key that identifies the inputs kept warm between runs (see warm_input()).
+	Input:
+		p_dict: Parameter values created in SKHASH.py, dictionary
+		key_params: parameters the input depends on
+	Output:
+		key: hexadecimal sha256 hash of the parameters, string
+	'''
+	params={key:p_dict[key] for key in key_params}
+	return hashlib.sha256(json.dumps(params,sort_keys=True,default=str).encode()).hexdigest()
+
+
+def warm_input(warm_state,name,key,create_fun):
+	'''
+	Returns an input kept in warm_state, creating it with create_fun() if it is missing or its key changed.
+	Input:
+		warm_state: dictionary of the warm inputs. If None, the input is always created.
+		name: name of the input
+		key: key identifying the parameters of the input (see warm_key())
+		create_fun: function creating the input
+	Output:
+		the input
+	'''
+	if warm_state is None:
+		return create_fun()
+	if not(name in warm_state) or (warm_state[name][0]!=key):
+		warm_state[name]=(key,create_fun())
+	return warm_state[name][1]
+
+
+def file_key(path):
+	'''
+	Identifies the version of a file by its path and modification time, so that warm inputs read from
+	the file are read again once it is modified.
+	'''
+	try:
+		return [path,os.path.getmtime(path)]
+	except OSError:
+		return [path,None]
+
+
+def create_histogram():
+	'''
+	Creates an empty latency histogram.
+	'''
+	return {'bucket_counts':[0]*len(latency_buckets),'sum':0.,'count':0}
+
+
+def observe_latency(histogram,latency):
+	'''
+	Adds a request latency (sec) to the histogram.
+	'''
+	for bucket_x,upper_bound in enumerate(latency_buckets):
+		if latency<=upper_bound:
+			histogram['bucket_counts'][bucket_x]+=1
+			break
+	histogram['sum']+=latency
+	histogram['count']+=1
+
+
+def format_metrics(histogram):
+	'''
+	Formats the latency histogram in the Prometheus text format, with cumulative bucket counts.
+	'''
+	lines=['# HELP skhash_request_latency_seconds Latency of the /mechanism requests.',
+			'# TYPE skhash_request_latency_seconds histogram']
+	cumulative_count=0
+	for upper_bound,count in zip(latency_buckets,histogram['bucket_counts']):
+		cumulative_count+=count
+		le='+Inf' if upper_bound==float('inf') else '{:g}'.format(upper_bound)
+		lines.append('skhash_request_latency_seconds_bucket{{le="{}"}} {}'.format(le,cumulative_count))
+	lines.append('skhash_request_latency_seconds_sum {:.6f}'.format(histogram['sum']))
+	lines.append('skhash_request_latency_seconds_count {}'.format(histogram['count']))
+	return '\n'.join(lines)+'\n'
+
+
+def base_config(controlfile,config=None):
+	'''
+	Reads the parameters of the service from a control file. The output files are disabled, the events
+	are computed in serial, and the random numbers of each event are seeded by its event id, so that the
+	mechanisms do not depend on the order of the requests.
+	Input:
+		controlfile: path of the control file. If empty, the default parameters are used.
+		config: parameter values overwriting the values of the control file, dictionary
+	Output:
+		config: parameter values passed to SKHASH.run(), dictionary
+	'''
+	import SKHASH
+	import functions.in_other as in_other # Functions for reading other inputs
+
+	p_dict=SKHASH.default_parameters()
+	if controlfile:
+		p_dict=in_other.read_control_file(controlfile,p_dict)
+	p_dict.update(config or {})
+	p_dict['controlfile']=''
+	for param in output_params:
+		p_dict[param]=''
+	p_dict['num_cpus']=1
+	p_dict['per_event_seed']=True
+	p_dict['incremental']=False
+	return p_dict
+
+
+def compute_request(service_state,payload):
+	'''
+	Computes the mechanisms of the events posted in a request.
+	Input:
+		service_state: dictionary with the base parameters (config), the warm inputs (warm_state),
+			and the folder in which the posted files are written (request_folder)
+		payload: dictionary of the request. The keys are input file parameters (event_params), whose values
+			are the contents of the files, and optionally "params", a dictionary of parameter values.
+	Output:
+		response: dictionary with the mechanisms (mechanisms), the runtime (runtime_sec), and the printed log (log)
+	'''
+	import SKHASH
+
+	if not(isinstance(payload,dict)):
+		raise ValueError('The request must be a JSON object.')
+	unknown_keys=[key for key in payload if not(key in event_params+['params'])]
+	if unknown_keys:
+		raise ValueError('Unknown request keys: {}. Expected the input files {} and/or params.'.format(unknown_keys,event_params))
+	params=payload.get('params',{})
+	blocked_params=[key for key in params if key in event_params+output_params+['controlfile','num_cpus']]
+	if blocked_params:
+		raise ValueError('These parameters cannot be changed by a request: {}'.format(blocked_params))
+
+	# Only the posted input files are used. The input files of the control file (e.g., its catalog) are never mixed with the posted ones.
+	config=dict(service_state['config'],**params)
+	for param in event_params:
+		config[param]=''
+		if param in payload:
+			config[param]=os.path.join(service_state['request_folder'],param)
+			with open(config[param],'w') as f:
+				f.write(payload[param])
+	if not(any([config[param] for param in ['fpfile','impfile','conpfile','dlpfile']])):
+		raise ValueError('No polarity file was posted (e.g., fpfile).')
+	if not(config['catfile']):
+		for param in ['fpfile','impfile','conpfile','dlpfile']:
+			input_format=(config['input_format_'+param] or config['input_format'] or 'skhash').lower()
+			if config[param] and (input_format=='skhash') and not(skhash_locations_given(payload[param])):
+				raise ValueError('No catfile was posted, and the posted {} does not give the event locations (origin_latitude, origin_longitude, origin_depth_km) '
+								'or the takeoff and azimuth angles. Post the catfile of the events.'.format(param))
+
+	run_start=time.time()
+	log=io.StringIO()
+	with contextlib.redirect_stdout(log):
+		results=SKHASH.run(config,warm_state=service_state['warm_state'])
+	return {'mechanisms':json.loads(results['mech_df'].to_json(orient='records')),
+			'runtime_sec':time.time()-run_start,
+			'log':log.getvalue()}
+
+
+def skhash_locations_given(contents):
+	'''
+	Determines if a polarity file in the SKHASH format gives what is needed to compute the mechanisms without
+	a catalog: either the event locations, or the takeoff and azimuth angles.
+	Input:
+		contents: contents of the polarity file, string
+	Output:
+		True if the columns are given, boolean
+	'''
+	import pandas as pd
+	try:
+		columns=pd.read_csv(io.StringIO(contents),skipinitialspace=True,comment='#',nrows=0).columns
+	except pd.errors.EmptyDataError:
+		return True # The error is raised when the file is read
+	return {'origin_latitude','origin_longitude','origin_depth_km'}.issubset(columns) or {'takeoff','azimuth'}.issubset(columns)
+
+
+def create_handler(service_state):
+	'''
+	Creates the class handling the HTTP requests of the service.
+	'''
+	class RequestHandler(http.server.BaseHTTPRequestHandler):
+		def send_body(self,status,body,content_type='application/json'):
+			body=body.encode()
+			self.send_response(status)
+			self.send_header('Content-Type',content_type)
+			self.send_header('Content-Length',str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def do_GET(self):
+			if self.path=='/metrics':
+				self.send_body(200,format_metrics(service_state['histogram']),'text/plain; version=0.0.4')
+			elif self.path=='/health':
+				self.send_body(200,'ok\n','text/plain')
+			else:
+				self.send_body(404,json.dumps({'error':'Unknown path: {}'.format(self.path)}))
+
+		def do_POST(self):
+			if self.path!='/mechanism':
+				self.send_body(404,json.dumps({'error':'Unknown path: {}'.format(self.path)}))
+				return
+			request_start=time.time()
+			try:
+				payload=json.loads(self.rfile.read(int(self.headers.get('Content-Length',0))))
+				response=compute_request(service_state,payload)
+				status=200
+			except ValueError as e:
+				response={'error':str(e)}
+				status=400
+			except Exception as e:
+				response={'error':'{}: {}'.format(type(e).__name__,e)}
+				status=500
+			observe_latency(service_state['histogram'],time.time()-request_start)
+			self.send_body(status,json.dumps(response))
+
+		def log_message(self,format,*args):
+			sys.stderr.write('{} - {}\n'.format(self.log_date_time_string(),format%args))
+
+	return RequestHandler
+
+
+def serve(controlfile,host='127.0.0.1',port=8765,config=None,warm_up=True):
+	'''
+	Runs the service until interrupted. The requests are handled one at a time, as the mechanisms
+	of each request are computed in the service's process.
+	Input:
+		controlfile: path of the control file
+		host: address the service listens on
+		port: port the service listens on
+		config: parameter values overwriting the values of the control file, dictionary
+		warm_up: if True and the control file gives input files, their events are computed once at startup,
+			so that the inputs are warm for the first request.
+	'''
+	import SKHASH
+
+	service_state={'config':base_config(controlfile,config),'warm_state':{},'histogram':create_histogram()}
+	with tempfile.TemporaryDirectory(prefix='skhash_service_') as request_folder:
+		service_state['request_folder']=request_folder
+		if warm_up and any([service_state['config'][param] for param in ['fpfile','impfile','conpfile','dlpfile']]):
+			warm_up_start=time.time()
+			with contextlib.redirect_stdout(io.StringIO()):
+				SKHASH.run(service_state['config'],warm_state=service_state['warm_state'])
+			print('Warmed up in {:.2f} sec'.format(time.time()-warm_up_start),flush=True)
+
+		server=http.server.HTTPServer((host,port),create_handler(service_state))
+		print('SKHASH service listening on http://{}:{}'.format(host,server.server_port),flush=True)
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			server.server_close()
@@ -0,0 +1,80 @@
+'''
+Functions for sharing large read-only inputs with the processes of a multiprocessing pool.
+
+The arrays are saved once as .npy files in a temporary folder, which each worker memory-maps,
+so a single copy of them is shared by the OS between the processes. Only a small description
+of the arrays is sent to the workers, rather than pickling the arrays for every task.
+'''
+
+# Standard libraries
+import shutil
+import tempfile
+
+# External libraries
+import numpy as np
+
+# Local libraries
+import functions.cache as cache # Caching arrays on disk
+
+
+def create_shared_folder():
+	'''
+	Creates the temporary folder in which the shared arrays are saved. It should be removed
+	with remove_shared_folder() once the pool is done.
+	Output:
+		shared_folder: path of the folder
+	'''
+	return tempfile.mkdtemp(prefix='skhash_shared_')
+
+
+def remove_shared_folder(shared_folder):
+	'''
+	Removes the folder created by create_shared_folder(). The workers' memory maps remain valid.
+	Input:
+		shared_folder: path of the folder
+	'''
+	shutil.rmtree(shared_folder,ignore_errors=True)
+
+
+def share_dict(input_dict,folder):
+	'''
+	Saves the arrays of a dictionary so they can be memory-mapped by other processes.
+	Nested dictionaries are shared as well. Other values (and object arrays) are kept as is.
+	Input:
+		input_dict: dictionary
+		folder: path of the folder to create, e.g., in the folder produced by create_shared_folder()
+	Output:
+		shared_dict: dictionary to pass to attach_dict()
+	'''
+	shared_dict={}
+	arrays={}
+	for key,value in input_dict.items():
+		if isinstance(value,np.ndarray) and (value.dtype!=object):
+			arrays[key]=value
+		elif isinstance(value,dict):
+			shared_dict[key]=share_dict(value,folder+'.'+key)
+		else:
+			shared_dict[key]=value
+	if arrays:
+		cache.save_arrays(folder,arrays)
+		shared_dict['shared_folder']=folder
+	return shared_dict
+
+
+def attach_dict(shared_dict):
+	'''
+	Recreates a dictionary shared by share_dict(), memory-mapping its arrays.
+	Input:
+		shared_dict: dictionary produced by share_dict()
+	Output:
+		output_dict: dictionary with the keys and values of the original dictionary
+	'''
+	output_dict={}
+	for key,value in shared_dict.items():
+		if key=='shared_folder':
+			output_dict.update(cache.load_arrays(value))
+		elif isinstance(value,dict):
+			output_dict[key]=attach_dict(value)
+		else:
+			output_dict[key]=value
+	return output_dict
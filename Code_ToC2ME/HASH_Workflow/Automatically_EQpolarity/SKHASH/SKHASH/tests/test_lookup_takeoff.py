@@ -0,0 +1,66 @@
+'''
+Checks that lookup_takeoff_batch() gives the same takeoff angles as calling lookup_takeoff() for each event.
+Run from the SKHASH folder with: python -m pytest tests
+'''
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import functions.fun as fun
+
+
+def create_events(deptab,delttab,num_picks,nmc,seed):
+	'''
+	Creates the perturbed depths and distances of events with num_picks picks each, spanning the lookup table.
+	'''
+	event_rng=np.random.default_rng(seed)
+	depth_list=[event_rng.uniform(deptab[0],deptab[-1],size=(npick,nmc)) for npick in num_picks]
+	dist_list=[event_rng.uniform(delttab[0],delttab[-1],size=(npick,nmc)) for npick in num_picks]
+	return depth_list,dist_list
+
+
+@pytest.mark.parametrize('uniform_grid',[True,False])
+def test_lookup_takeoff_batch_matches_lookup_takeoff(uniform_grid):
+	look_dep=[0,20,2]
+	look_del=[0,100,5]
+	if uniform_grid:
+		deptab=np.arange(look_dep[0],look_dep[1]+look_dep[2],look_dep[2])
+		delttab=np.arange(look_del[0],look_del[1]+look_del[2],look_del[2])
+	else:
+		deptab=np.array([0.,0.5,1.5,3.,6.,10.,20.])
+		delttab=np.array([0.,2.,5.,12.,30.,60.,100.])
+	num_velocity_models=3
+	nmc=30
+	num_picks=[1,12,43,7]
+	table=np.random.default_rng(0).uniform(0,180,size=(len(delttab),len(deptab),num_velocity_models))
+	depth_list,dist_list=create_events(deptab,delttab,num_picks,nmc,seed=1)
+
+	# Draws the velocity models of each event as lookup_takeoff() does
+	global_rng=fun.rng
+	try:
+		fun.rng=np.random.default_rng(2)
+		takeoff_expected=[fun.lookup_takeoff(table,depth.copy(),dist.copy(),look_dep,look_del,deptab,delttab,
+											num_velocity_models=num_velocity_models,uniform_grid=uniform_grid)
+						for depth,dist in zip(depth_list,dist_list)]
+		fun.rng=np.random.default_rng(2)
+		vm_ind_list=[fun.random_velocity_models(num_velocity_models,nmc) for _ in num_picks]
+	finally:
+		fun.rng=global_rng
+
+	out=np.full((sum(num_picks),nmc),np.nan)
+	takeoff_list=fun.lookup_takeoff_batch(table,depth_list,dist_list,look_dep,look_del,deptab,delttab,vm_ind_list,
+										uniform_grid=uniform_grid,out=out)
+
+	assert len(takeoff_list)==len(num_picks)
+	for takeoff,expected in zip(takeoff_list,takeoff_expected):
+		assert np.array_equal(takeoff,expected)
+		assert np.shares_memory(takeoff,out)
+	assert np.array_equal(np.concatenate(takeoff_expected),out)
+
+	# Without out, the output is allocated
+	takeoff_list=fun.lookup_takeoff_batch(table,depth_list,dist_list,look_dep,look_del,deptab,delttab,vm_ind_list,uniform_grid=uniform_grid)
+	for takeoff,expected in zip(takeoff_list,takeoff_expected):
+		assert np.array_equal(takeoff,expected)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming version of Steps 3-8 of the workflow (see README.md).
+
+Watches a folder (e.g., result_ToC2ME_eqpolarity) for new EQpolarity .polarity files. Each new
+event is processed in memory, without writing the intermediate .pol.hash and .csv files:
+    - the probability filter of filter_polarity_average_pol.py (abs(polarity_raw-0.5)>=polarity_thre)
+    - the polarity signs of generate_pol_hash_for_independent_test.m (polarity_raw>0.5 is '-'),
+      optionally reversed as in Reverse_pol_hash_polarity.py (ToC2ME instrument settings)
+    - the SNR cut of delete_low_SNR_waveform_in_pol_hash.py (SNR<=snr_min is removed)
+    - the polarity and catalog rows of generate_pol_csv.py and generate_eq_catalog.py
+The event is then sent to SKHASH, either computed in this process (keeping the lookup tables, the test
+mechanisms, and the station file warm, see SKHASH/SKHASH/functions/service.py) or posted to a running
+SKHASH service (SKHASH_service.py). The mechanisms are appended to a CSV file as soon as they are computed.
+
+A file is processed once its size and modification time are unchanged between two polls, so that files
+still being written are not read. The event id is the file name (e.g., 20161104064824.680).
+
+Example:
+    python3 stream_polarity_to_skhash.py --reverse_polarity
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import urllib.error
+import urllib.request
+from datetime import datetime
+import pandas as pd
+
+skhash_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SKHASH', 'SKHASH')
+
+
+def read_snr_table(snr_file):
+    '''
+    Reads the SNR of each event and station (Event_ID, Station_ID, SNR) produced by SNR_from_event_waveform_toc2me_me_2.py.
+    '''
+    return pd.read_csv(snr_file, dtype={'Event_ID': str, 'Station_ID': str})
+
+
+def polarity_to_skhash(polarity_path, polarity_thre, reverse_polarity, snr_df=None, snr_min=2):
+    '''
+    Converts an EQpolarity .polarity file into the SKHASH polarity and catalog inputs.
+    Input:
+        polarity_path: path of the .polarity file
+        polarity_thre: polarities with abs(polarity_raw-0.5)<polarity_thre are discarded
+        reverse_polarity: if True, the polarity signs are reversed
+        snr_df: SNR of each event and station, produced by read_snr_table(). If None, no SNR cut is applied.
+        snr_min: stations with SNR<=snr_min are discarded
+    Output:
+        pol_df: polarity dataframe (event_id,station,network,location,channel,p_polarity)
+        cat_df: catalog dataframe with one row
+    '''
+    event_id = os.path.basename(polarity_path)[:-len('.polarity')]
+    data = pd.read_csv(polarity_path, sep=r'\s+', header=None,
+                       names=['station_id', 'evla', 'evlo', 'depth', 'stla', 'stlo', 'polarity_raw'])
+
+    # Origin time from the file name (YYYYMMDDhhmmss.fff) and location from the first record
+    origin_time = datetime.strptime(event_id, "%Y%m%d%H%M%S.%f")
+    cat_df = pd.DataFrame([{
+        "time": origin_time.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
+        "latitude": data['evla'].iloc[0] if len(data) else float('nan'),
+        "longitude": data['evlo'].iloc[0] if len(data) else float('nan'),
+        "depth": data['depth'].iloc[0] if len(data) else float('nan'),
+        "horz_uncert_km": 0,
+        "vert_uncert_km": 0,
+        "mag": "--",
+        "event_id": event_id
+    }])
+
+    # Probability filter
+    data = data[abs(data['polarity_raw'] - 0.5) >= polarity_thre]
+
+    # SNR cut
+    data = data.assign(station=data['station_id'].map('{:04d}'.format))
+    if snr_df is not None:
+        low_snr_stations = snr_df.loc[(snr_df['Event_ID'] == event_id) & (snr_df['SNR'] <= snr_min), 'Station_ID']
+        data = data[~data['station'].isin(low_snr_stations) & ~data['station_id'].astype(str).isin(low_snr_stations)]
+
+    p_polarity = (data['polarity_raw'] <= 0.5).map({True: 1, False: -1})
+    if reverse_polarity:
+        p_polarity = -p_polarity
+    pol_df = pd.DataFrame({
+        "event_id": event_id,
+        "station": data['station'].values,
+        "network": "5B",
+        "location": "--",
+        "channel": "DHZ",
+        "p_polarity": p_polarity.values
+    })
+    return pol_df, cat_df
+
+
+def ready_files(watch_dir, file_state):
+    '''
+    Returns the .polarity files that are complete (unchanged since the previous poll) and not yet processed.
+    Input:
+        watch_dir: folder to watch
+        file_state: dictionary of the (size, modification time) of each file at the previous poll, and
+            of the processed files. Updated in place.
+    Output:
+        paths: list of the paths of the files to process, sorted by name
+    '''
+    paths = []
+    for entry in os.scandir(watch_dir):
+        if not(entry.name.endswith('.polarity')) or not(entry.is_file()):
+            continue
+        stat = entry.stat()
+        signature = (stat.st_size, stat.st_mtime)
+        previous = file_state.get(entry.path)
+        if previous == ('processed', signature):
+            continue
+        if previous == signature:
+            paths.append(entry.path)
+        else:
+            file_state[entry.path] = signature
+    return sorted(paths)
+
+
+def create_engine(controlfile, service_url):
+    '''
+    Creates the function computing the mechanisms of an event from its SKHASH inputs (the contents of fpfile and catfile).
+    If service_url is given, the inputs are posted to the SKHASH service. Otherwise, the mechanisms are computed
+    in this process, keeping the inputs that do not depend on the events warm.
+    '''
+    if service_url:
+        def compute(payload):
+            request = urllib.request.Request(service_url.rstrip('/') + '/mechanism', data=json.dumps(payload).encode(),
+                                             headers={'Content-Type': 'application/json'})
+            try:
+                with urllib.request.urlopen(request) as response:
+                    return json.loads(response.read())
+            except urllib.error.HTTPError as e:
+                # The service describes the error in the body of the response
+                return json.loads(e.read())
+        return compute
+
+    # The relative paths of the control file are relative to the SKHASH folder
+    sys.path.insert(0, skhash_dir)
+    os.chdir(skhash_dir)
+    import tempfile
+    import functions.service as service
+
+    service_state = {'config': service.base_config(controlfile), 'warm_state': {},
+                     'request_folder': tempfile.mkdtemp(prefix='skhash_stream_')}
+
+    # Computes the events of the control file once, so that the inputs are warm for the first streamed event
+    if any([service_state['config'][param] for param in ['fpfile', 'impfile', 'conpfile', 'dlpfile']]):
+        import io
+        import contextlib
+        import SKHASH
+        warm_up_start = time.time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            SKHASH.run(service_state['config'], warm_state=service_state['warm_state'])
+        print('Warmed up in {:.2f} sec'.format(time.time() - warm_up_start), flush=True)
+
+    def compute(payload):
+        return service.compute_request(service_state, payload)
+    return compute
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Streams EQpolarity .polarity files into SKHASH.')
+    parser.add_argument('--watch_dir', default='./result_ToC2ME_eqpolarity', help='Folder watched for new .polarity files')
+    parser.add_argument('--outfile', default='./results_ToC2ME_streaming/mechanisms.csv', help='CSV file to which the mechanisms are appended')
+    parser.add_argument('--controlfile', default='ToC2ME_demo/control_file_skhash.txt', help='SKHASH control file, relative to the SKHASH folder (e.g., velocity models, station file, parameters)')
+    parser.add_argument('--service_url', default='', help='If given, the events are posted to this SKHASH service (e.g., http://127.0.0.1:8765) rather than computed in this process')
+    parser.add_argument('--polarity_thre', type=float, default=0.45, help='Polarities with abs(polarity_raw-0.5)<polarity_thre are discarded')
+    parser.add_argument('--reverse_polarity', action='store_true', help='Reverses the polarity signs (ToC2ME instrument settings)')
+    parser.add_argument('--snr_file', default='', help='SNR of each event and station (e.g., SNR_event_waveform_toc2me_me_2.csv). Reread when modified.')
+    parser.add_argument('--snr_min', type=float, default=2, help='Stations with SNR<=snr_min are discarded')
+    parser.add_argument('--poll_interval', type=float, default=0.5, help='Time (sec) between scans of watch_dir')
+    parser.add_argument('--skip_existing', action='store_true', help='Only process the files created after starting')
+    parser.add_argument('--once', action='store_true', help='Process the files currently in watch_dir, then exit')
+    args = parser.parse_args()
+
+    watch_dir = os.path.abspath(args.watch_dir)
+    outfile = os.path.abspath(args.outfile)
+    snr_file = os.path.abspath(args.snr_file) if args.snr_file else ''
+    os.makedirs(os.path.dirname(outfile), exist_ok=True)
+
+    compute = create_engine(args.controlfile, args.service_url)
+
+    file_state = {}
+    if args.skip_existing:
+        for entry in os.scandir(watch_dir):
+            if entry.name.endswith('.polarity'):
+                stat = entry.stat()
+                file_state[entry.path] = ('processed', (stat.st_size, stat.st_mtime))
+    snr_df = None
+    snr_mtime = None
+
+    print('Watching {} for .polarity files...'.format(watch_dir), flush=True)
+    while True:
+        paths = ready_files(watch_dir, file_state)
+        for path in paths:
+            landed_time = os.path.getmtime(path)
+            signature = (os.path.getsize(path), landed_time)
+            try:
+                if snr_file and (os.path.getmtime(snr_file) != snr_mtime):
+                    snr_mtime = os.path.getmtime(snr_file)
+                    snr_df = read_snr_table(snr_file)
+                pol_df, cat_df = polarity_to_skhash(path, args.polarity_thre, args.reverse_polarity, snr_df, args.snr_min)
+                response = compute({'fpfile': pol_df.to_csv(index=False), 'catfile': cat_df.to_csv(index=False)})
+            except Exception as e:
+                print('Error processing {}: {}'.format(path, e), flush=True)
+                file_state[path] = ('processed', signature)
+                continue
+            file_state[path] = ('processed', signature)
+
+            if 'error' in response:
+                print('Error processing {}: {}'.format(path, response['error']), flush=True)
+                continue
+            mech_df = pd.DataFrame(response['mechanisms'])
+            if len(mech_df):
+                # SKHASH reads the event ids as numbers, e.g., 20161104064824.680 as 20161104064824.68
+                mech_df['event_id'] = cat_df['event_id'].iloc[0]
+                mech_df.to_csv(outfile, mode='a', index=False, header=not(os.path.exists(outfile)))
+                print('{}: {} polarities, strike/dip/rake {}/{}/{} (quality {}), {:.2f} sec after the file landed'.format(
+                      os.path.basename(path), len(pol_df), mech_df['strike'].iloc[0], mech_df['dip'].iloc[0], mech_df['rake'].iloc[0],
+                      mech_df['quality'].iloc[0], time.time() - landed_time), flush=True)
+            else:
+                print('{}: {} polarities, no mechanism computed'.format(os.path.basename(path), len(pol_df)), flush=True)
+
+        if args.once and not(paths) and all([isinstance(state[0], str) for state in file_state.values()]):
+            break
+        time.sleep(args.poll_interval)